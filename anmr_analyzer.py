@@ -0,0 +1,185 @@
+####################
+#
+# Static timing and resource analysis of compiled programs.
+#
+# Works on the bytecode alone, before anything is downloaded: how long a
+# scan takes, when the arduino will send each DAT block and how many points
+# it holds, and whether the program fits in the arduino's heap.
+#
+# Times are counted in 16 MHz cycles like the firmware does. PULSE, READ_DATA
+# and SYNC first wait for the right point in the carrier's period, which
+# depends on where the timer happens to be, so every time comes as a range:
+# earliest (no waiting) and latest (a full period every time).
+#
+##################
+
+import anmr_common
+import anmr_compiler
+from anmr_compiler import (END_OF_PROGRAM, DELAY_IN_CLOCKS, DELAY_IN_MS, WAIT_FOR_PIN, PULSE, READ_DATA,
+                           SET_FREQ, LOOP, END_LOOP, SYNC)
+
+CLOCK = 16000000  # cycles per second
+CONV_MS = 16000  # cycles per ms, as in the firmware
+CYCLES_PER_POINT = int(round(anmr_common.TIME_STEP * CLOCK))
+HEAP_BYTES = 1500  # what's left of the ATmega328's 2 kB for malloc, roughly
+
+# margins for turning the schedule into deadlines: the arduino's resonator
+# is good to well under 1 %, the rest is serial and host latency.
+CLOCK_TOLERANCE = 0.01
+DEADLINE_SLACK = 0.5  # s
+
+
+def delayMsCycles(ms):
+    # cycles a DELAY_IN_MS of ms takes on the arduino. The firmware reads the
+    # argument into a signed int: from 32768 on it is negative, and
+    # numMS * CONV_MS wraps around as an unsigned long
+    ms -= (ms & 0x8000) << 1
+    return (ms * CONV_MS) & 0xffffffff
+
+
+class ProgramAnalysis:
+    # Result of analyze(). Times are in seconds from GO.
+    #   duration, maxDuration   earliest and latest end of the scan
+    #   blocks                  one (earliest start, latest start, points) per DAT block, in order
+    #   totalReadings           points in all DAT blocks
+    #   programBytes            what the arduino mallocs for the program
+    #   waitsForPin             the program has WAIT_FOR_PIN, its end is open
+    #   excitation              (earliest, latest) middle of the first PULSE, None without one
+    def __init__(self, duration, maxDuration, blocks, programBytes, waitsForPin, heapBytes=HEAP_BYTES,
+                 excitation=None):
+        self.duration = duration
+        self.maxDuration = maxDuration
+        self.blocks = blocks
+        self.totalReadings = sum(block[2] for block in blocks)
+        self.programBytes = programBytes
+        self.heapBytes = heapBytes
+        self.waitsForPin = waitsForPin
+        self.excitation = excitation
+
+    def fitsHeap(self):
+        return self.programBytes <= self.heapBytes
+
+    def headerDeadlines(self, slack=DEADLINE_SLACK):
+        # latest time from GO at which each DAT header can still be expected,
+        # None if the program waits for an external signal
+        if self.waitsForPin:
+            return None
+        return [late * (1 + CLOCK_TOLERANCE) + slack for early, late, points in self.blocks]
+
+    def blockDuration(self, points, slack=DEADLINE_SLACK):
+        # time for the points of one block to arrive once its header is in
+        return points * anmr_common.TIME_STEP * (1 + CLOCK_TOLERANCE) + slack
+
+    def endDeadline(self, slack=DEADLINE_SLACK):
+        # latest time from GO for EOP, None if the program waits for an external signal
+        if self.waitsForPin:
+            return None
+        return self.maxDuration * (1 + CLOCK_TOLERANCE) + slack
+
+    def echoTimes(self):
+        # time of the middle of every DAT block after the middle of the first
+        # pulse (from GO without a pulse), from the middle of each range
+        if self.excitation is not None:
+            start = sum(self.excitation) / 2.0
+        else:
+            start = 0.0
+        return [(early + late) / 2.0 + points * anmr_common.TIME_STEP / 2.0 - start
+                for early, late, points in self.blocks]
+
+    def report(self):
+        lines = ['program: %d bytes of %d available%s' % (self.programBytes, self.heapBytes,
+                                                          '' if self.fitsHeap() else ' - TOO LARGE'),
+                 'scan time: %.4f - %.4f s%s' % (self.duration, self.maxDuration,
+                                                 ' plus WAIT_FOR_PIN' if self.waitsForPin else ''),
+                 'DAT blocks: %d, %d points' % (len(self.blocks), self.totalReadings)]
+        return '\n'.join(lines)
+
+
+class _Timer:
+    # walks instructions keeping the earliest and latest time in cycles
+    def __init__(self):
+        self.hperiod = 0
+        self.early = 0
+        self.late = 0
+        self.blocks = []
+        self.waitsForPin = False
+        self.excitation = None
+
+    def align(self):
+        if self.hperiod:
+            self.late += 2 * self.hperiod
+
+    def step(self, opcode, args):
+        if opcode == DELAY_IN_CLOCKS:
+            self.early += args[0]
+            self.late += args[0]
+        elif opcode == DELAY_IN_MS:
+            self.early += delayMsCycles(args[0])
+            self.late += delayMsCycles(args[0])
+        elif opcode == PULSE:
+            self.align()
+            if self.excitation is None:
+                half = args[-1] * self.hperiod // 2
+                self.excitation = (self.early + half, self.late + half)
+            self.early += args[-1] * self.hperiod
+            self.late += args[-1] * self.hperiod
+        elif opcode == READ_DATA:
+            self.align()
+            self.blocks.append((self.early, self.late, args[-1]))
+            self.early += args[-1] * CYCLES_PER_POINT
+            self.late += args[-1] * CYCLES_PER_POINT
+        elif opcode == SET_FREQ:
+            self.hperiod = args[2]
+        elif opcode == SYNC:
+            self.align()
+        elif opcode == WAIT_FOR_PIN:
+            self.waitsForPin = True
+
+    def loop(self, body, count):
+        # the firmware runs the body at least once, even for a count of 0.
+        # Only the first pass can differ (a SET_FREQ in the body), from the
+        # second on every pass is the same, so it is walked once and repeated.
+        for opcode, args in body:
+            self.step(opcode, args)
+        if count < 2:
+            return
+        early, late, first = self.early, self.late, len(self.blocks)
+        for opcode, args in body:
+            self.step(opcode, args)
+        dEarly = self.early - early
+        dLate = self.late - late
+        passBlocks = self.blocks[first:]
+        for n in range(1, count - 1):
+            self.blocks.extend((e + n * dEarly, l + n * dLate, points) for e, l, points in passBlocks)
+        self.early += (count - 2) * dEarly
+        self.late += (count - 2) * dLate
+
+
+def analyze(prog, heapBytes=HEAP_BYTES):
+    # prog is the bytecode of a CompiledProgram. Raises ValueError if it can't be decoded.
+    instructions = anmr_compiler.decode(prog)
+    timer = _Timer()
+    i = 0
+    while i < len(instructions):
+        offset, opcode, args = instructions[i]
+        if opcode == END_OF_PROGRAM:
+            break
+        if opcode == LOOP:
+            end = i + 1
+            while instructions[end][1] not in (END_LOOP, END_OF_PROGRAM):
+                end += 1
+            body = [(op, a) for o, op, a in instructions[i + 1:end]]
+            if instructions[end][1] == END_LOOP:
+                timer.loop(body, anmr_compiler.loopPasses(args[0]))
+            else:  # never closed: runs through once
+                timer.loop(body, 1)
+            i = end + 1
+            continue
+        timer.step(opcode, args)  # a stray END_LOOP (from a LOOP 0) does nothing
+        i += 1
+    blocks = [(early / CLOCK, late / CLOCK, points) for early, late, points in timer.blocks]
+    excitation = None
+    if timer.excitation is not None:
+        excitation = (timer.excitation[0] / CLOCK, timer.excitation[1] / CLOCK)
+    return ProgramAnalysis(timer.early / CLOCK, timer.late / CLOCK, blocks, len(prog), timer.waitsForPin,
+                           heapBytes, excitation)
@@ -0,0 +1,262 @@
+####################
+#
+# asyncio transport for the arduino server.
+#
+# runProgram reads the arduino with blocking readline()s and polls a global
+# abort flag between them, so aborting and noticing a header both wait on
+# the serial timeout. Here the serial port's fd is watched by the event loop
+# and FrameParser cuts the byte stream into frames as it arrives, so a run
+# can be cancelled at once like any other task, and one loop can serve
+# several arduinos:
+#
+#   async with AsyncDevice(ardSerA) as a, AsyncDevice(ardSerB) as b:
+#       dataA, dataB = await asyncio.gather(acquire(a, scans=4), acquire(b, scans=4))
+#
+# or block by block:
+#
+#   async for samples in device.blocks(analysis):
+#       ...
+#
+# Needs a serial port with a file descriptor, ie. not Windows (see available()).
+# SweepRunner measures through it where it can.
+#
+##################
+
+import asyncio
+import os
+import struct
+
+import numpy
+
+import anmr_compiler
+
+HEADER_TIMEOUT = 20.0  # s to wait for a frame when there is no analysis, as runProgram does
+CANCEL_POLL = 0.01  # s between two looks at runProgram's cancelled()
+
+
+def available(ardSer):
+    # True if ardSer can be served by an AsyncDevice
+    if os.name == 'nt':
+        return False
+    try:
+        ardSer.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+class FrameParser:
+    # Incremental parser for what the arduino sends. feed() takes whatever
+    # bytes arrived and returns the frames completed by them:
+    #   ('line', bytes)       any other text line, without the line end
+    #   ('dat', samples)      a whole DAT block as a numpy int16 array
+    #   ('deb', value)        a DEB debug value
+    #   ('eop', None)         end of program
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.state = 'line'
+        self.line = bytearray()
+        self.needed = 0
+        self.header = bytearray()
+        self.block = None
+        self.filled = 0
+
+    def feed(self, data):
+        frames = []
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if self.state == 'line':
+                end = data.find(b'\n', pos)
+                if end < 0:
+                    self.line += view[pos:]
+                    break
+                self.line += view[pos:end + 1]
+                pos = end + 1
+                line = bytes(self.line).strip()
+                self.line = bytearray()
+                if line == b'DAT':
+                    self.state, self.needed = 'count', 4
+                elif line == b'DEB':
+                    self.state, self.needed = 'deb', 2
+                elif line == b'EOP':
+                    frames.append(('eop', None))
+                else:
+                    frames.append(('line', line))
+            elif self.state in ('count', 'deb'):
+                take = min(self.needed - len(self.header), len(view) - pos)
+                self.header += view[pos:pos + take]
+                pos += take
+                if len(self.header) < self.needed:
+                    break
+                if self.state == 'deb':
+                    frames.append(('deb', struct.unpack('<H', self.header)[0]))
+                    self.state = 'line'
+                else:
+                    points = struct.unpack('<i', self.header)[0]
+                    self.block = numpy.empty(max(points, 0), dtype='<i2')
+                    self.filled = 0
+                    self.state = 'data'
+                self.header = bytearray()
+                if self.state == 'data' and len(self.block) == 0:
+                    frames.append(('dat', self.block))
+                    self.state = 'line'
+            else:  # 'data': straight into the block's buffer
+                raw = self.block.view(numpy.uint8)
+                take = min(len(raw) - self.filled, len(view) - pos)
+                raw[self.filled:self.filled + take] = view[pos:pos + take]
+                self.filled += take
+                pos += take
+                if self.filled == len(raw):
+                    frames.append(('dat', self.block))
+                    self.block = None
+                    self.state = 'line'
+        return frames
+
+
+class AsyncDevice:
+    # One arduino on an open serial.Serial (eg. from anmr_session). Frames are
+    # parsed as soon as the event loop sees data, whether or not anybody is
+    # waiting for them.
+    def __init__(self, ardSer):
+        self.ardSer = ardSer
+        self.fd = ardSer.fileno()
+        self.parser = FrameParser()
+        self.frames = None
+        self.loop = None
+        self.running = False  # GO sent and EOP not seen yet
+        self._blocking = None
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.frames = asyncio.Queue()
+        self._blocking = os.get_blocking(self.fd)
+        os.set_blocking(self.fd, False)
+        self.loop.add_reader(self.fd, self._readable)
+        return self
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+            os.set_blocking(self.fd, self._blocking)
+            self.loop = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.frames.put_nowait(('error', e))
+            return
+        if not data:
+            self.frames.put_nowait(('error', EOFError('serial port closed')))
+            return
+        for frame in self.parser.feed(data):
+            self.frames.put_nowait(frame)
+
+    async def _next(self, deadline):
+        # next frame, raising asyncio.TimeoutError after deadline (loop time)
+        timeout = None if deadline is None else max(0.0, deadline - self.loop.time())
+        kind, value = await asyncio.wait_for(self.frames.get(), timeout)
+        if kind == 'error':
+            raise value
+        if kind == 'eop':
+            self.running = False
+        return kind, value
+
+    async def resync(self, timeout=HEADER_TIMEOUT):
+        # after a cancelled run the arduino is still sending: wait for its EOP
+        deadline = self.loop.time() + timeout
+        while self.running:
+            await self._next(deadline)
+        while not self.frames.empty():
+            self.frames.get_nowait()
+
+    async def query(self, timeout=1.0):
+        await self.resync()
+        self.ardSer.write(bytes([anmr_compiler.QUERY]))
+        kind, value = await self._next(self.loop.time() + timeout)
+        return value
+
+    async def blocks(self, analysis=None):
+        # sends GO and yields the samples of each DAT block as it completes.
+        # analysis (anmr_analyzer.ProgramAnalysis) gives every block and the
+        # EOP a deadline, without it each frame gets HEADER_TIMEOUT.
+        # Raises asyncio.TimeoutError or RuntimeError.
+        await self.resync()
+        self.ardSer.write(bytes([anmr_compiler.GO]))
+        self.running = True
+        kind, value = await self._next(self.loop.time() + HEADER_TIMEOUT)
+        if kind != 'line' or not value.startswith(b'Executing'):
+            self.running = False
+            raise RuntimeError("Arduino didn't start up correctly: " + repr(value))
+        goTime = self.loop.time()
+        deadlines = None
+        if analysis is not None and analysis.headerDeadlines() is not None:
+            deadlines = [start + analysis.blockDuration(points)
+                         for start, (early, late, points) in zip(analysis.headerDeadlines(), analysis.blocks)]
+            deadlines.append(analysis.endDeadline())
+        block = 0
+        while True:
+            if deadlines is not None:
+                deadline = goTime + deadlines[min(block, len(deadlines) - 1)]
+            else:
+                deadline = self.loop.time() + HEADER_TIMEOUT
+            kind, value = await self._next(deadline)
+            if kind == 'dat':
+                block += 1
+                yield value
+            elif kind == 'eop':
+                return
+            elif kind == 'deb':
+                print('got DEB with val:', value)
+            else:
+                raise RuntimeError("Unexpected header message from arduino: " + repr(value))
+
+
+async def acquire(device, scans=1, analysis=None, data=None):
+    # async counterpart of anmr_common.runProgram: runs the program scans
+    # times and returns the summed samples. data, if given, is added to.
+    for scan in range(scans):
+        # with an analysis the scan's buffer is allocated once, up front
+        scanData = numpy.empty(analysis.totalReadings if analysis is not None else 0, dtype='<i2')
+        filled = 0
+        async for samples in device.blocks(analysis):
+            if filled + len(samples) > len(scanData):
+                scanData = numpy.concatenate((scanData[:filled], samples))
+            else:
+                scanData[filled:filled + len(samples)] = samples
+            filled += len(samples)
+        scanData = scanData[:filled]
+        if data is None:
+            data = scanData.astype(numpy.int64)
+        elif data.size != scanData.size:
+            raise ValueError("found new data of a different length than old data")
+        else:
+            data += scanData
+    return data
+
+
+def runProgram(ardSer, scans=1, analysis=None, data=None, cancelled=None):
+    # blocking convenience wrapper, for scripts and SweepRunner. cancelled(),
+    # if given, is asked every CANCEL_POLL s and stops the run once it returns
+    # True. Returns the summed samples as acquire() does, None if cancelled.
+    async def run():
+        async with AsyncDevice(ardSer) as device:
+            task = asyncio.ensure_future(acquire(device, scans, analysis, data))
+            while not task.done():
+                if cancelled is not None and cancelled():
+                    task.cancel()
+                    return None
+                await asyncio.wait([task], timeout=CANCEL_POLL)
+            return task.result()
+    return asyncio.run(run())
@@ -0,0 +1,367 @@
+####################
+#
+# Signal averaging over many scans.
+#
+# Averager keeps, per point, the sum and the sum of squares of all scans in
+# int64. Samples are at most +-512, so neither overflows before some 10^13
+# scans and the mean comes out exact. The variance is formed from them in
+# floating point, as n * sumSq would leave int64 after some 10^6 scans.
+# AveragingEngine runs a resident program scan after scan into an Averager,
+# reports every displayEvery scans and writes a binary checkpoint every
+# checkpointEvery scans rather than rewriting a text file per scan like the
+# old runProgram.
+# runToSNR() instead stops as soon as the spectrum is good enough.
+# Programs that cycle phases from scan to scan get a PhaseCycledAverager,
+# which turns every scan back to a common phase before adding it up.
+#
+##################
+
+import os
+import statistics
+import time
+
+import numpy
+
+import anmr_common
+
+
+class Averager:
+    def __init__(self, points):
+        self.sum = numpy.zeros(points, dtype=numpy.int64)
+        self.sumSq = numpy.zeros(points, dtype=numpy.int64)
+        self.scans = 0
+
+    def __len__(self):
+        return len(self.sum)
+
+    def add(self, scan, scanNum=None):
+        # scanNum is only needed by PhaseCycledAverager
+        scan = numpy.asarray(scan, dtype=numpy.int64)
+        if scan.shape != self.sum.shape:
+            raise ValueError("scan has " + str(scan.size) + " points, expected " + str(self.sum.size))
+        self.sum += scan
+        self.sumSq += scan * scan
+        self.scans += 1
+
+    def mean(self):
+        return self.sum / max(self.scans, 1)
+
+    def variance(self):
+        # sample variance of each point over the scans
+        n = self.scans
+        if n < 2:
+            return numpy.zeros(len(self.sum))
+        return (self.sumSq - self.sum * (self.sum / n)) / (n - 1)
+
+    def noise(self):
+        # rms noise of a single scan, averaged over all points
+        return float(numpy.sqrt(numpy.mean(self.variance()))) if len(self.sum) else 0.0
+
+    def standardError(self):
+        # uncertainty of mean(), per point
+        return numpy.sqrt(self.variance() / max(self.scans, 1))
+
+    def missing(self):
+        # scans still needed to complete a phase cycle, none without one
+        return 0
+
+    def save(self, fileName):
+        # written to a temporary name and renamed, so a crash never leaves half a checkpoint
+        tmpName = anmr_common.tempName(fileName)
+        with open(tmpName, 'wb') as f:
+            numpy.savez(f, sum=self.sum, sumSq=self.sumSq, scans=self.scans)
+        os.replace(tmpName, fileName)
+
+    @classmethod
+    def load(cls, fileName):
+        with numpy.load(fileName) as saved:
+            averager = cls(len(saved['sum']))
+            averager.sum[:] = saved['sum']
+            averager.sumSq[:] = saved['sumSq']
+            averager.scans = int(saved['scans'])
+        return averager
+
+
+def rotatePhase(block, degrees):
+    # turns the phase of a real signal back by degrees: cos(wt + a + degrees)
+    # becomes cos(wt + a). Multiples of 180 only change the sign, anything else
+    # goes through the Hilbert transform of the block.
+    degrees %= 360
+    if degrees == 0:
+        return block
+    if degrees == 180:
+        return -block
+    spectrum = numpy.fft.rfft(block)
+    spectrum[0] = 0
+    if len(block) % 2 == 0:
+        spectrum[-1] = 0
+    hilbert = numpy.fft.irfft(-1j * spectrum, len(block))
+    angle = numpy.radians(degrees)
+    return numpy.cos(angle) * block + numpy.sin(angle) * hilbert
+
+
+class PhaseCycledAverager:
+    # Averages a phase cycled program: one Averager per step of the cycle,
+    # keeping the sums exact integers, turned to the phase of the first step
+    # only when the mean is asked for. The steps are weighted equally, so what
+    # the cycle cancels stays cancelled in an incomplete cycle as long as every
+    # step has been run at least once.
+    #   blockPoints   points of every DAT block of a scan
+    #   phases        for every step of the cycle, how far each block's phase is
+    #                 off that of the first step (PhaseCycle.relativePhases())
+    def __init__(self, blockPoints, phases):
+        self.blockPoints = list(blockPoints)
+        self.phases = numpy.array(phases, dtype=numpy.int64).reshape(len(phases), len(self.blockPoints))
+        self.steps = [Averager(sum(self.blockPoints)) for i in range(len(self.phases))]
+
+    def __len__(self):
+        return sum(self.blockPoints)
+
+    @property
+    def scans(self):
+        return sum(step.scans for step in self.steps)
+
+    @property
+    def counts(self):
+        return [step.scans for step in self.steps]
+
+    def add(self, scan, scanNum):
+        # scanNum is the arduino's scan number, it decides the step of the cycle
+        self.steps[scanNum % len(self.steps)].add(scan)
+
+    def missing(self):
+        # scans still needed until every step has been run equally often
+        counts = self.counts
+        return max(counts) * len(counts) - sum(counts)
+
+    def _rotated(self, step, data):
+        result = numpy.empty(len(data))
+        start = 0
+        for points, phase in zip(self.blockPoints, self.phases[step]):
+            result[start:start + points] = rotatePhase(data[start:start + points], phase)
+            start += points
+        return result
+
+    def mean(self):
+        used = [i for i, step in enumerate(self.steps) if step.scans]
+        if not used:
+            return numpy.zeros(len(self))
+        return sum(self._rotated(i, self.steps[i].mean()) for i in used) / len(used)
+
+    def variance(self):
+        # single scan variance per point, pooled over the steps
+        n = sum(max(step.scans - 1, 0) for step in self.steps)
+        if n == 0:
+            return numpy.zeros(len(self))
+        return sum(step.variance() * max(step.scans - 1, 0) for step in self.steps) / n
+
+    def noise(self):
+        return float(numpy.sqrt(numpy.mean(self.variance()))) if len(self) else 0.0
+
+    def standardError(self):
+        counts = [count for count in self.counts if count]
+        if not counts:
+            return numpy.zeros(len(self))
+        return numpy.sqrt(self.variance() * sum(1.0 / count for count in counts)) / len(counts)
+
+    def save(self, fileName):
+        tmpName = anmr_common.tempName(fileName)
+        with open(tmpName, 'wb') as f:
+            numpy.savez(f, sum=numpy.array([step.sum for step in self.steps]),
+                        sumSq=numpy.array([step.sumSq for step in self.steps]),
+                        counts=numpy.array(self.counts), phases=self.phases, blockPoints=numpy.array(self.blockPoints))
+        os.replace(tmpName, fileName)
+
+    @classmethod
+    def load(cls, fileName):
+        with numpy.load(fileName) as saved:
+            averager = cls(saved['blockPoints'].tolist(), saved['phases'])
+            for step, stepSum, stepSumSq, count in zip(averager.steps, saved['sum'], saved['sumSq'], saved['counts']):
+                step.sum[:] = stepSum
+                step.sumSq[:] = stepSumSq
+                step.scans = int(count)
+        return averager
+
+
+def loadAverager(fileName):
+    # a checkpoint written by either kind of averager
+    with numpy.load(fileName) as saved:
+        cycled = 'phases' in saved.files
+    return PhaseCycledAverager.load(fileName) if cycled else Averager.load(fileName)
+
+
+# longest phase cycle that is co-added step by step. PhaseCycledAverager
+# keeps an Averager per step, and the length is the least common multiple over
+# all PULSE and READ_DATA: increments of 254 and 255 degrees alone make a cycle
+# of 11658600 scans.
+MAX_PHASE_CYCLE = 1024
+
+
+def coAddedCycle(program):
+    # the program's PhaseCycle if its scans are co-added step by step, None if
+    # nothing is cycled or the cycle is longer than MAX_PHASE_CYCLE
+    cycle = program.phase_cycle
+    if cycle.length == 1 or cycle.length > MAX_PHASE_CYCLE:
+        return None
+    return cycle
+
+
+def makeAverager(program):
+    # the right averager for a CompiledProgram
+    cycle = coAddedCycle(program)
+    if cycle is None:
+        if program.phase_cycle.length > MAX_PHASE_CYCLE:
+            print('phase cycle of', program.phase_cycle.length, 'scans is longer than', MAX_PHASE_CYCLE,
+                  '- averaging without turning the phases back')
+        return Averager(program.total_readings)
+    return PhaseCycledAverager(cycle.blockPoints, cycle.relativePhases())
+
+
+class SNREstimate:
+    # snr         peak within signalBand of the frequency over the rms of the off-resonance band
+    # lower       one-sided lower confidence bound of snr (same as snr without a confidence level)
+    # noiseBins   number of spectrum points the noise came from
+    # remainingScans, remainingTime   predicted from snr growing as sqrt(scans)
+    def __init__(self, snr, lower, noiseBins, scans, target, scanTime):
+        self.snr = snr
+        self.lower = lower
+        self.noiseBins = noiseBins
+        self.scans = scans
+        if lower >= target:
+            self.remainingScans = 0
+        elif not lower > 0:
+            self.remainingScans = None  # no signal seen yet (or no estimate at all, nan), can't say
+        else:
+            self.remainingScans = int(numpy.ceil(scans * (target / lower) ** 2)) - scans
+        self.remainingTime = None if self.remainingScans is None or scanTime is None \
+            else self.remainingScans * scanTime
+
+
+def snrBands(points, frequency, timeStep=anmr_common.TIME_STEP, signalBand=50.0, offset=500.0, lowCut=100.0):
+    # which points of the rfft of points samples estimateSNR takes as signal
+    # and which as noise, as two boolean arrays
+    freqs = numpy.fft.rfftfreq(points, timeStep)
+    return numpy.abs(freqs - frequency) <= signalBand, (numpy.abs(freqs - frequency) >= offset) & (freqs >= lowCut)
+
+
+def estimateSNR(mean, frequency, timeStep=anmr_common.TIME_STEP, signalBand=50.0, offset=500.0, lowCut=100.0):
+    # SNR of the averaged signal from its spectrum: the largest magnitude within
+    # signalBand Hz of frequency, against the rms magnitude of every point at
+    # least offset Hz away from it (and above lowCut, clear of the DC offset).
+    # Returns (snr, number of noise points), (nan, 0) if either band has no
+    # points in this spectrum.
+    mean = numpy.asarray(mean, dtype=float)
+    spectrum = numpy.abs(numpy.fft.rfft(mean - mean.mean()))
+    signalBins, noiseBins = snrBands(len(mean), frequency, timeStep, signalBand, offset, lowCut)
+    signal = spectrum[signalBins]
+    noise = spectrum[noiseBins]
+    if len(signal) == 0 or len(noise) == 0:
+        return float('nan'), 0
+    rms = numpy.sqrt(numpy.mean(noise * noise))
+    if rms == 0:
+        return float('inf'), len(noise)
+    return float(signal.max() / rms), len(noise)
+
+
+class AveragingEngine:
+    # Runs scans of one program back to back on an arduino. The program is
+    # downloaded once if the arduino doesn't already hold it. With a runFile
+    # (anmr_runfile.RunWriter) every raw scan is appended to it as well.
+    def __init__(self, ardSer, program, analysis=None, checkpointFile=None, displayEvery=10, checkpointEvery=100,
+                 chunkSize=anmr_common.DOWNLOAD_CHUNK, runFile=None):
+        self.ardSer = ardSer
+        self.program = program
+        self.analysis = analysis
+        self.checkpointFile = checkpointFile
+        self.displayEvery = displayEvery
+        self.checkpointEvery = checkpointEvery
+        self.chunkSize = chunkSize
+        self.runFile = runFile
+        self.averager = None
+        self.scanNum = None  # the arduino's number for the next scan, None while unknown
+
+    def run(self, scans, averager=None, onUpdate=None, cancelEvent=None, stop=None):
+        # adds scans scans to averager (from makeAverager() if None, see self.averager).
+        # onUpdate(averager) is called every displayEvery scans and after the
+        # last one. cancelEvent (threading.Event) is checked between scans and
+        # aborts a running scan as well. stop(averager) is asked
+        # after every scan and ends the run early when it returns True.
+        # Returns True, or the error string from the download or runProgram.
+        if averager is None:
+            averager = makeAverager(self.program)
+        self.averager = averager
+        if not anmr_common.programResident(self.program, self.ardSer):
+            result = anmr_common.sendProgram(self.program, self.ardSer, self.chunkSize)
+            if result is not True:
+                return result
+            self.scanNum = 0
+        elif self.scanNum is None:
+            resident = anmr_common.queryResidentProgram(self.ardSer)
+            self.scanNum = resident[2] if resident is not None else None
+        if self.scanNum is None and isinstance(averager, PhaseCycledAverager):
+            # the scan number picks the step of the cycle, guessing it adds scans up with the wrong phase
+            return "scan number unknown (firmware without QUERY_PROGRAM), can't co-add the phase cycle"
+        anmr_common.ardSer = self.ardSer
+        cancelled = cancelEvent.is_set if cancelEvent is not None else None
+        result = True
+        for i in range(scans):
+            if cancelEvent is not None and cancelEvent.is_set():
+                result = "aborted"
+                break
+            result, data = anmr_common.runProgram(None, None, 0, self.analysis, cancelled=cancelled)
+            if result is not True:
+                break
+            averager.add(data, self.scanNum)
+            if self.runFile is not None:
+                self.runFile.append(data, self.scanNum)
+            if self.scanNum is not None:
+                self.scanNum += 1
+            if onUpdate is not None and averager.scans % self.displayEvery == 0:
+                onUpdate(averager)
+            if self.checkpointFile is not None and averager.scans % self.checkpointEvery == 0:
+                averager.save(self.checkpointFile)
+            if stop is not None and stop(averager):
+                break
+        if onUpdate is not None and averager.scans % self.displayEvery != 0:
+            onUpdate(averager)
+        if self.checkpointFile is not None and averager.scans:
+            averager.save(self.checkpointFile)
+        return result
+
+    def runToSNR(self, targetSNR, frequency, maxScans, averager=None, confidence=None, minScans=2,
+                 onEstimate=None, onUpdate=None, cancelEvent=None, **bands):
+        # runs scans until the SNR at frequency (Hz, eg. the program's %frequency)
+        # reaches targetSNR, or maxScans scans are in averager. With confidence
+        # (eg. 0.95) the lower confidence bound has to reach it instead. A
+        # phase cycle that has been started is completed before stopping.
+        # onEstimate(SNREstimate) is called after every scan; bands go to estimateSNR.
+        # If they hold no spectrum points at frequency there is no estimate
+        # (snr nan, remainingScans None) and all maxScans scans are run.
+        # The scans run in one run(), so onUpdate and checkpoints keep their
+        # intervals. Returns (result, last SNREstimate) with result as from run().
+        z = statistics.NormalDist().inv_cdf(confidence) if confidence else 0.0
+        estimate = None
+        started = time.time()
+        startScans = averager.scans if averager is not None else 0
+        if startScans >= maxScans:
+            return True, estimate
+        signalBins, noiseBins = snrBands(len(averager) if averager is not None else self.program.total_readings,
+                                         frequency, **bands)
+        if not signalBins.any() or not noiseBins.any():
+            print('no spectrum points in the signal or noise band at', frequency, 'Hz, running all', maxScans, 'scans')
+
+        def reached(averager):
+            nonlocal estimate
+            if averager.scans < minScans:
+                return False
+            snr, noiseBins = estimateSNR(averager.mean(), frequency, **bands)
+            # spread of the estimate: noise on the peak plus the error of the noise rms
+            lower = snr - z * numpy.sqrt(1.0 + snr * snr / (2.0 * noiseBins)) if noiseBins else snr
+            scanTime = (time.time() - started) / (averager.scans - startScans)
+            estimate = SNREstimate(snr, lower, noiseBins, averager.scans, targetSNR, scanTime)
+            if onEstimate is not None:
+                onEstimate(estimate)
+            return estimate.remainingScans == 0 and averager.missing() == 0
+
+        result = self.run(maxScans - startScans, averager, onUpdate, cancelEvent, reached)
+        return result, estimate
@@ -0,0 +1,127 @@
+####################
+#
+# Cache of compiled pulse programs.
+#
+# Programs are keyed by a hash of the source text and the resolved values of
+# all %variables, so a program is only compiled once no matter how often it is
+# run. The most recently used programs are kept in memory, and every compiled
+# program is also written to TEMP_DIR so later sessions can skip compilation too.
+# The keys include the compiler's and the entries' format version, so entries
+# written before either changed are compiled again.
+#
+##################
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import anmr_common
+import anmr_compiler
+
+CACHE_DIR = os.path.join(anmr_common.TEMP_DIR, 'prog-cache')
+CACHE_FORMAT = 2  # of the entries written by _store
+
+
+def programKey(text, overrides=None, optimize=False):
+    # the overrides go in separately from the resolved values: a variable that
+    # is redefined part way through the file ends up with the same final value
+    # whether or not it was overridden, but compiles differently.
+    variables = anmr_compiler.resolveVariables(text, overrides)
+    overrides = anmr_compiler.normalizeOverrides(overrides)
+    h = hashlib.sha256(text.encode('utf-8'))
+    h.update(b'\0')
+    h.update(json.dumps([CACHE_FORMAT, anmr_compiler.COMPILER_VERSION, anmr_compiler.PROG_VERSION]).encode('utf-8'))
+    h.update(json.dumps([sorted(variables.items()), sorted(overrides.items())]).encode('utf-8'))
+    if optimize:
+        h.update(b'\0peephole')
+    return h.hexdigest()
+
+
+class ProgramCache:
+    def __init__(self, maxEntries=256, cacheDir=CACHE_DIR):
+        self.maxEntries = maxEntries
+        self.cacheDir = cacheDir  # None: memory only
+        self.hits = 0
+        self.misses = 0
+        self._programs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text, overrides=None, optimize=False):
+        # returns the CompiledProgram for text, compiling it only if needed.
+        # Raises anmr_compiler.CompileError like compile_source.
+        key = programKey(text, overrides, optimize)
+        with self._lock:
+            program = self._programs.get(key)
+            if program is not None:
+                self._programs.move_to_end(key)
+                self.hits += 1
+                return program
+        program = self._load(key)
+        if program is None:
+            program = anmr_compiler.compile_source(text, overrides, optimize)
+            self._store(key, program)
+            hit = False
+        else:
+            hit = True
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._programs[key] = program
+            self._programs.move_to_end(key)
+            while len(self._programs) > self.maxEntries:
+                self._programs.popitem(last=False)
+        return program
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._programs)}
+
+    def clear(self):
+        with self._lock:
+            self._programs.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key + '.json')
+
+    def _load(self, key):
+        if self.cacheDir is None:
+            return None
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+            relocations = entry['relocations']
+            if relocations is not None:
+                relocations = [tuple(relocation) for relocation in relocations]
+            return anmr_compiler.CompiledProgram(bytes.fromhex(entry['prog']), entry['total_readings'],
+                                                 entry['checksum1'], entry['checksum2'], entry['variables'],
+                                                 bytes.fromhex(entry['source_hash']), entry['bytes_saved'],
+                                                 relocations)
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            # not cached, or a damaged entry (cut short, or fields of the wrong
+            # type) that counts as a miss and is just overwritten
+            return None
+
+    def _store(self, key, program):
+        if self.cacheDir is None:
+            return
+        entry = {'prog': program.prog.hex(), 'total_readings': program.total_readings,
+                 'checksum1': program.checksum1, 'checksum2': program.checksum2,
+                 'variables': program.variables, 'source_hash': program.source_hash.hex(),
+                 'bytes_saved': program.bytes_saved, 'relocations': program.relocations}
+        try:
+            if not os.path.isdir(self.cacheDir):
+                os.makedirs(self.cacheDir)
+                os.chmod(self.cacheDir, 0o777)
+            # write to a temporary name first so other processes never see half a file
+            tmpName = anmr_common.tempName(self._path(key))
+            with open(tmpName, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmpName, self._path(key))
+        except (IOError, OSError):
+            print('could not write program cache entry in', self.cacheDir)
@@ -24,7 +24,7 @@ import os
 import tempfile
 import numpy
 import struct
-from threading import Thread
+from threading import Thread, get_ident
 import gc
 import anmr_compiler
 
@@ -42,6 +42,13 @@ TEMP_PROG_NAME = os.path.join(TEMP_DIR, "anmr-prog.txt")
 TEMP_BIN_PROG = os.path.join(TEMP_DIR, "anmr-prog.bin")
 LOCKFILE = os.path.join(TEMP_DIR, "anmr-lockfile")
 
+
+def tempName(fileName):
+    # a name next to fileName to write to before os.replace()ing it, so nobody
+    # sees half a file. It differs per process and per thread, so two writers
+    # of the same file (eg. a StepWorker and the GUI) don't write into each other.
+    return fileName + '.' + str(os.getpid()) + '.' + str(get_ident()) + '.tmp'
+
 CLASS_USE = False
 # sets image path different, and forces EXPERTMODE off
 
@@ -55,6 +62,9 @@ if CLASS_USE:
 # 104 us is the time per point we get from the arduino.
 TIME_STEP = .000104
 
+# opening the hardware port resets the arduino, it takes this long (s) to come back up.
+ARDUINO_RESET_DELAY = 1.6
+
 inited = False  # True means we've talked successfully to the arduino in the past.
 arduinoDev = None  # the device we open to talk to, either a serial pipe or hardware
 hardwareDev = None  # the actual hardware device
@@ -96,6 +106,15 @@ def calc_lims(min,max):
 
 def readAFile(filename):
     #    print 'in readFile with name:', filename
+    # returns [sum of the scans, number of scans], from a run file (see
+    # anmr_runfile) or the older text file: '#scans' and one value per line
+    import anmr_runfile  # it imports this module
+    try:
+        if anmr_runfile.isRunFile(filename):
+            run = anmr_runfile.load(filename)
+            return [run.sum(), len(run)]
+    except (IOError, OSError, ValueError):
+        return [-1, -1]
     # if points has some value, we'll truncate to that many, or pad with zeros.
     # unless we got  no points
     try:
@@ -122,15 +141,45 @@ def readAFile(filename):
 abort = False
 
 
+def readLine(ardSer, deadline, cancelled=None):
+    # reads one '\n' terminated line. readline() gives up after ardSer.timeout
+    # and returns what it has so far, the pieces are joined until the line is
+    # complete. Returns None if time.time() passes deadline or cancelled()
+    # (if given) returns True first.
+    line = b''
+    while True:
+        line = line + ardSer.readline()
+        if cancelled is not None and cancelled():
+            return None
+        if len(line) > 0:
+            if line[-1] == b'\n'[0]:
+                return line
+        if time.time() > deadline:
+            return None
+
+
 def setAbortFlag():
     global abort
     print('setting abort flag')
     abort = True
 
 
-def runProgram(dataFileName, data, scans):
+# runs the program on the arduino and adds the scan to data. With a
+# dataFileName the raw scan is also appended to that run file (see
+# anmr_runfile), which is started anew when scans is 0; program is the
+# CompiledProgram that runs, recorded in the new file's header.
+# analysis is an optional anmr_analyzer.ProgramAnalysis of the downloaded
+# program. With it each DAT block and the EOP get their own deadline from the
+# program's schedule, without it we wait up to 20 s for every header.
+# cancelled, if given, is called while waiting like the abort flag is checked,
+# the run is aborted once it returns True (eg. threading.Event.is_set).
+def runProgram(dataFileName, data, scans, analysis=None, program=None, cancelled=None):
     global ardSer, abort
     abort = False
+
+    def stopped():
+        return abort or (cancelled is not None and cancelled())
+
     try:
         runReading = True
         adata = ""  # this will be the string of data for all the reads
@@ -149,28 +198,26 @@ def runProgram(dataFileName, data, scans):
         #        print ('read: ',line)
         if line[0:9] != b'Executing':
             return "Arduino didn't start up correctly", None
+        goTime = time.time()
+        deadlines = analysis.headerDeadlines() if analysis is not None else None
+        if deadlines is not None:
+            deadlines.append(analysis.endDeadline())
+        block = 0
         #        print ('with len:',len(line))
-        dat_list = bytearray()
+        # with an analysis we know how much is coming and fill the buffer in place
+        dat_list = bytearray(2 * analysis.totalReadings if analysis is not None else 0)
+        filled = 0  # bytes of dat_list received so far
         while runReading:
-            line = b''
+            if deadlines is not None:
+                lineDeadline = goTime + deadlines[min(block, len(deadlines) - 1)]
+            else:
+                lineDeadline = time.time() + 20  # 20 s to start receiving data
             # read a line, with periodic checks for abort flag.
-            for i in range(20):  # 20 s to start receiving data
-                #                print 'bytes for line waiting: ',ardSer.inWaiting()
-                #                print 'before read: ',time.time()-stime
-                fline = ardSer.readline()
-                #                print 'after read: ',time.time()-stime
-                #                print ('fline is:',fline)
-                #                print('with length:',len(fline))
-                #                for i in range(len(fline)):
-                #                    print(ord(fline[i]))
-                if abort:
-                    return "aborted", None
-                line = line + fline
-                if len(line) > 0:
-                    if line[-1] == b'\n'[0]:
-                        break
-                if i == 19:
-                    return "Serial read timeout", None
+            line = readLine(ardSer, lineDeadline, stopped)
+            if stopped():
+                return "aborted", None
+            if line is None:
+                return "Serial read timeout", None
             if line == b'EOP\r\n':
                 runReading = False
             #                print ("EOP")
@@ -201,14 +248,16 @@ def runProgram(dataFileName, data, scans):
                     pts_to_acquire = num_points * 2 - num_read
                     if pts_to_acquire > 10000:  # this is about 0.5 sec.
                         pts_to_acquire = 10000
-                    new_dat = ardSer.read(pts_to_acquire)
-                    dat_list.extend(new_dat)
-                    this_num_read = len(new_dat)
+                    if filled + pts_to_acquire > len(dat_list):
+                        dat_list.extend(bytes(filled + pts_to_acquire - len(dat_list)))
+                    with memoryview(dat_list) as view:
+                        this_num_read = ardSer.readinto(view[filled:filled + pts_to_acquire])
+                    filled += this_num_read
                     num_read += this_num_read
                     if this_num_read == 0:
                         doneRead = True  # should never happen
                     #                    print ('read ',this_num_read,' bytes')
-                    if abort:
+                    if stopped():
                         print('aborting')
                         return "aborted", None
                     # are there any points?
@@ -220,6 +269,7 @@ def runProgram(dataFileName, data, scans):
                 if num_read != num_points * 2:
                     return "Serial read timeout\n expected " + str(num_points * 2) + " bytes, found only: " + str(
                         num_read), None
+                block += 1
                 # add data from this read on to all data
                 # is this too slow?
             #                adata = adata+ndata
@@ -235,6 +285,7 @@ def runProgram(dataFileName, data, scans):
     ###
     # join all the strings together:
     #    adata = ''.join(dat_list)
+    del dat_list[filled:]
     fmt = str(len(dat_list) // 2) + 'h'
     #    print("fmt is:",fmt," dat_list has len: ",len(dat_list))
     #    print(dat_list)
@@ -251,50 +302,110 @@ def runProgram(dataFileName, data, scans):
         if data.size != adata.size:
             return "runProgram found new data of a different length than old data", None
         data = data + adata
-    # write the data to the file
+    # append the scan to the run file, instead of rewriting the sum as text
     if dataFileName is not None:
+        import anmr_runfile  # it imports this module
         try:
-            fd = open(dataFileName, 'w')
-        except:
-            return "runProgram couldn't open output file " + dataFileName + " for writing", None
-        fd.write('#' + str(scans + 1) + '\n')
-        if data.size > 0:
-            data.astype(int).tofile(fd, sep='\n')
-        fd.close()
+            if scans == 0 or not os.path.exists(dataFileName):
+                writer = anmr_runfile.create(dataFileName, adata.size, program)
+            else:
+                writer = anmr_runfile.append(dataFileName)
+            with writer:
+                writer.append(adata)
+        except (IOError, OSError, ValueError) as e:
+            return "runProgram couldn't write the scan to " + dataFileName + ": " + str(e), None
 
     # return the retVal and the data
     #    print 'returning data of len: ',data.size
     return True, data
 
 
+# checksums of the program we last downloaded to each device, keyed by port name.
+# Together with QUERY_PROGRAM this lets us skip downloading a program the
+# arduino already holds.
+residentPrograms = {}
+
+
+def _deviceKey(ardSer):
+    return getattr(ardSer, 'port', None) or id(ardSer)
+
+
+def queryResidentProgram(ardSer):
+    # asks the arduino which program it holds. Returns (checksum1, checksum2, scanNum),
+    # the checksums are 0 if it holds no program. Returns None if the firmware
+    # doesn't know QUERY_PROGRAM (it answers "Unknown Instruction!").
+    ardSer.timeout = 0.2
+    ardSer.flushInput()
+    ardSer.write(bytearray([anmr_compiler.QUERY_PROGRAM]))
+    line = ardSer.readline()
+    if not line.strip().isdigit():
+        return None
+    lines = [line, ardSer.readline(), ardSer.readline()]
+    try:
+        return tuple(int(line) for line in lines)
+    except ValueError:
+        return None
+
+
+def programResident(program, ardSer):
+    # True if program (a CompiledProgram) is what we last downloaded to this
+    # device and the arduino confirms it still holds it.
+    if ardSer is None or program is None:
+        return False
+    checksums = (program.checksum1, program.checksum2)
+    if residentPrograms.get(_deviceKey(ardSer)) != checksums:
+        return False
+    try:
+        resident = queryResidentProgram(ardSer)
+    except (serial.SerialException, OSError):
+        return False
+    return resident is not None and resident[:2] == checksums
+
+
+# The arduino's serial receive buffer holds 64 bytes and fRead empties it as fast as
+# bytes arrive on the wire, so the program can go out in chunks of that size with no
+# per-byte delay. The pacing is open loop: the firmware acknowledges nothing between
+# the "Malloc successful" line and the checksums, so we only keep from getting more
+# than one buffer ahead of the wire, by the time the bytes take at the baud rate.
+# That holds because fRead does nothing else while it reads, an arduino that falls
+# behind still loses bytes, which the checksum check then reports. A per-chunk
+# acknowledgement would need a change of the firmware.
+DOWNLOAD_CHUNK = 64
+
+
 def downloadProgram(fileName,
-                    ardSer):  # xrs: added ardSer serial port handle parameter so I can call this fct from external scripts
+                    ardSer, chunkSize=DOWNLOAD_CHUNK):  # xrs: added ardSer serial port handle parameter so I can call this fct from external scripts
     # global ardSer   # xrs: took this out
-    INTER_DELAY = 150e-6
+    # chunkSize=1 gives the old byte-at-a-time download with a delay after each byte.
     if ardSer is None:
         return 'serial device not open'
+    # binary program file, or the older one-integer-per-line text file
     try:
-        inFile = open(fileName)
-    except:
+        program = anmr_compiler.loadProgram(fileName)
+    except (IOError, OSError):
         return "Couldn't open binary program file: " + fileName
-    lines = inFile.readlines()
-    tnums = numpy.array(lines)
-    inFile.close()
-    tnums = tnums.astype(int)
-    startFlag = tnums[0]
-    num_bytes = tnums[1]
+    except ValueError as e:
+        return "Couldn't read program file " + fileName + ": " + str(e)
+    return sendProgram(program, ardSer, chunkSize)
+
+
+# downloads a CompiledProgram that is already in memory, eg. one patched
+# by anmr_sweep. Returns True or an error string like downloadProgram.
+def sendProgram(program, ardSer, chunkSize=DOWNLOAD_CHUNK):
+    INTER_DELAY = 150e-6
+    if ardSer is None:
+        return 'serial device not open'
+    startFlag = anmr_compiler.START_OF_PROGRAM
+    prog = program.prog  # num_bytes bytes, which include END_OF_PROGRAM at end
+    num_bytes = len(prog)
     #    print 'num_bytes is: ',num_bytes
-    num_points = tnums[2]
+    num_points = program.total_readings
     #    print 'num_points: ', num_points
-
-    # now we have num_bytes more bytes, which include END_OF_PROGRAM at end
-    # so the points from tnums[3]
-    # then have checksums
-    # for i in range(num_bytes):
-    #    print tnums[i+3]
-    checksum1 = tnums[3 + num_bytes]
-    checksum2 = tnums[4 + num_bytes]
+    checksum1 = program.checksum1
+    checksum2 = program.checksum2
     print('checksums read from file: ', checksum1, checksum2)
+    # whatever the arduino held is gone once we start sending
+    residentPrograms.pop(_deviceKey(ardSer), None)
     try:
         ardSer.timeout = 0.2
         ardSer.flushInput()  # windows seems to need this
@@ -304,6 +415,15 @@ def downloadProgram(fileName,
         #        if line != 'ANMR v0.8, Ready\r\n':
         if line != IDENTIFIER:
             return "Didn't find ready from arduino"
+        if chunkSize > 1:
+            line = _downloadChunked(ardSer, startFlag, prog, num_points, chunkSize)
+            if line[0:6] != b'Malloc':
+                return "Arduino didn't accept program header: " + str(line)
+            if line != b'Malloc successful\r\n':
+                return "Arduino couldn't allocate memory for a program of " + str(num_bytes) + " bytes"
+            checkline1 = ardSer.readline()
+            checkline2 = ardSer.readline()
+            return _verifyDownload(ardSer, checkline1, checkline2, checksum1, checksum2)
         #        print 'sending header'
         ardSer.write(bytearray([startFlag]))
         time.sleep(INTER_DELAY)
@@ -327,10 +447,10 @@ def downloadProgram(fileName,
         check1 = 0
         check2 = 0
         for i in range(num_bytes):
-            ardSer.write(bytearray([tnums[i + 3]]))
+            ardSer.write(bytearray([prog[i]]))
             time.sleep(INTER_DELAY)
-            check1 += (i + 1) * tnums[i + 3]
-            check2 += (i + 2) * tnums[i + 3]
+            check1 += (i + 1) * prog[i]
+            check2 += (i + 2) * prog[i]
         # ardSer.write(chr(0))
 
         checkline1 = ardSer.readline()  # read a '\n' terminated line
@@ -342,13 +462,43 @@ def downloadProgram(fileName,
     # should check that files checksums and arduinos checksums match
     except:
         return "Exception occurred while downloading program"
+    return _verifyDownload(ardSer, checkline1, checkline2, checksum1, checksum2)
+
+
+def _downloadChunked(ardSer, startFlag, prog, num_points, chunkSize):
+    # send the 7 header bytes in one write, wait for the arduino to report on its
+    # malloc, then send the program body in chunks. Returns the malloc line.
+    num_bytes = len(prog)
+    header = struct.pack('<BHI', startFlag, num_bytes, num_points)
+    ardSer.write(header)
+    line = ardSer.readline()  # "Malloc successful" or "Malloc failed!"
+    if line != b'Malloc successful\r\n':
+        return line
+    # time for one byte (start, 8 data, stop bits) on the wire
+    byteTime = 10.0 / ardSer.baudrate
+    sendTime = time.time()
+    for start in range(0, num_bytes, chunkSize):
+        chunk = prog[start:start + chunkSize]
+        # wait until the previous chunk has left the wire by the estimate of
+        # byteTime, not by any word from the arduino (see DOWNLOAD_CHUNK)
+        wait = sendTime - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        ardSer.write(chunk)
+        sendTime = time.time() + len(chunk) * byteTime
+    ardSer.flush()
+    return line
+
+
+def _verifyDownload(ardSer, checkline1, checkline2, checksum1, checksum2):
     try:
         check1 = int(checkline1)
         check2 = int(checkline2)
     except:
-        return "Exception converting " + checkline1 + " or " + checkline2 + " to integers."
+        return "Exception converting " + str(checkline1) + " or " + str(checkline2) + " to integers."
     if check1 == checksum1 and check2 == checksum2:
         print('Program downloaded successfully')
+        residentPrograms[_deviceKey(ardSer)] = (checksum1, checksum2)
         return True
     else:
         print('checksums off?')
@@ -529,7 +679,7 @@ def openDev(serialDev, myType):
         return -1
     if myType == 'hardware':
         print('in open, sleeping')
-        time.sleep(1.6)
+        time.sleep(ARDUINO_RESET_DELAY)
     try:
         # flush any waiting input:
         ardSer.flushInput()
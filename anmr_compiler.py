@@ -1,455 +1,822 @@
-import os
-
-END_OF_PROGRAM = 0
-START_OF_PROGRAM = 1
-DELAY_IN_CLOCKS = 2
-DELAY_IN_MS = 3
-CHANGE_PIN = 4
-WAIT_FOR_PIN = 5
-SET_PULSE_PINS = 6
-PULSE = 7
-READ_DATA = 8
-GO = 9
-SET_FREQ = 10
-LOOP = 11
-END_LOOP = 12
-SYNC = 13
-QUERY = 14
-TOGGLE_PIN = 15
-TABLE = 16
-
-# now, go through lines of files
-# first line of file must start with PULSE_PROGRAM
-# if first char of a line is %, its a variable definition
-# of the form %somebody = something
-# build a table of variable/value pairs
-# need to check a variable isn't already in the table with the same name. If so,
-# replace its value with the new one.
-# if line starts with #, throw it away.
-# then deal with commands one at a time
-# DELAY_IN_CLOCKS
-# DELAY_IN_MS
-# CHANGE_PIN
-# WAIT_FOR_PIN
-# PULSE
-# READ_DATA
-# SET_FREQ
-# SET_PULSE_PINS
-# LOOP
-# END_LOOP
-# SYNC
-
-inFile = None
-outFile = None
-vars = []
-vals = []
-numVars = 0
-
-
-def cleanup():
-    global inFile, outFile
-    if inFile is not None:
-        inFile.close()
-    if outFile is not None:
-        outFile.close()
-    return
-
-
-# useful when we know exactly how many arguments to read:
-def getArgs(line, number):
-    global vars, vals, numVars
-    args = []
-
-    fields = line.split()
-    if len(fields) != number + 1:  # first is the command.
-        return False, None
-    for i in range(number):
-        isVariable = False
-        if fields[i + 1][0] == '%':  # its a variable, look it up
-            for j in range(numVars):
-                if fields[i + 1] == vars[j]:  # match!
-                    args.append(vals[j])
-                    #                    print 'variable match: ',fields[i+1],vals[j]
-                    isVariable = True
-        if isVariable == False:
-            try:  # translate directly to an int
-                ivalue = int(fields[i + 1])
-            except:
-                print('failed to translate field: ', fields[i + 1], 'to an int')
-                return False, None
-            args.append(ivalue)
-    #    print 'getArgs returning: ',args
-    return True, args
-
-
-# look for header line:
-def compile(inName, outName):
-    global inFile, outFile, vars, vals, numVars
-    prog = b""
-    freqSet = True  # xrs: was False --> compile prob
-    pinsSet = True  # xrs: was False --> compile prob
-    nullLoop = False
-    totalReadings = 0
-    loopNum = 1
-    loopStarted = False
-
-    try:
-        inFile = open(inName)
-    except:
-        print("couldn't open input file ", inName)
-        return "couldn't open input file"
-    try:
-        outFile = open(outName, "w")
-    except:
-        print("couldn't open output file ", outName)
-        cleanup()
-        return "couldn't open output file"
-    os.chmod(outName, 0o666)
-
-    tables_defined = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    try:
-        if inFile.readline().strip() != "PULSE_PROGRAM":
-            print("invalid pulse program file")
-            return "invalid pulse program file (PULSE_PROGRAM not found)"
-    except:
-        print("error reading first line of file!")
-        return "Error reading first line of pulse program"
-
-    lines = inFile.readlines()
-
-    # now parse, looking for commands, %'s and #'s
-    for i in range(len(lines)):
-        myline = lines[i].split('#')[0]  # remove any trailing comments
-        myline = myline.strip()
-        #        print '\nparsing line: ',myline
-        if len(myline) > 0 and (myline[0]) != '#':  # not a comment
-            if myline[0] == '%':  # variable defintion
-                fields = myline.split("=")
-                if len(fields) != 2:
-                    print("Error parsing variable definition:", myline)
-                    return "Error parsing variable definition: " + myline
-                variable = fields[0].strip()
-                value = fields[1].strip()
-                #                print 'variable: ',variable,', value: ',value
-                try:
-                    ivalue = int(value)
-                except:
-                    print("failed to turn variable value into an int")
-                    return "failed to convert a variable value into an int: " + myline
-                # see if its already in the table:
-                mustAppend = True
-                for j in range(numVars):
-                    if vars[j] == variable:
-                        #                        print 'match found with previous variable'
-                        vals[j] = ivalue
-                        mustAppend = False
-                if mustAppend:
-                    vars.append(variable)
-                    vals.append(ivalue)
-                    numVars += 1
-                # done!
-
-            elif myline.startswith("DELAY_IN_CLOCKS"):
-                #                print "got delay in clocks"
-                # should have one argument
-                rVal, args = getArgs(myline, 1)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                    return "failed to retrieve arguments in: " + myline
-                if args[0] <= 104:
-                    args[0] = 105
-                if nullLoop == False:
-                    prog = prog + bytearray([DELAY_IN_CLOCKS])
-                    prog = prog + bytearray(
-                        [args[0] & 255, args[0] >> 8 & 255, args[0] >> 16 & 255, args[0] >> 24 & 255])
-            #                    prog = prog + bytearray([args[0]>>8 & 255])
-            #                    prog = prog + bytearray([args[0]>>16 & 255])
-            #                    prog = prog + bytearray([args[0]>>24 & 255])
-
-            elif myline.startswith("DELAY_IN_MS"):
-                #                print "got delay in ms"
-                rVal, args = getArgs(myline, 1)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                    return "failed to retrieve arguments in line: " + myline
-                if nullLoop == False and args[0] > 0:
-                    prog = prog + bytearray([DELAY_IN_MS])
-                    prog = prog + bytearray([args[0] & 255, args[0] >> 8 & 255])
-            #                    prog = prog + bytearray([args[0]>>8 & 255])
-
-            elif myline.startswith("CHANGE_PIN"):
-                rVal, args = getArgs(myline, 2)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                #                print "got change pin with args: ",args
-                if nullLoop == False:
-                    prog = prog + bytearray([CHANGE_PIN])
-                    prog = prog + bytearray([args[0], args[1]])  # pin,value
-            #                    prog = prog+bytearray([args[1]]) #value
-
-            elif myline.startswith("TOGGLE_PIN"):
-                rVal, args = getArgs(myline, 2)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                #                print "got change pin with args: ",args
-                if nullLoop == False:
-                    prog = prog + bytearray([TOGGLE_PIN])
-                    prog = prog + bytearray([args[0], args[1]])  # pin, start value
-            #                    prog = prog+bytearray([args[1]]) #value
-
-            elif myline.startswith("WAIT_FOR_PIN"):
-                rVal, args = getArgs(myline, 2)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                    return "failed to retrieve arguments in line: " + myline
-                #                print "got wait_for_pin with args: ",args
-                if nullLoop == False:
-                    prog = prog + bytearray([WAIT_FOR_PIN])
-                    prog = prog + bytearray([args[0], args[1]])  # pin
-            #                    prog = prog+bytearray([args[1]])#code for waiting.
-
-            elif myline.startswith("PULSE"):
-                if freqSet == False or pinsSet == False:
-                    print("Pulse, but freqSet or pinsSet is False")
-                    return "PULSE requested, but freqSet or pinsSet is False"
-                #                print "got PULSE"
-                if myline.split()[1][0] == 'T':  # phase table style
-                    # which table?
-                    try:
-                        tnum = int(myline.split()[1][1:])
-                    except:
-                        print("Error translating table number")
-                        return "Error translating table number: " + myline
-                    if tnum < 0 or tnum > 15:
-                        print("Illegal table number")
-                        return 'Illegal table number: ' + myline
-                    if tables_defined[tnum] != 1:
-                        print("Table not defined")
-                        return 'Table not defined: ' + myline
-                    # now get the number of half cycles in the pulse
-                    rVal, args = getArgs(myline[5:].strip(), 1)
-                    if rVal == False:
-                        print("1 failed to getArgs in line: ", myline)
-                        return "failed to retrieve arguments in line: " + myline
-                    print("number of cycles: ", args[0])
-                    if nullLoop == False:
-                        prog = prog + bytearray([PULSE])
-                        prog = prog + bytearray([255 - tnum])
-                        prog = prog + bytearray([args[0] & 255])
-                        prog = prog + bytearray([args[0] >> 8 & 255])
-
-                else:
-                    rVal, args = getArgs(myline, 4)
-                    if rVal == False:
-                        print("2 failed to getArgs in line: ", myline)
-                        return "failed to retrieve arguments in line: " + myline
-                    # args are start phase, phase increment,
-                    # steps between phase increment and number of half periods
-                    if args[2] == 0:
-                        args[2] = 1
-                    if nullLoop == False:
-                        prog = prog + bytearray([PULSE])
-                        prog = prog + bytearray([(args[0] % 360) // 2])
-                        prog = prog + bytearray([(args[1] % 360) // 2])
-                        prog = prog + bytearray([args[2] & 255])
-                        prog = prog + bytearray([args[3] & 255])
-                        prog = prog + bytearray([args[3] >> 8 & 255])
-
-            elif myline.startswith("READ_DATA"):
-                #                print( 'got read_data')
-
-                if myline.split()[1][0] == 'T':  # phase table style
-                    # which table?
-                    try:
-                        tnum = int(myline.split()[1][1:])
-                    except:
-                        print("Error translating table number")
-                        return "Error translating table number: " + myline
-                    if tnum < 0 or tnum > 15:
-                        print("Illegal table number")
-                        return 'Illegal table number ' + myline
-                    if tables_defined[tnum] != 1:
-                        print("Table not defined")
-                        return 'Table not defined ' + myline
-                    if freqSet == 0:
-                        print('need to set frequency before reading with phase table is possible')
-                        return 'READ_DATA requested phase cycling with phase table is possible.'
-                    # now get the number of half cycles in the pulse
-                    rVal, args = getArgs(myline[9:].strip(), 1)
-                    if rVal == False:
-                        print("failed to getArgs in line:", myline)
-                        return "failed to retrieve arguments in line: " + myline
-                    print("number of points: ", args[0])
-                    if nullLoop == False:
-                        if loopStarted:
-                            totalReadings += args[0] * loopNum
-                        else:
-                            totalReadings += args[0]
-                        prog = prog + bytearray([READ_DATA])
-                        prog = prog + bytearray([255 - tnum])  # always more than 180
-                        prog = prog + bytearray([args[0] & 255])
-                        prog = prog + bytearray([args[0] >> 8 & 255])
-                        prog = prog + bytearray([args[0] >> 16 & 255])
-                        prog = prog + bytearray([args[0] >> 24 & 255])
-                else:  # initial, increment, modulo style
-                    #                    print("looking for old style")
-                    rVal, args = getArgs(myline, 4)
-                    if rVal == False:
-                        print("failed to getArgs in line: ", myline)
-                        return "failed to retrieve arguments in line: " + myline
-                    if args[1] > 0 and freqSet == 0:
-                        print('need to set frequency before reading with phase increment ' + args[1] + ' is possible')
-                        return 'READ_DATA requested phase cycling with increment ' + args[1] + ', but frequency not set'
-                    if args[2] == 0:
-                        args[2] = 1
-                    if nullLoop == False:
-                        if loopStarted:
-                            totalReadings += args[3] * loopNum
-                        else:
-                            totalReadings += args[3]
-                        prog = prog + bytearray([READ_DATA])
-                        prog = prog + bytearray([(args[0] % 360) // 2])  # always less than 180
-                        prog = prog + bytearray([(args[1] % 360) // 2])
-                        prog = prog + bytearray([args[2] & 255])
-                        prog = prog + bytearray([args[3] & 255])
-                        prog = prog + bytearray([args[3] >> 8 & 255])
-                        prog = prog + bytearray([args[3] >> 16 & 255])
-                        prog = prog + bytearray([args[3] >> 24 & 255])
-
-            elif myline.startswith("SET_FREQ"):
-                #                print 'got set freq'
-                rVal, args = getArgs(myline, 1)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                    return "failed to retrieve arguments in line: " + myline
-                hperiod = int(8000000 / args[0])
-                delc1 = int(0.3591 / 3.14159 * hperiod)
-                #                delc1 = int (hperiod/6) # for minimum 3rd harmonic
-                delc2 = int(hperiod - 2 * delc1)
-                if nullLoop == False:
-                    prog = prog + bytearray([SET_FREQ])
-                    prog = prog + bytearray([delc1 & 255])
-                    prog = prog + bytearray([delc1 >> 8 & 255])
-                    prog = prog + bytearray([delc2 & 255])
-                    prog = prog + bytearray([delc2 >> 8 & 255])
-                    prog = prog + bytearray([hperiod & 255])
-                    prog = prog + bytearray([hperiod >> 8 & 255])
-                    freqSet = True
-
-            elif myline.startswith('SET_PULSE_PINS'):
-                #                print 'got set pulse pins'
-                rVal, args = getArgs(myline, 2)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                    return "failed to retrieve arguments in line: " + myline
-                if nullLoop == False:
-                    prog = prog + bytearray([SET_PULSE_PINS])
-                    prog = prog + bytearray([args[0]])
-                    prog = prog + bytearray([args[1]])
-                    pinsSet = 1
-            #                    print 'set pinsSet'
-
-            elif myline.startswith('LOOP'):
-                #                print 'got loop'
-                if loopStarted:
-                    print("can't nest loops")
-                    return "can't nest loops"
-                rVal, args = getArgs(myline, 1)
-                if rVal == False:
-                    print("failed to getArgs in line: ", myline)
-                    return "failed to retrieve arguments in line: " + myline
-                if args[0] == 0:
-                    nullLoop = True
-                    loopStarted = True
-                else:
-                    loopStarted = True
-                    loopNum = args[0]
-                    prog = prog + bytearray([LOOP])
-                    prog = prog + bytearray([args[0] & 255])
-                    prog = prog + bytearray([args[0] >> 8 & 255])
-
-            elif myline.startswith('END_LOOP'):
-                #                print 'got end loop'
-                if loopStarted == False:
-                    print("ending a loop without starting?")
-                    return "END_LOOP found without a LOOP start"
-                loopStarted = False
-                nullLoop = False
-                prog = prog + bytearray([END_LOOP])
-
-            elif myline.startswith('SYNC'):
-                #                print 'got SYNC'
-                if nullLoop == False:
-                    prog = prog + bytearray([SYNC])
-
-            elif myline.startswith('TABLE'):
-                # define a phase table syntax: TABLE T0 {0,90,90,180,180,0}
-                # check that the line specifies a table number T0 - T15
-                if myline.split()[1][0] != 'T':
-                    print("Table number not Tn")
-                    return "Table number not Tn: " + myline
-                # get the table number
-                try:  # translate directly to an int
-                    tnum = int(myline.split()[1][1:])
-                except:
-                    print('Failed to translate table number')
-                    return "Failed to translate table number: " + myline
-                if tnum > 15 or tnum < 0:
-                    print('Illegal table number')
-                    return "Illegal table number: " + myline
-                #                print ' got table number ',tnum
-                if len(myline.split('}')) != 2 or len(myline.split('{')) != 2:
-                    print("sytax error in table definition")
-                    return "syntax error in table definition: " + myline
-                phase_list = myline.split('{')[1].split('}')[0].split(',')
-                #               print phase_list
-                prog = prog + bytearray([TABLE])
-                prog = prog + bytearray([255 - tnum])
-                prog = prog + bytearray([len(phase_list)])
-                if len(phase_list) == 0:
-                    print("empty phase table?")
-                    return "empty phase table? " + myline
-                for i in range(len(phase_list)):
-                    try:
-                        phval = int(phase_list[i])
-                    except:
-                        print("Failed to convert phase value in table to int")
-                        return "Failed to convert phase value in table to int: " + myline
-                    phval = (phval % 360) // 2
-                    #                    print phval
-                    prog = prog + bytearray([phval])
-                tables_defined[tnum] = 1  # flag that the table has been defined.
-            # first byte is TABLE, then 255-tnum, then length of table, then the table itself, each
-            # phase is one byte: degrees/2 (0-179 -> 0-358deg)
-            elif len(myline) == 0:
-                print('got an empty line')
-            else:
-                print('got an unknown line: ', myline)
-                return "got an unknown line: " + myline
-
-    prog = prog + bytearray([END_OF_PROGRAM])
-    print('Compilation successful, XRS')
-    check1 = 0
-    check2 = 0
-    for i in range(len(prog)):
-        check1 += (i + 1) * (ord(prog[i:i + 1]))
-        check2 += (i + 2) * (ord(prog[i:i + 1]))
-
-    #    print 'got checksums: ',check1,check2
-    outFile.write(str(START_OF_PROGRAM) + '\n')
-    outFile.write(str(len(prog)) + '\n')
-    outFile.write(str(totalReadings) + '\n')
-    for i in range(len(prog)):
-        outFile.write(str(prog[i]) + '\n')
-    outFile.write(str(check1) + '\n')
-    outFile.write(str(check2) + '\n')
-    outFile.close()
-    inFile.close()
-    return True
-# to write the file, we write:  1byte start, 2 byte number of bytes in program+1
-# then 4 byte of number of points to read
-# and 1 byte END_OF_PROGRAM
-# then finally the two checksums.
-
-# usage:
-# compile('/tmp/Anmr/anmr-prog.txt','/tmp/Anmr/anmr-prog/bin')
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+END_OF_PROGRAM = 0
+START_OF_PROGRAM = 1
+DELAY_IN_CLOCKS = 2
+DELAY_IN_MS = 3
+CHANGE_PIN = 4
+WAIT_FOR_PIN = 5
+SET_PULSE_PINS = 6
+PULSE = 7
+READ_DATA = 8
+GO = 9
+SET_FREQ = 10
+LOOP = 11
+END_LOOP = 12
+SYNC = 13
+QUERY = 14
+TOGGLE_PIN = 15
+TABLE = 16
+QUERY_PROGRAM = 17
+
+# the firmware reads DELAY_IN_MS into a signed int, longer delays come out wrong
+MAX_DELAY_MS = 0x7fff
+
+# goes up whenever the same source compiles to different bytecode,
+# checksums or relocations, so anmr_cache doesn't serve programs from an older compiler
+COMPILER_VERSION = 3
+
+# binary program files start with a fixed 64 byte header:
+# magic, version, flags (unused), program length, total readings,
+# checksum1, checksum2, sha256 of the source text
+# followed by the program bytes. All little endian.
+PROG_MAGIC = b'ANMR'
+PROG_VERSION = 1
+PROG_HEADER = struct.Struct('<4sHHIIQQ32s')
+
+# now, go through lines of files
+# first line of file must start with PULSE_PROGRAM
+# if first char of a line is %, its a variable definition
+# of the form %somebody = something
+# build a table of variable/value pairs
+# need to check a variable isn't already in the table with the same name. If so,
+# replace its value with the new one.
+# if line starts with #, throw it away.
+# then deal with commands one at a time
+# DELAY_IN_CLOCKS
+# DELAY_IN_MS
+# CHANGE_PIN
+# WAIT_FOR_PIN
+# PULSE
+# READ_DATA
+# SET_FREQ
+# SET_PULSE_PINS
+# LOOP
+# END_LOOP
+# SYNC
+
+
+class CompileError(Exception):
+    pass
+
+
+class CompiledProgram:
+    # the result of compiling one pulse program: the bytecode (including the
+    # trailing END_OF_PROGRAM), the number of points the arduino will send,
+    # the two checksums the arduino computes on download, and the resolved
+    # values of all %variables.
+    # relocations lists where %variables land in prog as (offset, size,
+    # variable, kind) tuples, see encodeRelocation(), with size 0 where the
+    # variable's value dropped the instruction. None when the program
+    # can't be patched (optimized, or loaded from a file).
+    def __init__(self, prog, totalReadings, checksum1, checksum2, variables, sourceHash=None, bytesSaved=0,
+                 relocations=None):
+        self.prog = prog
+        self.total_readings = totalReadings
+        self.checksum1 = checksum1
+        self.checksum2 = checksum2
+        self.variables = variables
+        self.source_hash = sourceHash  # sha256 digest of the source, None if unknown
+        self.bytes_saved = bytesSaved  # by the peephole optimizer, 0 if it didn't run
+        self.relocations = relocations
+        self._phaseCycle = None
+
+    @property
+    def phase_cycle(self):
+        # the program's phase cycling schedule (PhaseCycle), worked out from
+        # prog the first time it is asked for
+        if self._phaseCycle is None:
+            self._phaseCycle = phaseCycle(self.prog)
+        return self._phaseCycle
+
+    def __len__(self):
+        return len(self.prog)
+
+    def toText(self):
+        # the legacy one-integer-per-line format read by downloadProgram:
+        # START_OF_PROGRAM, length, totalReadings, the bytes, checksum1, checksum2
+        fields = [START_OF_PROGRAM, len(self.prog), self.total_readings]
+        fields.extend(self.prog)
+        fields.append(self.checksum1)
+        fields.append(self.checksum2)
+        return '\n'.join(map(str, fields)) + '\n'
+
+    def toBinary(self):
+        header = PROG_HEADER.pack(PROG_MAGIC, PROG_VERSION, 0, len(self.prog), self.total_readings,
+                                  self.checksum1, self.checksum2, self.source_hash or bytes(32))
+        return header + bytes(self.prog)
+
+
+def _int16(value):
+    # value as the arduino's 16 bit int holds it
+    value &= 0xffff
+    return value - ((value & 0x8000) << 1)
+
+
+def checksums(prog):
+    # same sums the arduino forms while receiving the program: (i+1)*head[i]
+    # is worked out in a 16 bit int, from byte 128 on it can wrap around, and
+    # is added to the unsigned long sums sign extended
+    check1 = 0
+    check2 = 0
+    for i, b in enumerate(prog):
+        check1 += _int16((i + 1) * b)
+        check2 += _int16((i + 2) * b)
+    return check1 & 0xffffffff, check2 & 0xffffffff
+
+
+def loopPasses(count):
+    # times the arduino runs the body of a LOOP of count. The firmware reads
+    # count into a signed int, runs the body and jumps back while the
+    # decremented counter is above 0: 0 and 32769 to 65535 run it once
+    # (32768 is -32768, which wraps around to 32767 on the first decrement)
+    counter = _int16(count - 1)
+    return counter + 1 if counter > 0 else 1
+
+
+def encodeRelocation(kind, value):
+    # the bytes Compiler emits for value at a relocation of the given kind.
+    # Raises ValueError for a value that would change the program's layout
+    # instead (a DELAY_IN_MS or LOOP of 0 drops instructions) or doesn't fit.
+    if kind == 'byte':
+        if not 0 <= value <= 255:
+            raise ValueError("value doesn't fit in a byte: " + str(value))
+        return bytes([value])
+    if kind == 'word':
+        return (value & 0xffff).to_bytes(2, 'little')
+    if kind == 'ms' or kind == 'loop':
+        if value <= 0:
+            raise ValueError("a " + kind + " value of " + str(value) + " changes the program's layout")
+        return (value & 0xffff).to_bytes(2, 'little')
+    if kind == 'clocks':
+        return (max(value, 105) & 0xffffffff).to_bytes(4, 'little')
+    if kind == 'points':
+        return (value & 0xffffffff).to_bytes(4, 'little')
+    if kind == 'phase':
+        return bytes([(value % 360) // 2])
+    if kind == 'mod':
+        return bytes([(value if value != 0 else 1) & 255])
+    if kind == 'freq':
+        if value <= 0:
+            raise ValueError("frequency must be positive: " + str(value))
+        hperiod = int(8000000 / value)
+        delc1 = int(0.3591 / 3.14159 * hperiod)
+        delc2 = int(hperiod - 2 * delc1)
+        return b''.join((word & 0xffff).to_bytes(2, 'little') for word in (delc1, delc2, hperiod))
+    raise ValueError("unknown relocation kind: " + kind)
+
+
+def decode(prog):
+    # splits bytecode back into instructions. Returns a list of
+    # (offset, opcode, args) up to and including END_OF_PROGRAM. args are:
+    #   DELAY_IN_CLOCKS (cycles,)  DELAY_IN_MS (ms,)  LOOP (count,)
+    #   CHANGE_PIN, TOGGLE_PIN, WAIT_FOR_PIN, SET_PULSE_PINS (byte, byte)
+    #   PULSE (phase, inc, mod, halfPeriods) or (table, halfPeriods)
+    #   READ_DATA (phase, inc, mod, points) or (table, points)
+    #   SET_FREQ (delc1, delc2, hperiod)  TABLE (table, phases)
+    #   END_LOOP, SYNC, END_OF_PROGRAM ()
+    # phase and table fields are the raw bytes: phases in units of 2 degrees,
+    # tables as 255-tnum. Raises ValueError on anything that isn't an instruction.
+    instructions = []
+    ptr = 0
+    try:
+        while True:
+            offset = ptr
+            opcode = prog[ptr]
+            ptr += 1
+            if opcode == DELAY_IN_CLOCKS:
+                args = (int.from_bytes(prog[ptr:ptr + 4], 'little'),)
+                ptr += 4
+            elif opcode == DELAY_IN_MS or opcode == LOOP:
+                args = (int.from_bytes(prog[ptr:ptr + 2], 'little'),)
+                ptr += 2
+            elif opcode in (CHANGE_PIN, TOGGLE_PIN, WAIT_FOR_PIN, SET_PULSE_PINS):
+                args = (prog[ptr], prog[ptr + 1])
+                ptr += 2
+            elif opcode == PULSE or opcode == READ_DATA:
+                size = 2 if opcode == PULSE else 4
+                if prog[ptr] < 180:
+                    args = (prog[ptr], prog[ptr + 1], prog[ptr + 2])
+                    ptr += 3
+                else:
+                    args = (prog[ptr],)
+                    ptr += 1
+                args += (int.from_bytes(prog[ptr:ptr + size], 'little'),)
+                ptr += size
+            elif opcode == SET_FREQ:
+                args = tuple(int.from_bytes(prog[i:i + 2], 'little') for i in (ptr, ptr + 2, ptr + 4))
+                ptr += 6
+            elif opcode == TABLE:
+                tlen = prog[ptr + 1]
+                args = (prog[ptr], bytes(prog[ptr + 2:ptr + 2 + tlen]))
+                ptr += 2 + tlen
+            elif opcode in (END_LOOP, SYNC, END_OF_PROGRAM):
+                args = ()
+            else:
+                raise ValueError("not an instruction byte: " + str(opcode) + " at " + str(offset))
+            if ptr > len(prog):
+                raise IndexError
+            instructions.append((offset, opcode, args))
+            if opcode == END_OF_PROGRAM:
+                return instructions
+    except IndexError:
+        raise ValueError("program ends in the middle of an instruction at " + str(offset))
+
+
+class PhaseCycle:
+    # How the phases of a program change from scan to scan. The arduino works
+    # out the phase of every PULSE and READ_DATA from its scan number, as
+    # start + increment * (scanNum / modulo) or table[scanNum % length]; this
+    # is that schedule, for every PULSE and READ_DATA in the order they run
+    # (loops unrolled).
+    #   steps     list of ('pulse' or 'read', rule, points), points 0 for pulses.
+    #             rule is ('inc', start, increment, modulo) or ('table', phases)
+    #             in degrees.
+    #   tables    {table number: phases in degrees} as defined by the program
+    #   length    scans until every phase repeats, 1 if nothing is cycled
+    def __init__(self, steps, tables):
+        self.steps = steps
+        self.tables = tables
+        self.length = 1
+        for kind, rule, points in steps:
+            self.length = self.length * _period(rule) // math.gcd(self.length, _period(rule))
+
+    @property
+    def blockPoints(self):
+        return [points for kind, rule, points in self.steps if kind == 'read']
+
+    def pulsePhases(self, scanNum):
+        return [_phaseAt(rule, scanNum) for kind, rule, points in self.steps if kind == 'pulse']
+
+    def readPhases(self, scanNum):
+        return [_phaseAt(rule, scanNum) for kind, rule, points in self.steps if kind == 'read']
+
+    def blockPhases(self, scanNum):
+        # the phase the signal of every DAT block arrives with in scan scanNum.
+        # The first pulse sets the phase of the magnetisation, every further one
+        # is taken as a refocusing pulse (phase 2 * pulse - phase). READ_DATA
+        # starts sampling at its phase of the carrier and negates the data from
+        # 180 degrees on, which adds its phase to that of the signal.
+        phases = []
+        signal = None
+        for kind, rule, points in self.steps:
+            phase = _phaseAt(rule, scanNum)
+            if kind == 'pulse':
+                signal = phase if signal is None else (2 * phase - signal) % 360
+            else:
+                phases.append(((signal or 0) + phase) % 360)
+        return phases
+
+    def relativePhases(self):
+        # blockPhases for every scan of a cycle, less those of the first scan:
+        # how far each scan's blocks have to be turned back to add up coherently
+        first = self.blockPhases(0)
+        return [[(phase - ref) % 360 for phase, ref in zip(self.blockPhases(scanNum), first)]
+                for scanNum in range(self.length)]
+
+
+def _phaseAt(rule, scanNum):
+    # the firmware's phase calculation
+    if rule[0] == 'table':
+        return rule[1][scanNum % len(rule[1])]
+    kind, start, increment, modulo = rule
+    return (start + increment * (scanNum // modulo)) % 360
+
+
+def _period(rule):
+    if rule[0] == 'table':
+        return len(rule[1])
+    kind, start, increment, modulo = rule
+    if increment % 360 == 0:
+        return 1
+    return modulo * (360 // math.gcd(increment, 360))
+
+
+class _PhaseWalker:
+    # collects the steps of a PhaseCycle instruction by instruction
+    def __init__(self):
+        self.steps = []
+        self.tables = {}
+        self.freqSet = False
+
+    def step(self, opcode, args):
+        if opcode == SET_FREQ:
+            self.freqSet = True
+        elif opcode == TABLE:
+            self.tables[255 - args[0]] = tuple(phase * 2 for phase in args[1])
+        elif opcode == PULSE or opcode == READ_DATA:
+            if len(args) == 2:
+                rule = ('table', self.tables.get(255 - args[0], (0,)))
+            else:
+                rule = ('inc', args[0] * 2, args[1] * 2, args[2] or 1)
+            if opcode == PULSE:
+                self.steps.append(('pulse', rule, 0))
+            else:
+                if not self.freqSet:
+                    # no carrier to line up with: the firmware only negates below 180 degrees
+                    rule = ('inc', 180 if rule[1] < 180 else 0, 0, 1)
+                self.steps.append(('read', rule, args[-1]))
+
+
+def phaseCycle(prog):
+    # the PhaseCycle of bytecode. Raises ValueError if it can't be decoded.
+    instructions = decode(prog)
+    walker = _PhaseWalker()
+    i = 0
+    while i < len(instructions):
+        offset, opcode, args = instructions[i]
+        if opcode == END_OF_PROGRAM:
+            break
+        if opcode == LOOP:
+            # as in anmr_analyzer: the body runs at least once, a stray END_LOOP does nothing
+            end = i + 1
+            while instructions[end][1] not in (END_LOOP, END_OF_PROGRAM):
+                end += 1
+            passes = loopPasses(args[0]) if instructions[end][1] == END_LOOP else 1
+            for n in range(passes):
+                for o, op, a in instructions[i + 1:end]:
+                    walker.step(op, a)
+            i = end + 1
+            continue
+        walker.step(opcode, args)
+        i += 1
+    return PhaseCycle(walker.steps, walker.tables)
+
+
+def normalizeOverrides(overrides):
+    # accept {'frequency': 2153} as well as {'%frequency': 2153}
+    if not overrides:
+        return {}
+    normalized = {}
+    for name, value in overrides.items():
+        name = name.strip()
+        if not name.startswith('%'):
+            name = '%' + name
+        normalized[name] = int(value)
+    return normalized
+
+
+def resolveVariables(text, overrides=None):
+    # the final value of every %variable in the source after applying the
+    # overrides, without compiling the program.
+    overrides = normalizeOverrides(overrides)
+    variables = dict(overrides)
+    for line in text.splitlines():
+        myline = line.split('#')[0].strip()
+        if myline.startswith('%'):
+            fields = myline.split('=')
+            if len(fields) == 2:
+                variable = fields[0].strip()
+                if variable not in overrides:
+                    value = fields[1].strip()
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        pass  # compile() will complain about it
+                    variables[variable] = value
+    return variables
+
+
+class Compiler:
+    # Holds the state of one compilation. Nothing is shared between instances,
+    # so compilers can run concurrently in several threads. A Compiler can be
+    # reused; every call to compile() starts from a clean symbol table.
+    # With optimize set the bytecode goes through peephole() before it is returned.
+
+    def __init__(self, overrides=None, optimize=False):
+        self.overrides = normalizeOverrides(overrides)
+        self.optimize = optimize
+
+    def _reset(self):
+        self.vars = dict(self.overrides)
+        self.prog = bytearray()
+        self.freqSet = True  # xrs: was False --> compile prob
+        self.pinsSet = True  # xrs: was False --> compile prob
+        self.nullLoop = False
+        self.totalReadings = 0
+        self.loopNum = 1
+        self.loopStarted = False
+        self.tables_defined = [0] * 16
+        self.relocations = []
+        self.argVars = []  # for each argument getArgs returned, the %variable it came from or None
+
+    # useful when we know exactly how many arguments to read:
+    def getArgs(self, line, number):
+        fields = line.split()
+        if len(fields) != number + 1:  # first is the command.
+            raise CompileError("failed to retrieve arguments in line: " + line)
+        args = []
+        self.argVars = []
+        for field in fields[1:]:
+            if field[0] == '%' and field in self.vars:  # its a variable, look it up
+                args.append(self.vars[field])
+                self.argVars.append(field)
+                continue
+            self.argVars.append(None)
+            try:  # translate directly to an int
+                args.append(int(field))
+            except ValueError:
+                raise CompileError("failed to translate field: " + field + " to an int in line: " + line)
+        return args
+
+    def _relocate(self, index, offset, size, kind):
+        # called just before an instruction is appended: records where argument
+        # index lands (offset bytes into the instruction) if it came from a %variable.
+        # An instruction the value drops (DELAY_IN_MS or LOOP of 0) gets an entry
+        # of size 0, so a patcher knows the variable can't be moved by patching.
+        variable = self.argVars[index]
+        if variable is not None:
+            self.relocations.append((len(self.prog) + offset, size, variable, kind))
+
+    def _tableNumber(self, myline, needDefined=True):
+        try:
+            tnum = int(myline.split()[1][1:])
+        except ValueError:
+            raise CompileError("Error translating table number: " + myline)
+        if tnum < 0 or tnum > 15:
+            raise CompileError("Illegal table number: " + myline)
+        if needDefined and self.tables_defined[tnum] != 1:
+            raise CompileError("Table not defined: " + myline)
+        return tnum
+
+    def compile(self, text):
+        self._reset()
+        lines = text.splitlines()
+        if not lines or lines[0].strip() != "PULSE_PROGRAM":
+            raise CompileError("invalid pulse program file (PULSE_PROGRAM not found)")
+
+        # now parse, looking for commands, %'s and #'s
+        for line in lines[1:]:
+            myline = line.split('#')[0].strip()  # remove any trailing comments
+            if len(myline) > 0:
+                try:
+                    self._compileLine(myline)
+                except (IndexError, ValueError, OverflowError) as e:
+                    # eg. a missing argument or a pin number that doesn't fit in a byte
+                    raise CompileError("Error compiling line: " + myline + " (" + str(e) + ")")
+
+        self.prog.append(END_OF_PROGRAM)
+        prog = bytes(self.prog)
+        saved = 0
+        relocations = self.relocations
+        if self.optimize:
+            optimized = peephole(prog)
+            saved = len(prog) - len(optimized)
+            prog = optimized
+            relocations = None  # offsets have moved
+        check1, check2 = checksums(prog)
+        return CompiledProgram(prog, self.totalReadings, check1, check2, dict(self.vars),
+                               hashlib.sha256(text.encode('utf-8')).digest(), saved, relocations)
+
+    def _compileLine(self, myline):
+        prog = self.prog
+        if myline[0] == '%':  # variable defintion
+            fields = myline.split("=")
+            if len(fields) != 2:
+                raise CompileError("Error parsing variable definition: " + myline)
+            variable = fields[0].strip()
+            try:
+                ivalue = int(fields[1].strip())
+            except ValueError:
+                raise CompileError("failed to convert a variable value into an int: " + myline)
+            # values passed in as overrides win over the ones in the file.
+            if variable not in self.overrides:
+                self.vars[variable] = ivalue
+
+        elif myline.startswith("DELAY_IN_CLOCKS"):
+            args = self.getArgs(myline, 1)
+            if args[0] <= 104:
+                args[0] = 105
+            if not self.nullLoop:
+                self._relocate(0, 1, 4, 'clocks')
+                prog.append(DELAY_IN_CLOCKS)
+                prog += (args[0] & 0xffffffff).to_bytes(4, 'little')
+
+        elif myline.startswith("DELAY_IN_MS"):
+            args = self.getArgs(myline, 1)
+            if not self.nullLoop and args[0] > 0:
+                self._relocate(0, 1, 2, 'ms')
+                prog.append(DELAY_IN_MS)
+                prog += bytes([args[0] & 255, args[0] >> 8 & 255])
+            elif not self.nullLoop:
+                self._relocate(0, 0, 0, 'ms')
+
+        elif myline.startswith("CHANGE_PIN"):
+            args = self.getArgs(myline, 2)
+            if not self.nullLoop:
+                self._relocate(0, 1, 1, 'byte')
+                self._relocate(1, 2, 1, 'byte')
+                prog += bytes([CHANGE_PIN, args[0], args[1]])  # pin,value
+
+        elif myline.startswith("TOGGLE_PIN"):
+            args = self.getArgs(myline, 2)
+            if not self.nullLoop:
+                self._relocate(0, 1, 1, 'byte')
+                self._relocate(1, 2, 1, 'byte')
+                prog += bytes([TOGGLE_PIN, args[0], args[1]])  # pin, start value
+
+        elif myline.startswith("WAIT_FOR_PIN"):
+            args = self.getArgs(myline, 2)
+            if not self.nullLoop:
+                self._relocate(0, 1, 1, 'byte')
+                self._relocate(1, 2, 1, 'byte')
+                prog += bytes([WAIT_FOR_PIN, args[0], args[1]])  # pin, code for waiting
+
+        elif myline.startswith("PULSE"):
+            if not self.freqSet or not self.pinsSet:
+                raise CompileError("PULSE requested, but freqSet or pinsSet is False")
+            if myline.split()[1][0] == 'T':  # phase table style
+                tnum = self._tableNumber(myline)
+                # now get the number of half cycles in the pulse
+                args = self.getArgs(myline[5:].strip(), 1)
+                if not self.nullLoop:
+                    self._relocate(0, 2, 2, 'word')
+                    prog += bytes([PULSE, 255 - tnum, args[0] & 255, args[0] >> 8 & 255])
+            else:
+                # args are start phase, phase increment,
+                # steps between phase increment and number of half periods
+                args = self.getArgs(myline, 4)
+                if args[2] == 0:
+                    args[2] = 1
+                if not self.nullLoop:
+                    for index, kind in enumerate(('phase', 'phase', 'mod')):
+                        self._relocate(index, index + 1, 1, kind)
+                    self._relocate(3, 4, 2, 'word')
+                    prog += bytes([PULSE, (args[0] % 360) // 2, (args[1] % 360) // 2, args[2] & 255,
+                                   args[3] & 255, args[3] >> 8 & 255])
+
+        elif myline.startswith("READ_DATA"):
+            if myline.split()[1][0] == 'T':  # phase table style
+                tnum = self._tableNumber(myline)
+                if not self.freqSet:
+                    raise CompileError('READ_DATA requested phase cycling with phase table, but frequency not set')
+                # now get the number of points
+                args = self.getArgs(myline[9:].strip(), 1)
+                if not self.nullLoop:
+                    self.totalReadings += args[0] * (loopPasses(self.loopNum) if self.loopStarted else 1)
+                    self._relocate(0, 2, 4, 'points')
+                    prog += bytes([READ_DATA, 255 - tnum])  # always more than 180
+                    prog += (args[0] & 0xffffffff).to_bytes(4, 'little')
+            else:  # initial, increment, modulo style
+                args = self.getArgs(myline, 4)
+                if args[1] > 0 and not self.freqSet:
+                    raise CompileError('READ_DATA requested phase cycling with increment ' + str(args[1]) +
+                                       ', but frequency not set')
+                if args[2] == 0:
+                    args[2] = 1
+                if not self.nullLoop:
+                    self.totalReadings += args[3] * (loopPasses(self.loopNum) if self.loopStarted else 1)
+                    for index, kind in enumerate(('phase', 'phase', 'mod')):
+                        self._relocate(index, index + 1, 1, kind)
+                    self._relocate(3, 4, 4, 'points')
+                    prog += bytes([READ_DATA, (args[0] % 360) // 2,  # always less than 180
+                                   (args[1] % 360) // 2, args[2] & 255])
+                    prog += (args[3] & 0xffffffff).to_bytes(4, 'little')
+
+        elif myline.startswith("SET_FREQ"):
+            args = self.getArgs(myline, 1)
+            if args[0] <= 0:
+                raise ValueError("frequency must be positive")
+            hperiod = int(8000000 / args[0])
+            delc1 = int(0.3591 / 3.14159 * hperiod)
+            #                delc1 = int (hperiod/6) # for minimum 3rd harmonic
+            delc2 = int(hperiod - 2 * delc1)
+            if not self.nullLoop:
+                self._relocate(0, 1, 6, 'freq')
+                prog.append(SET_FREQ)
+                prog += bytes([delc1 & 255, delc1 >> 8 & 255, delc2 & 255, delc2 >> 8 & 255,
+                               hperiod & 255, hperiod >> 8 & 255])
+                self.freqSet = True
+
+        elif myline.startswith('SET_PULSE_PINS'):
+            args = self.getArgs(myline, 2)
+            if not self.nullLoop:
+                self._relocate(0, 1, 1, 'byte')
+                self._relocate(1, 2, 1, 'byte')
+                prog += bytes([SET_PULSE_PINS, args[0], args[1]])
+                self.pinsSet = True
+
+        elif myline.startswith('LOOP'):
+            if self.loopStarted:
+                raise CompileError("can't nest loops")
+            args = self.getArgs(myline, 1)
+            self.loopStarted = True
+            if args[0] == 0:
+                self.nullLoop = True
+                self._relocate(0, 0, 0, 'loop')
+            else:
+                self.loopNum = args[0]
+                self._relocate(0, 1, 2, 'loop')
+                prog += bytes([LOOP, args[0] & 255, args[0] >> 8 & 255])
+
+        elif myline.startswith('END_LOOP'):
+            if not self.loopStarted:
+                raise CompileError("END_LOOP found without a LOOP start")
+            self.loopStarted = False
+            self.nullLoop = False
+            prog.append(END_LOOP)
+
+        elif myline.startswith('SYNC'):
+            if not self.nullLoop:
+                prog.append(SYNC)
+
+        elif myline.startswith('TABLE'):
+            # define a phase table syntax: TABLE T0 {0,90,90,180,180,0}
+            # check that the line specifies a table number T0 - T15
+            if myline.split()[1][0] != 'T':
+                raise CompileError("Table number not Tn: " + myline)
+            tnum = self._tableNumber(myline, needDefined=False)
+            if len(myline.split('}')) != 2 or len(myline.split('{')) != 2:
+                raise CompileError("syntax error in table definition: " + myline)
+            phase_list = myline.split('{')[1].split('}')[0].split(',')
+            try:
+                phases = [(int(phval) % 360) // 2 for phval in phase_list]
+            except ValueError:
+                raise CompileError("Failed to convert phase value in table to int: " + myline)
+            # first byte is TABLE, then 255-tnum, then length of table, then the table itself, each
+            # phase is one byte: degrees/2 (0-179 -> 0-358deg)
+            prog += bytes([TABLE, 255 - tnum, len(phases)])
+            prog += bytes(phases)
+            self.tables_defined[tnum] = 1  # flag that the table has been defined.
+
+        else:
+            raise CompileError("got an unknown line: " + myline)
+
+
+def compile_source(text, overrides=None, optimize=False):
+    # compile pulse program source text entirely in memory.
+    # overrides maps variable names (with or without the %) to values that
+    # replace the definitions in the text. optimize runs peephole() on the
+    # result. Raises CompileError.
+    return Compiler(overrides, optimize).compile(text)
+
+
+def _encode(opcode, args):
+    # inverse of decode() for one instruction
+    if opcode == DELAY_IN_CLOCKS:
+        return bytes([opcode]) + args[0].to_bytes(4, 'little')
+    if opcode == DELAY_IN_MS or opcode == LOOP:
+        return bytes([opcode]) + args[0].to_bytes(2, 'little')
+    if opcode == PULSE or opcode == READ_DATA:
+        return bytes([opcode]) + bytes(args[:-1]) + args[-1].to_bytes(2 if opcode == PULSE else 4, 'little')
+    if opcode == SET_FREQ:
+        return bytes([opcode]) + b''.join(arg.to_bytes(2, 'little') for arg in args)
+    if opcode == TABLE:
+        return bytes([opcode, args[0], len(args[1])]) + args[1]
+    return bytes([opcode]) + bytes(args)
+
+
+def _dropPinWrites(instructions):
+    # drops CHANGE_PINs that set a pin to the level an earlier CHANGE_PIN
+    # already gave it. Only CHANGE_PIN makes a pin's level known (it also
+    # makes it an output); TOGGLE_PIN depends on the scan number, WAIT_FOR_PIN
+    # makes the pin an input and PULSE drives the pulse pins, so those forget it.
+    known = {}
+    pulsePins = [2, 3]
+    result = []
+    for i, (opcode, args) in enumerate(instructions):
+        if opcode == CHANGE_PIN:
+            if known.get(args[0]) == args[1] & 1:
+                continue
+            known[args[0]] = args[1] & 1
+        elif opcode == TOGGLE_PIN or opcode == WAIT_FOR_PIN:
+            known.pop(args[0], None)
+        elif opcode == SET_PULSE_PINS:
+            pulsePins = list(args)
+        elif opcode == PULSE:
+            for pin in pulsePins:
+                known.pop(pin, None)
+        elif opcode == LOOP:
+            # the body is also entered from its own end: forget whatever it changes.
+            # Leaving the loop, the state is that at the end of the (last pass of the) body.
+            for bodyOpcode, bodyArgs in instructions[i + 1:]:
+                if bodyOpcode in (END_LOOP, END_OF_PROGRAM):
+                    break
+                if bodyOpcode in (CHANGE_PIN, TOGGLE_PIN, WAIT_FOR_PIN):
+                    known.pop(bodyArgs[0], None)
+                elif bodyOpcode in (PULSE, SET_PULSE_PINS):
+                    known.clear()
+        result.append((opcode, args))
+    return result
+
+
+def _foldLoops(instructions):
+    # END_LOOP without a LOOP (left by LOOP 0) does nothing, a LOOP 1 or a loop
+    # with an empty body is just its body
+    result = []
+    loopStart = None  # index in result of the current LOOP
+    for opcode, args in instructions:
+        if opcode == LOOP:
+            loopStart = len(result)
+        elif opcode == END_LOOP:
+            if loopStart is None:
+                continue
+            if loopPasses(result[loopStart][1][0]) == 1 or loopStart == len(result) - 1:
+                del result[loopStart]
+                loopStart = None
+                continue
+            loopStart = None
+        result.append((opcode, args))
+    return result
+
+
+def _mergeDelays(instructions):
+    # adjacent delays of the same kind become one, as long as the sum fits
+    result = []
+    limits = {DELAY_IN_MS: MAX_DELAY_MS, DELAY_IN_CLOCKS: 0xffffffff}
+    for opcode, args in instructions:
+        if opcode in limits and result and result[-1][0] == opcode \
+                and result[-1][1][0] + args[0] <= limits[opcode]:
+            result[-1] = (opcode, (result[-1][1][0] + args[0],))
+            continue
+        result.append((opcode, args))
+    return result
+
+
+def peephole(prog):
+    # optimizes compiled bytecode without changing its timing on the arduino:
+    # merges adjacent delays, drops CHANGE_PINs that change nothing and folds
+    # loops that run once or are empty. Returns the new bytecode.
+    instructions = [(opcode, args) for offset, opcode, args in decode(prog)]
+    while True:
+        size = len(instructions)
+        instructions = _mergeDelays(_foldLoops(_dropPinWrites(instructions)))
+        if len(instructions) == size:
+            break
+    return b''.join(_encode(opcode, args) for opcode, args in instructions)
+
+
+def writeProgram(program, fileName, textFormat=False):
+    data = program.toText().encode('ascii') if textFormat else program.toBinary()
+    with open(fileName, 'wb') as outFile:
+        outFile.write(data)
+    os.chmod(fileName, 0o666)
+
+
+def loadProgram(fileName):
+    # reads a program written by writeProgram, binary or the older text format.
+    # Binary files are memory mapped, the returned program's prog is a
+    # read-only memoryview into the file. Raises ValueError for a damaged file.
+    with open(fileName, 'rb') as inFile:
+        if inFile.read(len(PROG_MAGIC)) != PROG_MAGIC:
+            inFile.seek(0)
+            return _parseTextProgram(inFile.read())
+        mapped = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < PROG_HEADER.size:
+        raise ValueError("truncated program file: " + fileName)
+    (magic, version, flags, length, totalReadings,
+     check1, check2, sourceHash) = PROG_HEADER.unpack_from(mapped)
+    if version != PROG_VERSION:
+        raise ValueError("unknown program file version " + str(version) + " in " + fileName)
+    if len(mapped) < PROG_HEADER.size + length:
+        raise ValueError("truncated program file: " + fileName)
+    prog = memoryview(mapped)[PROG_HEADER.size:PROG_HEADER.size + length]
+    if sourceHash == bytes(32):
+        sourceHash = None
+    return CompiledProgram(prog, totalReadings, check1, check2, {}, sourceHash)
+
+
+def _parseTextProgram(data):
+    fields = [int(field) for field in data.split()]
+    if len(fields) < 3 or len(fields) != fields[1] + 5 or fields[0] != START_OF_PROGRAM:
+        raise ValueError("malformed text program file")
+    numBytes = fields[1]
+    return CompiledProgram(bytes(fields[3:3 + numBytes]), fields[2],
+                           fields[3 + numBytes], fields[4 + numBytes], {})
+
+
+# file based interface, kept for the GUI and older scripts. Writes the binary
+# format unless textFormat is set, optimize runs peephole() on the program.
+# returns True on success or an error string.
+def compile(inName, outName, textFormat=False, optimize=False):
+    try:
+        with open(inName) as inFile:
+            text = inFile.read()
+    except (IOError, OSError):
+        print("couldn't open input file ", inName)
+        return "couldn't open input file"
+    try:
+        program = compile_source(text, optimize=optimize)
+    except CompileError as e:
+        print(e)
+        return str(e)
+    try:
+        writeProgram(program, outName, textFormat)
+    except (IOError, OSError):
+        print("couldn't open output file ", outName)
+        return "couldn't open output file"
+    if optimize:
+        print('optimizer saved', program.bytes_saved, 'bytes')
+    print('Compilation successful, XRS')
+    return True
+# to write the file, we write:  1byte start, 2 byte number of bytes in program+1
+# then 4 byte of number of points to read
+# and 1 byte END_OF_PROGRAM
+# then finally the two checksums.
+
+# usage:
+# compile('/tmp/Anmr/anmr-prog.txt','/tmp/Anmr/anmr-prog/bin')
@@ -0,0 +1,146 @@
+####################
+#
+# Digital downconversion of ADC data.
+#
+# The FID is sampled every TIME_STEP (about 9.6 kHz) around %frequency
+# (about 2 kHz) while the line is only a few hundred Hz wide. Downconverter
+# mixes the samples down by the programmed frequency, low-pass filters them
+# and keeps every decimation-th value, giving a complex baseband signal with
+# 4 to 16 times fewer samples. It keeps the mixer phase and the filter
+# history between calls, so the chunks of a DAT block can be fed in as they
+# come off the serial port; flush() returns the rest at the end of the block
+# and starts the next one.
+#
+#   ddc = anmr_ddc.Downconverter(frequency, decimation=8)
+#   baseband = [ddc.process(chunk) for chunk in chunks] + [ddc.flush()]
+#
+# Baseband sample m belongs to the time of input sample m * decimation: the
+# filter is centred on it, so there is no filter delay (and no first order
+# phase from it) in the result.
+#
+##################
+
+import numpy
+import scipy.signal
+from numpy.lib.stride_tricks import sliding_window_view
+
+import anmr_common
+
+
+class Downconverter:
+    #   frequency   Hz mixed down to 0, the program's %frequency
+    #   decimation  input samples per output sample
+    #   numTaps     FIR length, default 8 per decimation step plus one; made
+    #               odd so the filter has a centre tap
+    #   cutoff      Hz of the low-pass, default 80% of the output Nyquist
+    #               frequency so little aliases back into the band
+    def __init__(self, frequency, decimation=8, numTaps=None, cutoff=None, timeStep=anmr_common.TIME_STEP):
+        decimation = int(decimation)
+        if decimation < 1:
+            raise ValueError("decimation must be at least 1")
+        self.frequency = float(frequency)
+        self.decimation = decimation
+        self.timeStep = timeStep
+        if numTaps is None:
+            numTaps = 8 * decimation + 1
+        numTaps |= 1
+        if cutoff is None:
+            cutoff = 0.8 * 0.5 / (timeStep * decimation)
+        # times 2: a real cosine of amplitude A mixes down to A / 2
+        self.taps = 2 * scipy.signal.firwin(numTaps, cutoff, fs=1.0 / timeStep)
+        self.reset()
+
+    @property
+    def outputTimeStep(self):
+        return self.timeStep * self.decimation
+
+    @property
+    def lag(self):
+        # input samples a baseband sample waits for after its own time: half the filter
+        return (len(self.taps) - 1) // 2
+
+    def reset(self):
+        # start of a new block: mixer phase 0, empty filter history
+        self.history = numpy.zeros(len(self.taps) - 1, dtype=complex)
+        self.count = 0  # input samples since reset
+        self.points = 0  # input samples of the block, without flush's padding
+
+    def outputPoints(self, points):
+        # baseband samples a block of points input samples gives
+        return -(-points // self.decimation)
+
+    def process(self, chunk):
+        # complex baseband samples for the next chunk of the block
+        chunk = numpy.asarray(chunk, dtype=float)
+        self.points += len(chunk)
+        return self._filter(chunk)
+
+    def flush(self):
+        # the baseband samples still waiting for input after the end of the
+        # block, then reset() for the next block
+        out = self._filter(numpy.zeros(self.lag))
+        self.reset()
+        return out
+
+    def _filter(self, chunk):
+        if len(chunk) == 0:
+            # a read that brought nothing, there is no new window either
+            return numpy.zeros(0, dtype=complex)
+        n = self.count + numpy.arange(len(chunk))
+        mixed = chunk * numpy.exp(-2j * numpy.pi * self.frequency * self.timeStep * n)
+        buffer = numpy.concatenate((self.history, mixed))
+        # window i of the buffer ends at input count + i and is centred on
+        # input count + i - lag. Output m is the window centred on
+        # m * decimation; only those windows are computed, which costs the
+        # same as the polyphase form: len(taps) / decimation multiplications
+        # per input sample
+        first = self.lag - self.count
+        if first < 0:
+            first %= self.decimation
+        last = self.points + self.lag - self.count  # centres beyond the block are padding
+        windows = sliding_window_view(buffer, len(self.taps))[first:max(first, last):self.decimation]
+        out = windows @ self.taps[::-1]
+        self.history = buffer[len(buffer) - len(self.history):]
+        self.count += len(chunk)
+        return out
+
+
+class Baseband:
+    #   samples      complex baseband of all blocks one after the other
+    #   blockPoints  baseband samples in each block
+    #   frequency    Hz the data was mixed down by, bin 0 of the baseband
+    #   timeStep     s between baseband samples
+    def __init__(self, samples, blockPoints, frequency, timeStep, decimation):
+        self.samples = numpy.asarray(samples)
+        self.blockPoints = [int(points) for points in blockPoints]
+        self.frequency = float(frequency)
+        self.timeStep = timeStep
+        self.decimation = int(decimation)
+
+    def save(self, fileName):
+        # complex64 is plenty for 10 bit ADC values and halves the file
+        numpy.savez(fileName, samples=self.samples.astype(numpy.complex64), blockPoints=self.blockPoints,
+                    frequency=self.frequency, timeStep=self.timeStep, decimation=self.decimation)
+
+
+def load(fileName):
+    with numpy.load(fileName) as saved:
+        return Baseband(saved['samples'], saved['blockPoints'], float(saved['frequency']),
+                        float(saved['timeStep']), int(saved['decimation']))
+
+
+def downconvert(samples, blockPoints, downconverter):
+    # Baseband of samples made of DAT blocks of blockPoints points each, every
+    # block on its own (the data is not continuous between blocks)
+    blockPoints = [int(points) for points in blockPoints]
+    if sum(blockPoints) != len(samples):
+        raise ValueError(str(len(samples)) + " samples for DAT blocks of " + str(sum(blockPoints)) + " points")
+    parts = []
+    start = 0
+    for points in blockPoints:
+        downconverter.reset()
+        parts.append(numpy.concatenate((downconverter.process(samples[start:start + points]), downconverter.flush())))
+        start += points
+    out = numpy.concatenate(parts) if parts else numpy.zeros(0, dtype=complex)
+    return Baseband(out, [len(part) for part in parts], downconverter.frequency,
+                    downconverter.outputTimeStep, downconverter.decimation)
@@ -0,0 +1,131 @@
+####################
+#
+# Multi-echo data as a matrix.
+#
+# A program with READ_DATA inside a LOOP (a CPMG train like
+# CommandFullEchoKorrekt.txt) sends one DAT block per echo. EchoMatrix keeps
+# those blocks as the rows of one array, with the echo times the analyzer
+# works out from the bytecode, and runs its FFTs, peak search and echo
+# summation over all rows at once instead of treating the scan as one trace.
+#
+#   echoes = anmr_echoes.fromScan(samples, blockPoints, analysis)
+#   amplitudes, positions = echoes.peaks()      # one per echo, at echoes.times
+#
+##################
+
+import numpy
+
+import anmr_common
+import anmr_spectrum
+
+
+class EchoMatrix:
+    #   echoes    float array, one row per DAT block. Shorter blocks are padded
+    #             with 0 at the end, see lengths
+    #   times     s from the middle of the excitation pulse to the middle of
+    #             each block, None if unknown
+    #   lengths   points in each block
+    def __init__(self, echoes, times=None, lengths=None, timeStep=anmr_common.TIME_STEP):
+        self.echoes = numpy.asarray(echoes, dtype=float)
+        if self.echoes.ndim != 2:
+            raise ValueError("echoes must be a 2D array")
+        self.times = None if times is None else numpy.asarray(times, dtype=float)
+        if lengths is None:
+            lengths = [self.echoes.shape[1]] * len(self.echoes)
+        self.lengths = numpy.asarray(lengths, dtype=numpy.int64)
+        self.timeStep = timeStep
+
+    def __len__(self):
+        return len(self.echoes)
+
+    @property
+    def points(self):
+        return self.echoes.shape[1]
+
+    def _valid(self):
+        # True for the points that were measured, False for the padding
+        return numpy.arange(self.points) < self.lengths[:, None]
+
+    def _centred(self):
+        # every row less its own mean (the ADC offset), padding left at 0
+        valid = self._valid()
+        means = numpy.where(valid, self.echoes, 0).sum(axis=1) / numpy.maximum(self.lengths, 1)
+        return numpy.where(valid, self.echoes - means[:, None], 0)
+
+    def frequencies(self):
+        return anmr_spectrum.frequencies(anmr_spectrum.fftLength(self.points), self.timeStep)
+
+    def spectra(self, window='none', broadening=0.0):
+        # complex spectrum of every echo, one row each, all in one FFT.
+        # window and broadening as for anmr_spectrum.spectrum
+        return anmr_spectrum.spectrum(self._centred(), window, broadening, offset=0, timeStep=self.timeStep)[1]
+
+    def envelopes(self):
+        # magnitude of the analytic signal of every echo
+        n = self.points
+        weights = numpy.zeros(n)
+        weights[0] = 1
+        weights[1:(n + 1) // 2] = 2
+        if n % 2 == 0:
+            weights[n // 2] = 1
+        return numpy.abs(numpy.fft.ifft(numpy.fft.fft(self._centred(), axis=1) * weights, axis=1))
+
+    def peaks(self):
+        # (amplitude, time in s from the start of its block) of the top of every echo
+        envelopes = self.envelopes()
+        positions = envelopes.argmax(axis=1)
+        return envelopes[numpy.arange(len(self)), positions], positions * self.timeStep
+
+    def spectralPeaks(self, frequency=None, band=50.0):
+        # (magnitude, frequency) of the largest spectral line of every echo,
+        # within band Hz of frequency if one is given
+        magnitudes = numpy.abs(self.spectra())
+        freqs = self.frequencies()
+        if frequency is not None:
+            magnitudes = numpy.where(numpy.abs(freqs - frequency) <= band, magnitudes, 0)
+        bins = magnitudes.argmax(axis=1)
+        return magnitudes[numpy.arange(len(self)), bins], freqs[bins]
+
+    def summed(self):
+        # all echoes added up point by point
+        return self.echoes.sum(axis=0)
+
+    def summedSpectrum(self, window='none', broadening=0.0):
+        # magnitude of the sum of the echoes' spectra
+        return numpy.abs(self.spectra(window, broadening).sum(axis=0))
+
+    def save(self, fileName):
+        arrays = {'echoes': self.echoes, 'lengths': self.lengths, 'timeStep': self.timeStep}
+        if self.times is not None:
+            arrays['times'] = self.times
+        numpy.savez(fileName, **arrays)
+
+
+def load(fileName):
+    with numpy.load(fileName) as saved:
+        times = saved['times'] if 'times' in saved.files else None
+        return EchoMatrix(saved['echoes'], times, saved['lengths'], float(saved['timeStep']))
+
+
+def fromScan(samples, blockPoints, analysis=None):
+    # splits the samples of one scan (or a mean) into its DAT blocks.
+    # blockPoints are the points of each block as received, analysis
+    # (anmr_analyzer.ProgramAnalysis) gives the echo times if its blocks match.
+    samples = numpy.asarray(samples)
+    blockPoints = [int(points) for points in blockPoints]
+    if sum(blockPoints) != len(samples):
+        raise ValueError(str(len(samples)) + " samples for DAT blocks of " + str(sum(blockPoints)) + " points")
+    times = None
+    if analysis is not None and [block[2] for block in analysis.blocks] == blockPoints:
+        times = analysis.echoTimes()
+    if not blockPoints:
+        return EchoMatrix(numpy.zeros((0, 0)), times, [])
+    if len(set(blockPoints)) == 1:
+        # the usual case: all echoes the same length, just a different view
+        echoes = samples.reshape(len(blockPoints), blockPoints[0])
+    else:
+        echoes = numpy.zeros((len(blockPoints), max(blockPoints)))
+        starts = numpy.cumsum([0] + blockPoints[:-1])
+        for row, (start, points) in enumerate(zip(starts, blockPoints)):
+            echoes[row, :points] = samples[start:start + points]
+    return EchoMatrix(echoes, times, blockPoints)
@@ -0,0 +1,407 @@
+####################
+#
+# Emulator of the arduino server (arduinoCode.ino) on a pseudo-terminal.
+#
+# BytecodeVM executes a downloaded program the same way the firmware's GO
+# case does, against a virtual 16 MHz clock, and produces the bytes the
+# firmware would send (DAT blocks with synthetic FID samples, EOP).
+# ArduinoEmulator serves QUERY, QUERY_PROGRAM, START_OF_PROGRAM and GO on a
+# pty, so anmr_common, anmr_session and the GUI can talk to it exactly as
+# they talk to the board:
+#
+#   emu = ArduinoEmulator(timeScale=0.0)
+#   port = emu.start()          # eg. /dev/pts/3
+#   ...  serial.Serial(port, 1000000) ...
+#   emu.stop()
+#
+# Linux only (needs os.openpty).
+#
+##################
+
+import math
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+import numpy
+
+import anmr_common
+import anmr_compiler
+from anmr_analyzer import CLOCK, CYCLES_PER_POINT, HEAP_BYTES, delayMsCycles
+from anmr_compiler import (END_OF_PROGRAM, START_OF_PROGRAM, DELAY_IN_CLOCKS, DELAY_IN_MS, CHANGE_PIN,
+                           WAIT_FOR_PIN, SET_PULSE_PINS, PULSE, READ_DATA, GO, SET_FREQ, LOOP, END_LOOP,
+                           SYNC, QUERY, TOGGLE_PIN, TABLE, QUERY_PROGRAM)
+
+SLOP2 = 200  # cycles of advance the firmware allows for when lining up READ_DATA
+
+
+def _int16(value):
+    # an int on the arduino
+    value &= 0xffff
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def firmwareChecksums(prog):
+    # the checksums the firmware prints after a download, worked out step by
+    # step as arduinoCode.ino does rather than taken from anmr_compiler, so a
+    # host that gets them wrong fails against the emulator as on the board:
+    #   checksum1 += (i+1)*head[i];   int * byte is an int, 16 bits
+    checksum1 = checksum2 = 0
+    for i in range(len(prog)):
+        checksum1 = (checksum1 + _int16((i + 1) * prog[i])) & 0xffffffff
+        checksum2 = (checksum2 + _int16((i + 2) * prog[i])) & 0xffffffff
+    return checksum1, checksum2
+
+
+class BytecodeVM:
+    # Runs one scan of a program. Physics of the synthetic signal:
+    #   amplitude   peak FID amplitude in ADC counts for full polarization
+    #   t1          build-up time (s) of the polarization while polarizePin is high
+    #   t2          decay (s) between the excitation and each READ_DATA
+    #   t2star      decay (s) within one READ_DATA block
+    #   offsetHz    Larmor frequency minus the SET_FREQ frequency
+    #   noise       rms noise in ADC counts
+    # The signal takes the phase of the first pulse, every later pulse refocuses it.
+    def __init__(self, prog, scanNum=0, amplitude=200.0, t1=2.0, t2=1.0, t2star=0.1, offsetHz=3.0,
+                 noise=5.0, polarizePin=12, rng=None):
+        self.prog = bytes(prog)
+        self.scanNum = scanNum
+        self.amplitude = amplitude
+        self.t1 = t1
+        self.t2 = t2
+        self.t2star = t2star
+        self.offsetHz = offsetHz
+        self.noise = noise
+        self.polarizePin = polarizePin
+        self.rng = rng if rng is not None else numpy.random.default_rng()
+
+        self.clock = 0  # virtual time in cycles since GO
+        self.pins = {}
+        self.events = []  # (clock, kind, value), for checking timing
+        self.delc1 = self.delc2 = self.hperiod = self.fperiod = 0
+        self.freqStart = 0  # clock when timer 1 was last restarted by SET_FREQ
+        self.ppin = 2
+        self.mpin = 3
+        self.tables = {}
+        self.polStart = None
+        self.polTime = None  # how long the polarizing pin was on, s
+        self.excitation = None  # clock of the first pulse after polarizing
+        self.pulsePhase = 0
+
+    def _val(self, ptr, n):
+        return int.from_bytes(self.prog[ptr:ptr + n], 'little')
+
+    def _timer1(self):
+        if self.fperiod == 0:
+            return 0
+        return (self.clock - self.freqStart) % self.fperiod
+
+    def _phase(self, ptr, phase):
+        # decodes start phase/increment/modulo or a table reference, as the firmware does.
+        # returns phase in degrees and the new ptr
+        if phase < 180:
+            phase *= 2
+            phaseInc = self.prog[ptr] * 2
+            phaseMod = self.prog[ptr + 1]
+            phase = (phase + phaseInc * (self.scanNum // phaseMod)) % 360
+            return phase, ptr + 2
+        table = self.tables[phase]
+        return table[self.scanNum % len(table)] * 2, ptr
+
+    def _setPin(self, pin, value):
+        if self.pins.get(pin, 0) != value:
+            self.events.append((self.clock, 'pin', (pin, value)))
+            if pin == self.polarizePin:
+                if value:
+                    self.polStart = self.clock
+                elif self.polStart is not None:
+                    self.polTime = (self.clock - self.polStart) / CLOCK
+        self.pins[pin] = value
+
+    def run(self, send):
+        # executes the program, calling send(bytes) with everything the arduino would
+        # write after "Executing instructions". Returns the number of cycles it took.
+        prog = self.prog
+        ptr = 0
+        loopPtr = 0
+        loopCounter = 0
+        while ptr < len(prog):
+            op = prog[ptr]
+            ptr += 1
+            if op == DELAY_IN_CLOCKS:
+                self.clock += self._val(ptr, 4)
+                ptr += 4
+            elif op == DELAY_IN_MS:
+                self.clock += delayMsCycles(self._val(ptr, 2))  # signed, as in the firmware
+                ptr += 2
+            elif op == TOGGLE_PIN:
+                self._setPin(prog[ptr], (prog[ptr + 1] + (self.scanNum & 1)) & 1)
+                ptr += 2
+            elif op == CHANGE_PIN:
+                self._setPin(prog[ptr], prog[ptr + 1] & 1)
+                ptr += 2
+            elif op == WAIT_FOR_PIN:
+                # nothing drives the inputs here, take the edge as immediate
+                self.events.append((self.clock, 'wait', prog[ptr]))
+                ptr += 2
+            elif op == PULSE:
+                phase, ptr = self._phase(ptr + 1, prog[ptr])
+                halfPeriods = self._val(ptr, 2)
+                ptr += 2
+                self._pulse(phase, halfPeriods)
+            elif op == READ_DATA:
+                phase, ptr = self._phase(ptr + 1, prog[ptr])
+                points = self._val(ptr, 4)
+                ptr += 4
+                self._readData(phase, points, send)
+            elif op == END_OF_PROGRAM:
+                send(b'EOP\r\n')
+                return self.clock
+            elif op == SET_FREQ:
+                self.delc1 = self._val(ptr, 2)
+                self.delc2 = self._val(ptr + 2, 2)
+                self.hperiod = self._val(ptr + 4, 2)
+                self.fperiod = 2 * self.hperiod
+                self.freqStart = self.clock
+                ptr += 6
+            elif op == SET_PULSE_PINS:
+                self.ppin = prog[ptr]
+                self.mpin = prog[ptr + 1]
+                ptr += 2
+            elif op == LOOP:
+                loopCounter = _int16(self._val(ptr, 2))  # int loopCounter
+                ptr += 2
+                loopPtr = ptr
+            elif op == END_LOOP:
+                loopCounter = _int16(loopCounter - 1)
+                if loopCounter > 0:
+                    ptr = loopPtr
+            elif op == SYNC:
+                if self.fperiod:
+                    self.clock += (self.fperiod - self._timer1()) % self.fperiod
+            elif op == TABLE:
+                tlen = prog[ptr + 1]
+                self.tables[prog[ptr]] = prog[ptr + 2:ptr + 2 + tlen]
+                ptr += 2 + tlen
+            else:
+                break  # not an instruction byte, the firmware just stops
+        return self.clock
+
+    def _pulse(self, phase, halfPeriods):
+        if self.hperiod:
+            # wait for the start of the half period the phase asks for
+            start = (self.delc1 + phase * self.hperiod // 180) % self.fperiod
+            self.clock += (start - self._timer1()) % self.fperiod
+        self.events.append((self.clock, 'pulse', (phase, halfPeriods)))
+        if self.excitation is None:
+            self.excitation = self.clock
+            self.pulsePhase = phase
+        else:  # taken as a refocusing pulse
+            self.pulsePhase = (2 * phase - self.pulsePhase) % 360
+        self.clock += halfPeriods * self.hperiod
+
+    def _readData(self, phase, points, send):
+        send(b'DAT\r\n' + struct.pack('<I', points))
+        # phase alignment and sign as in the firmware's READ_DATA case
+        extra = phase // 180
+        if self.hperiod:
+            ontime = (phase - 180 * extra) * self.hperiod // 180
+            diff = self._timer1() + SLOP2
+            diff = diff - self.hperiod * (diff >= self.fperiod)
+            if ontime <= diff < ontime + self.hperiod:
+                ontime += self.hperiod
+                extra += 1
+            mult = 1 if (extra & 1) == 0 else -1
+            self.clock += (ontime - self._timer1()) % self.fperiod
+        else:
+            mult = extra * 2 - 1
+        self.events.append((self.clock, 'read', (phase, points)))
+        start = self.clock
+        self.clock += points * CYCLES_PER_POINT
+        send(self.samples(start, points, mult))
+
+    def samples(self, start, points, mult=1):
+        # int16 little endian samples as sent by the firmware: (adc - 512) * mult
+        t = (start + numpy.arange(points) * CYCLES_PER_POINT) / CLOCK
+        amplitude = self.amplitude
+        if self.polTime is not None and self.t1 > 0:
+            amplitude *= 1.0 - math.exp(-self.polTime / self.t1)
+        if self.excitation is not None:
+            amplitude *= math.exp(-(start - self.excitation) / CLOCK / self.t2)
+        freq = (CLOCK / 2.0 / self.hperiod if self.hperiod else 0.0) + self.offsetHz
+        signal = amplitude * numpy.exp(-(t - start / CLOCK) / self.t2star) * \
+            numpy.cos(2 * math.pi * freq * (t - self.freqStart / CLOCK) + math.radians(self.pulsePhase))
+        adc = numpy.clip(numpy.rint(512 + signal + self.rng.normal(0, self.noise, points)), 0, 1023)
+        return ((adc.astype(numpy.int32) - 512) * mult).astype('<i2').tobytes()
+
+
+class ArduinoEmulator:
+    # timeScale: wall seconds per virtual second. 1.0 runs in real time (104 us
+    # per point, delays really wait), 0.0 runs as fast as possible.
+    # The remaining keyword arguments go to BytecodeVM.
+    def __init__(self, timeScale=1.0, seed=None, heapBytes=HEAP_BYTES, **physics):
+        self.timeScale = timeScale
+        self.heapBytes = heapBytes
+        self.physics = physics
+        self.rng = numpy.random.default_rng(seed)
+        self.port = None
+        self.head = None
+        self.checksum1 = 0
+        self.checksum2 = 0
+        self.totalNumReadings = 0
+        self.scanNum = 0
+        self.lastVM = None  # the VM of the last GO, for inspecting events
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='anmr-emulator', daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(1.0)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _send(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = os.write(self._master, view)
+            view = view[n:]
+
+    def _println(self, text):
+        self._send(str(text).encode('ascii') + b'\r\n')
+
+    def _read(self, n, timeout):
+        # like fRead: returns the bytes, or None on a timeout
+        data = bytearray()
+        deadline = time.time() + timeout
+        while len(data) < n:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self._running:
+                return None
+            ready, _, _ = select.select([self._master], [], [], remaining)
+            if ready:
+                data += os.read(self._master, n - len(data))
+        return bytes(data)
+
+    def _serve(self):
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                command = os.read(self._master, 1)
+            except OSError:
+                return
+            if command:
+                self._command(command[0])
+
+    def _command(self, command):
+        if command == QUERY:
+            self._println('ANMR v0.9, Ready')
+        elif command == QUERY_PROGRAM:
+            if self.head is not None:
+                self._println(self.checksum1)
+                self._println(self.checksum2)
+            else:
+                self._println(0)
+                self._println(0)
+            self._println(self.scanNum)
+        elif command == START_OF_PROGRAM:
+            self._download()
+        elif command == GO:
+            self._go()
+        else:
+            self._println('Unknown Instruction!')
+
+    def _download(self):
+        self.scanNum = 0
+        self.checksum1 = self.checksum2 = 0
+        self.head = None
+        header = self._read(2, 1.0)
+        if header is None:
+            self._println('Timed out reading number of bytes')
+            return
+        numBytes = struct.unpack('<H', header)[0]
+        readings = self._read(4, 1.0)
+        if readings is None:
+            self._println('Timed out reading number of readings')
+            return
+        self.totalNumReadings = struct.unpack('<I', readings)[0]
+        if numBytes > self.heapBytes:
+            self._println('Malloc failed!')
+            return
+        self._println('Malloc successful')
+        prog = self._read(numBytes, 1.0)
+        if prog is None:
+            self._println('Timed out reading program')
+            return
+        self.head = prog
+        self.checksum1, self.checksum2 = firmwareChecksums(prog)
+        self._println(self.checksum1)
+        self._println(self.checksum2)
+
+    def _go(self):
+        if self.head is None:
+            self._println('Execution failed')
+            return
+        self._println('Executing instructions')
+        vm = BytecodeVM(self.head, self.scanNum, rng=self.rng, **self.physics)
+        self.lastVM = vm
+        started = time.time()
+
+        def send(data):
+            # hold output back until the virtual clock has caught up with the wall clock
+            if self.timeScale > 0:
+                wait = started + vm.clock / CLOCK * self.timeScale - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            self._send(data)
+
+        vm.run(send)
+        self.scanNum += 1
+
+
+def _benchmark():
+    # download and acquisition throughput against the emulator
+    import tempfile
+    import serial
+
+    emu = ArduinoEmulator(timeScale=0.0, seed=1)
+    port = emu.start()
+    ardSer = serial.Serial(port, 1000000)
+    source = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CommandFullEchoKorrekt.txt')).read()
+    program = anmr_compiler.compile_source(source)
+    fileName = os.path.join(tempfile.mkdtemp(), 'bench.bin')
+    anmr_compiler.writeProgram(program, fileName)
+    for chunkSize in (1, anmr_common.DOWNLOAD_CHUNK):
+        start = time.time()
+        for i in range(10):
+            result = anmr_common.downloadProgram(fileName, ardSer, chunkSize)
+        print('download, chunk size', chunkSize, ':', result, (time.time() - start) / 10 * 1000, 'ms')
+    anmr_common.ardSer = ardSer
+    start = time.time()
+    result, data = anmr_common.runProgram(None, None, 0)
+    print('runProgram:', result, data.size, 'points in', time.time() - start, 's')
+    ardSer.close()
+    emu.stop()
+
+
+if __name__ == '__main__':
+    _benchmark()
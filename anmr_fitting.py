@@ -0,0 +1,287 @@
+####################
+#
+# Relaxation fits for many curves at once.
+#
+# fitDecay() fits mono- or bi-exponential decays (T2 from the echo amplitudes
+# of a CPMG train), fitRecovery() the build-up A * (1 - exp(-t / T1)) of the
+# signal with the polarization time. y may hold one curve or one per row, all
+# rows are fitted together: a closed form log-linear fit for the start values,
+# then Levenberg-Marquardt steps for all rows in one go with numpy. Times are
+# fitted as log-rates, so they can't go negative. Missing points are NaN.
+#
+#   result = anmr_fitting.fitDecay(echoes.times, amplitudes)
+#   print(result.value('T2'), '+-', result.error('T2'))
+#
+##################
+
+import numpy
+
+LOG_RATE_LIMIT = 50.0  # a wild LM step mustn't overflow exp(), the fit rejects it anyway
+
+
+class FitResult:
+    #   names       the parameters, in the order of the columns of params
+    #   params      one row of fitted values per curve
+    #   errors      their standard errors, from the covariance scaled by the residuals
+    #   rss         weighted sum of squared residuals of every curve
+    #   converged   False where maxIter was used up or the fit failed
+    #   iterations  LM iterations done
+    def __init__(self, names, params, errors, rss, converged, iterations):
+        self.names = names
+        self.params = params
+        self.errors = errors
+        self.rss = rss
+        self.converged = converged
+        self.iterations = iterations
+
+    def __len__(self):
+        return len(self.params)
+
+    def value(self, name):
+        return self.params[:, self.names.index(name)]
+
+    def error(self, name):
+        return self.errors[:, self.names.index(name)]
+
+    def report(self, row=0):
+        return ', '.join('%s = %.4g +- %.2g' % (name, self.params[row, i], self.errors[row, i])
+                         for i, name in enumerate(self.names))
+
+
+def _prepare(t, y, sigma):
+    # rows of y and t as 2D float arrays, weights 0 where y is missing
+    y = numpy.atleast_2d(numpy.asarray(y, dtype=float))
+    t = numpy.broadcast_to(numpy.asarray(t, dtype=float), y.shape)
+    if sigma is None:
+        weights = numpy.ones(y.shape)
+    else:
+        weights = 1.0 / numpy.broadcast_to(numpy.asarray(sigma, dtype=float), y.shape) ** 2
+    missing = ~numpy.isfinite(y) | ~numpy.isfinite(t)
+    weights = numpy.where(missing, 0.0, weights)
+    return numpy.where(missing, 0.0, t), numpy.where(missing, 0.0, y), weights
+
+
+def _logLinear(t, y, weights):
+    # weighted least squares of log(y) = log(A) - R * t for every row, only
+    # over positive y. Weights y^2 undo the stretching of the log.
+    # Returns (A, R); rows without two usable points get A = max(y), R = 1 / t span.
+    w = numpy.where(y > 0, weights * numpy.maximum(y, 0) ** 2, 0.0)
+    logY = numpy.log(numpy.where(y > 0, y, 1.0))
+    sw = w.sum(axis=1)
+    st = (w * t).sum(axis=1)
+    sy = (w * logY).sum(axis=1)
+    stt = (w * t * t).sum(axis=1)
+    sty = (w * t * logY).sum(axis=1)
+    det = sw * stt - st * st
+    ok = (det > 0) & ((w > 0).sum(axis=1) >= 2)
+    det = numpy.where(ok, det, 1.0)
+    slope = (sw * sty - st * sy) / det
+    intercept = (sy - slope * st) / numpy.where(sw > 0, sw, 1.0)
+    span = numpy.where(weights > 0, t, -numpy.inf).max(axis=1) - numpy.where(weights > 0, t, numpy.inf).min(axis=1)
+    span = numpy.where(numpy.isfinite(span) & (span > 0), span, 1.0)
+    rate = numpy.where(ok & (slope < 0), -slope, 1.0 / span)
+    amplitude = numpy.where(ok, numpy.exp(intercept), numpy.max(numpy.where(weights > 0, y, 0), axis=1))
+    return amplitude, rate
+
+
+def _decayModel(components, offset):
+    # f(t, p) and its jacobian for sum(A_i exp(-R_i t)) (+ C), p = (A_i, log R_i, ..., C)
+    def model(t, p):
+        f = numpy.zeros(t.shape)
+        jac = []
+        for i in range(components):
+            amplitude = p[:, 2 * i, None]
+            rate = numpy.exp(numpy.clip(p[:, 2 * i + 1, None], -LOG_RATE_LIMIT, LOG_RATE_LIMIT))
+            e = numpy.exp(-rate * t)
+            f += amplitude * e
+            jac += [e, -amplitude * t * e * rate]
+        if offset:
+            f += p[:, -1, None]
+            jac.append(numpy.ones(t.shape))
+        return f, numpy.stack(jac, axis=-1)
+    return model
+
+
+def _recoveryModel(offset):
+    # A (1 - exp(-R t)) (+ C), p = (A, log R, C)
+    def model(t, p):
+        amplitude = p[:, 0, None]
+        rate = numpy.exp(numpy.clip(p[:, 1, None], -LOG_RATE_LIMIT, LOG_RATE_LIMIT))
+        e = numpy.exp(-rate * t)
+        f = amplitude * (1 - e)
+        jac = [1 - e, amplitude * t * e * rate]
+        if offset:
+            f += p[:, 2, None]
+            jac.append(numpy.ones(t.shape))
+        return f, numpy.stack(jac, axis=-1)
+    return model
+
+
+def levenbergMarquardt(model, t, y, weights, p0, maxIter=100, tol=1e-10):
+    # batched Levenberg-Marquardt: every row of y is a separate curve with its
+    # own damping, and rows stop being updated once their cost stops falling.
+    # model(t, p) gives the values and the jacobian (rows x points x params).
+    # Returns (p, covariance, rss, converged, iterations).
+    p = numpy.array(p0, dtype=float)
+    rows, nParams = p.shape
+    lam = numpy.full(rows, 1e-3)
+    f, jac = model(t, p)
+    cost = (weights * (y - f) ** 2).sum(axis=1)
+    active = numpy.isfinite(cost)
+    converged = numpy.zeros(rows, dtype=bool)
+    iterations = 0
+    eye = numpy.eye(nParams)
+    while iterations < maxIter and active.any():
+        iterations += 1
+        idx = numpy.flatnonzero(active)
+        ta, ya, wa, pa = t[idx], y[idx], weights[idx], p[idx]
+        f, jac = model(ta, pa)
+        r = ya - f
+        jtw = jac.transpose(0, 2, 1) * wa[:, None, :]
+        jtj = jtw @ jac
+        grad = (jtw @ r[:, :, None])[:, :, 0]
+        diag = numpy.diagonal(jtj, axis1=1, axis2=2)
+        damped = jtj + (lam[idx, None, None] * numpy.maximum(diag, 1e-12)[:, :, None]) * eye
+        try:
+            step = numpy.linalg.solve(damped, grad[:, :, None])[:, :, 0]
+        except numpy.linalg.LinAlgError:
+            step = numpy.stack([numpy.linalg.lstsq(m, g, rcond=None)[0] for m, g in zip(damped, grad)])
+        trial = pa + step
+        fTrial, jTrial = model(ta, trial)
+        trialCost = (wa * (ya - fTrial) ** 2).sum(axis=1)
+        better = numpy.isfinite(trialCost) & (trialCost <= cost[idx])
+        gain = cost[idx] - trialCost
+        p[idx[better]] = trial[better]
+        lam[idx] = numpy.where(better, lam[idx] / 3, lam[idx] * 4)
+        done = better & (gain <= tol * numpy.maximum(cost[idx], 1e-300))
+        done |= better & (numpy.abs(step) <= 1e-10 * (numpy.abs(pa) + 1e-10)).all(axis=1)
+        cost[idx[better]] = trialCost[better]
+        converged[idx[done]] = True
+        stuck = lam[idx] > 1e12  # no step makes it better: at the minimum as far as doubles go
+        converged[idx[stuck]] = True
+        active[idx[done | stuck]] = False
+    f, jac = model(t, p)
+    jtw = jac.transpose(0, 2, 1) * weights[:, None, :]
+    jtj = jtw @ jac
+    dof = numpy.maximum((weights > 0).sum(axis=1) - nParams, 1)
+    covariance = numpy.full(jtj.shape, numpy.nan)
+    invertible = numpy.linalg.matrix_rank(jtj) == nParams
+    if invertible.any():
+        covariance[invertible] = numpy.linalg.inv(jtj[invertible])
+    covariance *= (cost / dof)[:, None, None]
+    return p, covariance, cost, converged & invertible, iterations
+
+
+def _result(names, p, covariance, rss, converged, iterations, rateColumns):
+    # turns the log-rates back into times, with errors by error propagation
+    variances = numpy.diagonal(covariance, axis1=1, axis2=2).copy()
+    params = p.copy()
+    for column in rateColumns:
+        params[:, column] = numpy.exp(-p[:, column])
+        variances[:, column] *= params[:, column] ** 2
+    return FitResult(names, params, numpy.sqrt(variances), rss, converged, iterations)
+
+
+def fitDecay(t, y, components=1, offset=False, sigma=None, maxIter=100):
+    # fits y = A exp(-t / T2) (components=1) or A1 exp(-t / T2_1) + A2 exp(-t / T2_2)
+    # (components=2, T2_1 the shorter), plus a constant C with offset. t has
+    # one entry per point, or a row per curve like y. sigma: uncertainty of y.
+    if components not in (1, 2):
+        raise ValueError("components must be 1 or 2")
+    t, y, weights = _prepare(t, y, sigma)
+    amplitude, rate = _logLinear(t, y, weights)
+    if components == 1:
+        names = ['A', 'T2']
+        p0 = [amplitude, numpy.log(rate)]
+    else:
+        # peel: the slow component from the second half, the fast one from what's left
+        names = ['A1', 'T2_1', 'A2', 'T2_2']
+        used = numpy.maximum((weights > 0).sum(axis=1), 1)
+        middle = numpy.sort(numpy.where(weights > 0, t, numpy.inf), axis=1)[numpy.arange(len(t)), used // 2]
+        late = numpy.where(t >= middle[:, None], weights, 0)
+        slowA, slowR = _logLinear(t, y, late)
+        rest = y - slowA[:, None] * numpy.exp(-slowR[:, None] * t)
+        fastA, fastR = _logLinear(t, rest, numpy.where(late > 0, 0, weights))
+        # fall back to rates a factor of 3 either side of the mono fit
+        bad = ~(fastR > slowR * 1.5) | ~numpy.isfinite(fastA + fastR + slowA + slowR)
+        fastA = numpy.where(bad, amplitude / 2, fastA)
+        slowA = numpy.where(bad, amplitude / 2, slowA)
+        fastR = numpy.where(bad, rate * 3, fastR)
+        slowR = numpy.where(bad, rate / 3, slowR)
+        p0 = [fastA, numpy.log(fastR), slowA, numpy.log(slowR)]
+    if offset:
+        names.append('C')
+        p0.append(numpy.zeros(len(y)))
+    model = _decayModel(components, offset)
+    p0 = numpy.stack(p0, axis=1)
+    p, covariance, rss, converged, iterations = levenbergMarquardt(model, t, y, weights, p0, maxIter)
+    if components == 2 and not converged.all():
+        # a peeled start can let the fast component collapse onto the first
+        # points: try those rows again from either side of the mono fit
+        again = numpy.flatnonzero(~converged)
+        p0 = p0[again]
+        p0[:, 0] = p0[:, 2] = amplitude[again] / 2
+        p0[:, 1] = numpy.log(rate[again] * 3)
+        p0[:, 3] = numpy.log(rate[again] / 3)
+        retry = levenbergMarquardt(model, t[again], y[again], weights[again], p0, maxIter)
+        better = retry[3] | (retry[2] < rss[again])
+        for whole, part in zip((p, covariance, rss, converged), retry[:4]):
+            whole[again[better]] = part[better]
+        iterations = max(iterations, retry[4])
+    if components == 2:
+        # the shorter time first
+        swap = p[:, 1] < p[:, 3]  # larger log-rate first
+        order = numpy.array([2, 3, 0, 1] + ([4] if offset else []))
+        p[swap] = p[swap][:, order]
+        covariance[swap] = covariance[swap][:, order][:, :, order]
+    return _result(names, p, covariance, rss, converged, iterations, [1, 3] if components == 2 else [1])
+
+
+def fitRecovery(t, y, offset=False, sigma=None, maxIter=100):
+    # fits y = A (1 - exp(-t / T1)) (+ C), eg. the signal against the polarization time
+    t, y, weights = _prepare(t, y, sigma)
+    # log-linear on A - y with A a little above the largest value
+    top = numpy.max(numpy.where(weights > 0, y, -numpy.inf), axis=1)
+    top = numpy.where(numpy.isfinite(top), top, 1.0)
+    amplitude = numpy.where(top > 0, top * 1.05, 1.0)
+    gapA, rate = _logLinear(t, amplitude[:, None] - y, weights)
+    names = ['A', 'T1']
+    p0 = [amplitude, numpy.log(rate)]
+    if offset:
+        names.append('C')
+        p0.append(numpy.zeros(len(y)))
+    p, covariance, rss, converged, iterations = levenbergMarquardt(_recoveryModel(offset), t, y, weights,
+                                                                   numpy.stack(p0, axis=1), maxIter)
+    return _result(names, p, covariance, rss, converged, iterations, [1])
+
+
+def sweepAmplitudes(fileName, frequency=None, band=50.0, timeStep=None):
+    # signal amplitude at every point of a sweep saved by anmr_sweep.SweepRunner:
+    # the largest spectral magnitude (within band Hz of frequency if given).
+    # Returns (amplitudes with the sweep's shape, [(variable, values)] per axis).
+    import anmr_common
+    timeStep = anmr_common.TIME_STEP if timeStep is None else timeStep
+    with numpy.load(fileName) as saved:
+        data = saved['data'].astype(float)
+        lengths = saved['lengths']
+        axes = [(str(variable), saved['axis%d' % i]) for i, variable in enumerate(saved['variables'])]
+    valid = numpy.arange(data.shape[-1]) < lengths[..., None]
+    means = numpy.where(valid, data, 0).sum(axis=-1) / numpy.maximum(lengths, 1)
+    spectra = numpy.abs(numpy.fft.rfft(numpy.where(valid, data - means[..., None], 0), axis=-1))
+    if frequency is not None:
+        freqs = numpy.fft.rfftfreq(data.shape[-1], timeStep)
+        spectra = numpy.where(numpy.abs(freqs - frequency) <= band, spectra, 0)
+    return spectra.max(axis=-1), axes
+
+
+def fitSweepRecovery(fileName, variable='%polarization_time', frequency=None, offset=False):
+    # T1 from a sweep over the polarization time (in ms): one recovery fit for
+    # every combination of the other axes. Returns a FitResult with T1 in s and
+    # its rows in the order of the other axes.
+    amplitudes, axes = sweepAmplitudes(fileName, frequency)
+    names = [name for name, values in axes]
+    if variable not in names:
+        raise ValueError("sweep has no axis " + variable)
+    axis = names.index(variable)
+    curves = numpy.moveaxis(amplitudes, axis, -1).reshape(-1, amplitudes.shape[axis])
+    return fitRecovery(axes[axis][1] / 1000.0, curves, offset)
@@ -0,0 +1,290 @@
+####################
+#
+# Run files: every scan of a run, as the arduino sent it.
+#
+# runProgram used to rewrite the summed scans as decimal text after every
+# scan, and ExperimentModel kept its own adc_data.npy. A run file replaces
+# both. It starts with a fixed prefix (RUN_MAGIC, version, data offset) and a
+# JSON header: the checksums and source hash of the compiled program, its
+# %variables, TIME_STEP, the points of every DAT block and the phase cycle.
+# The raw int16 scans follow one after the other from the first page boundary
+# after the header; their number is the size of the file, so
+#
+#   run = anmr_runfile.load('adc_run.anmr')
+#   run.scans[i]    # scan i, a read-only numpy.memmap row
+#   run.mean()
+#
+# opens a run of any size without reading it. RunWriter only ever appends
+# scans and leaves the header alone after create() (but for update()), so a
+# run cut short by a crash reads back with every scan that was complete.
+# The arduino numbers its scans (the number picks the step of a phase cycle)
+# and starts again from 0 after every download. The header keeps firstScanNum
+# and, in scanNumJumps, [scan, number] wherever the numbering doesn't go on by
+# one; append() records them when given the scan's number.
+#
+#   with anmr_runfile.create('adc_run.anmr', points, program) as writer:
+#       writer.append(scan)
+#
+##################
+
+import json
+import os
+import struct
+import time
+
+import numpy
+
+import anmr_averaging
+import anmr_common
+
+RUN_MAGIC = b'ANMR-RUN'
+RUN_VERSION = 1
+RUN_PREFIX = struct.Struct('<8sHHI')  # magic, version, flags, offset of the first scan
+RUN_DTYPE = '<i2'
+PAGE_SIZE = 4096
+# room left in the header for update() to add to it
+HEADER_SLACK = 1024
+# scans summed at a time by Run.averager, bounds the memory it needs
+SUM_ROWS = 256
+
+
+def _jsonValue(value):
+    # numpy scalars and arrays in %variables or phases
+    if isinstance(value, (numpy.generic, numpy.ndarray)):
+        return value.tolist()
+    raise TypeError("can't store " + type(value).__name__ + " in a run header")
+
+
+def programHeader(program):
+    # the header fields describing a CompiledProgram (or None)
+    if program is None:
+        return {'program': None, 'variables': {}, 'phaseCycle': None}
+    try:
+        cycle = anmr_averaging.coAddedCycle(program)
+    except ValueError:
+        cycle = None
+    sourceHash = bytes(program.source_hash).hex() if program.source_hash is not None else None
+    return {'program': {'checksums': [program.checksum1, program.checksum2], 'sourceHash': sourceHash,
+                        'totalReadings': program.total_readings},
+            'variables': dict(program.variables),
+            'phaseCycle': None if cycle is None else
+            {'length': cycle.length, 'phases': cycle.relativePhases()}}
+
+
+class RunWriter:
+    # appends scans to a run file, see create() and append()
+    def __init__(self, fileName, header, dataOffset):
+        self.fileName = fileName
+        self.header = header
+        self.dataOffset = dataOffset
+        self.file = open(fileName, 'r+b')
+        self.scans = _completeScans(fileName, header, dataOffset)
+        # drop what a crash left of a scan that wasn't written completely
+        self.file.truncate(dataOffset + self.scans * self.scanBytes)
+
+    @property
+    def points(self):
+        return self.header['points']
+
+    @property
+    def scanBytes(self):
+        return self.points * numpy.dtype(RUN_DTYPE).itemsize
+
+    def append(self, scan, scanNum=None):
+        # scanNum is the arduino's number of the scan, None if it follows the previous one
+        scan = numpy.asarray(scan)
+        if scan.shape != (self.points,):
+            raise ValueError("scan has " + str(scan.size) + " points, the run " + str(self.points))
+        if not numpy.issubdtype(scan.dtype, numpy.integer):
+            raise ValueError("run files hold the raw integer scans, not " + str(scan.dtype))
+        if scanNum is not None and scanNumAt(self.header, self.scans) != scanNum:
+            if self.scans == 0:
+                self.update(firstScanNum=scanNum)
+            else:
+                self.update(scanNumJumps=self.header.get('scanNumJumps', []) + [[self.scans, scanNum]])
+        self.file.seek(self.dataOffset + self.scans * self.scanBytes)
+        self.file.write(scan.astype(RUN_DTYPE, copy=False).tobytes())
+        self.file.flush()
+        self.scans += 1
+
+    def update(self, **fields):
+        # changes header fields, eg. firstScanNum once it is known. The only
+        # write to the header after create(), best done before many scans
+        self.header.update(fields)
+        self._writeHeader()
+
+    def _writeHeader(self):
+        text = json.dumps(self.header, default=_jsonValue).encode('utf-8')
+        if RUN_PREFIX.size + len(text) > self.dataOffset:
+            raise ValueError("run header of " + str(len(text)) + " bytes no longer fits in " + self.fileName)
+        self.file.seek(RUN_PREFIX.size)
+        self.file.write(text.ljust(self.dataOffset - RUN_PREFIX.size))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def programBlocks(program, points):
+    # the program's DAT blocks if they add up to points, else one block
+    try:
+        blockPoints = program.phase_cycle.blockPoints if program is not None else None
+    except ValueError:
+        blockPoints = None
+    return blockPoints if blockPoints and sum(blockPoints) == points else [points]
+
+
+def create(fileName, points, program=None, blockPoints=None, timeStep=anmr_common.TIME_STEP, firstScanNum=None,
+           **fields):
+    # new, empty run file for scans of points values from program (a
+    # CompiledProgram, or None). blockPoints defaults to the program's DAT
+    # blocks, firstScanNum is the arduino's number of the first scan (it
+    # decides the step of a phase cycle), None if unknown. fields are added to
+    # the header as they are. Returns a RunWriter.
+    points = int(points)
+    if blockPoints is None:
+        blockPoints = programBlocks(program, points)
+    header = {'points': points, 'dtype': RUN_DTYPE, 'timeStep': timeStep,
+              'blockPoints': [int(n) for n in blockPoints], 'firstScanNum': firstScanNum,
+              'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+    header.update(programHeader(program))
+    header.update(fields)
+    size = RUN_PREFIX.size + len(json.dumps(header, default=_jsonValue).encode('utf-8')) + HEADER_SLACK
+    dataOffset = -(-size // PAGE_SIZE) * PAGE_SIZE
+    with open(fileName, 'wb') as outFile:
+        outFile.write(RUN_PREFIX.pack(RUN_MAGIC, RUN_VERSION, 0, dataOffset))
+    writer = RunWriter(fileName, header, dataOffset)
+    writer._writeHeader()
+    return writer
+
+
+def append(fileName):
+    # RunWriter adding scans to an existing run file
+    header, dataOffset = _readHeader(fileName)
+    return RunWriter(fileName, header, dataOffset)
+
+
+def isRunFile(fileName):
+    with open(fileName, 'rb') as inFile:
+        return inFile.read(len(RUN_MAGIC)) == RUN_MAGIC
+
+
+def _readHeader(fileName):
+    with open(fileName, 'rb') as inFile:
+        prefix = inFile.read(RUN_PREFIX.size)
+        if len(prefix) < RUN_PREFIX.size or prefix[:len(RUN_MAGIC)] != RUN_MAGIC:
+            raise ValueError("not a run file: " + fileName)
+        magic, version, flags, dataOffset = RUN_PREFIX.unpack(prefix)
+        if version != RUN_VERSION:
+            raise ValueError("unknown run file version " + str(version) + " in " + fileName)
+        text = inFile.read(dataOffset - RUN_PREFIX.size)
+    try:
+        return json.loads(text.decode('utf-8')), dataOffset
+    except ValueError:
+        raise ValueError("damaged run file header: " + fileName)
+
+
+class Run:
+    #   header  the JSON header as a dict
+    #   scans   (scans, points) int16, memory mapped read only
+    def __init__(self, header, scans):
+        self.header = header
+        self.scans = scans
+
+    def __len__(self):
+        return len(self.scans)
+
+    @property
+    def points(self):
+        return self.header['points']
+
+    @property
+    def timeStep(self):
+        return self.header['timeStep']
+
+    @property
+    def blockPoints(self):
+        return self.header['blockPoints']
+
+    @property
+    def variables(self):
+        return self.header['variables']
+
+    def averager(self):
+        # Averager, or PhaseCycledAverager for a phase cycled program, holding
+        # every scan. Adds up SUM_ROWS scans at a time instead of one by one
+        cycle = self.header.get('phaseCycle')
+        if cycle is None:
+            averager = anmr_averaging.Averager(self.points)
+            _accumulate(averager, self.scans)
+            return averager
+        segments = scanSegments(self.header, len(self.scans))
+        if any(first is None for start, stop, first in segments):
+            # which step of the cycle a scan belongs to isn't known, don't guess
+            print('scan numbers of the run are unknown, averaging without turning the phases back')
+            averager = anmr_averaging.Averager(self.points)
+            _accumulate(averager, self.scans)
+            return averager
+        averager = anmr_averaging.PhaseCycledAverager(self.blockPoints, cycle['phases'])
+        length = len(averager.steps)
+        for start, stop, first in segments:
+            for i in range(min(length, stop - start)):
+                # scan start + i + j * length was the arduino's scan first + i + j * length
+                _accumulate(averager.steps[(first + i) % length], self.scans[start + i:stop:length])
+        return averager
+
+    def sum(self):
+        # sum of all scans, int64
+        total = numpy.zeros(self.points, dtype=numpy.int64)
+        for start in range(0, len(self.scans), SUM_ROWS):
+            total += self.scans[start:start + SUM_ROWS].sum(axis=0, dtype=numpy.int64)
+        return total
+
+    def mean(self):
+        return self.averager().mean()
+
+
+def _accumulate(averager, scans):
+    # adds the rows of scans to an Averager, as Averager.add would one by one
+    for start in range(0, len(scans), SUM_ROWS):
+        block = scans[start:start + SUM_ROWS].astype(numpy.int64)
+        averager.sum += block.sum(axis=0)
+        averager.sumSq += (block * block).sum(axis=0)
+        averager.scans += len(block)
+
+
+def scanSegments(header, scans):
+    # the runs of consecutively numbered scans among the first scans of a run
+    # file, as (start, stop, arduino's number of scan start or None if unknown)
+    starts = [[0, header.get('firstScanNum')]] + header.get('scanNumJumps', [])
+    stops = [start for start, scanNum in starts[1:]] + [scans]
+    return [(start, min(stop, scans), scanNum) for (start, scanNum), stop in zip(starts, stops) if start < scans]
+
+
+def scanNumAt(header, index):
+    # the arduino's number of scan index, None if unknown
+    start, stop, scanNum = scanSegments(header, index + 1)[-1]
+    return None if scanNum is None else scanNum + index - start
+
+
+def _completeScans(fileName, header, dataOffset):
+    # scans that are completely in the file
+    scanBytes = header['points'] * numpy.dtype(header['dtype']).itemsize
+    return max(os.path.getsize(fileName) - dataOffset, 0) // max(scanBytes, 1)
+
+
+def load(fileName):
+    # the Run in a run file. A partly written scan at the end is left out
+    header, dataOffset = _readHeader(fileName)
+    points = header['points']
+    dtype = numpy.dtype(header['dtype'])
+    scans = _completeScans(fileName, header, dataOffset)
+    if scans == 0 or points == 0:
+        return Run(header, numpy.zeros((scans, points), dtype=dtype))
+    return Run(header, numpy.memmap(fileName, dtype=dtype, mode='r', offset=dataOffset, shape=(scans, points)))
@@ -0,0 +1,116 @@
+####################
+#
+# Serial sessions that outlive a single experiment.
+#
+# Opening the arduino's port resets the board, so every open costs the
+# 1.6 s boot delay plus a QUERY handshake. A SerialSession keeps the port
+# open between experiments, checks with QUERY that the server still answers
+# before handing it out again, and reopens it when it doesn't.
+#
+##################
+
+import atexit
+import threading
+import time
+
+import serial
+
+import anmr_common
+import anmr_compiler
+
+
+class SerialSession:
+    def __init__(self, port, baudrate=1000000, hardware=True):
+        self.port = port
+        self.baudrate = baudrate
+        self.hardware = hardware  # a real board resets on open, a pty doesn't
+        self.ardSer = None
+        self.opens = 0  # how often we had to (re)open the port
+        self.lock = threading.RLock()
+
+    def acquire(self):
+        # returns (ardSer, reused). reused is False if the port had to be
+        # (re)opened. Raises serial.SerialException if the arduino can't be reached.
+        with self.lock:
+            if self.ardSer is not None and self.isAlive():
+                return self.ardSer, True
+            self.close()
+            self._open()
+            return self.ardSer, False
+
+    def isAlive(self):
+        with self.lock:
+            if self.ardSer is None:
+                return False
+            try:
+                self.ardSer.timeout = 0.2
+                self.ardSer.reset_input_buffer()
+                self.ardSer.write(bytearray([anmr_compiler.QUERY]))
+                return self.ardSer.readline() == anmr_common.IDENTIFIER
+            except (serial.SerialException, OSError):
+                return False
+
+    def invalidate(self):
+        # call after an error or an aborted run: the arduino may still be busy
+        # sending data, so start over with a fresh connection next time.
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.ardSer is not None:
+                try:
+                    self.ardSer.close()
+                except (serial.SerialException, OSError):
+                    pass
+                self.ardSer = None
+                print('Serial session closed:', self.port)
+
+    def _open(self):
+        # same settings as anmr_common.openDev
+        ardSer = serial.Serial(self.port, self.baudrate)
+        try:
+            if self.hardware:
+                ardSer.setRTS(True)
+                ardSer.setDTR(True)
+                ardSer.bytesize = serial.EIGHTBITS
+                ardSer.parity = serial.PARITY_NONE
+                ardSer.stopbits = serial.STOPBITS_ONE
+            ardSer.baudrate = self.baudrate
+            if self.hardware:
+                print('in open, sleeping')
+                time.sleep(anmr_common.ARDUINO_RESET_DELAY)
+            self.ardSer = ardSer
+            self.opens += 1
+            if not self.isAlive():
+                raise serial.SerialException("no ANMR server answering on " + self.port)
+        except Exception:
+            self.ardSer = None
+            ardSer.close()
+            raise
+        print('Serial session opened:', self.port)
+
+
+class SessionManager:
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, port, baudrate=1000000, hardware=True):
+        with self.lock:
+            if port not in self.sessions:
+                self.sessions[port] = SerialSession(port, baudrate, hardware)
+            return self.sessions[port]
+
+    def acquire(self, port, baudrate=1000000, hardware=True):
+        return self.session(port, baudrate, hardware).acquire()
+
+    def closeAll(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.close()
+
+
+# the sessions of this process; closed when the application exits.
+sessions = SessionManager()
+atexit.register(sessions.closeAll)
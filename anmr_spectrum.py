@@ -0,0 +1,216 @@
+####################
+#
+# Spectra of ADC data.
+#
+# One pipeline for the FFTs of scans and echoes: residual DC removal, an
+# apodization window, zero-filling to a length the FFT handles quickly, a
+# real FFT and the matching frequency axis from anmr_common.TIME_STEP.
+# samples can be one scan or a 2D batch with one scan or echo per row; the
+# last axis is transformed, all rows in one call. Complex samples (baseband
+# from anmr_ddc) get a full FFT with the frequencies around centre instead.
+#
+#   freqs, spectra = anmr_spectrum.spectrum(samples, 'exponential', broadening=5.0)
+#
+# Windows and frequency axes are cached per length and returned read only,
+# scipy.fft keeps its own plans for lengths it has seen.
+#
+# After the FFT, autoPhase finds the zero and first order phase of every
+# spectrum so the real part can be shown instead of the magnitude, and
+# baseline fits a polynomial to the signal free part:
+#
+#   phased, phi0, phi1 = anmr_spectrum.autoPhase(spectra)
+#   real = phased.real - anmr_spectrum.baseline(phased.real)
+#
+##################
+
+import functools
+
+import numpy
+import scipy.fft
+
+import anmr_common
+
+# the firmware sends (adc - ADC_OFFSET) * mult, so samples from READ_DATA are
+# already centred on 0 and only a small bias is left for removeDC
+ADC_OFFSET = 512
+
+WINDOWS = ('none', 'exponential', 'gaussian', 'hann', 'hamming', 'blackman')
+
+
+def removeDC(samples, offset=None):
+    # float (or complex) copy of samples less offset, or less the mean of
+    # each row if offset is None (the bias left after the firmware's ADC_OFFSET)
+    data = numpy.array(samples, dtype=complex if numpy.iscomplexobj(samples) else float)
+    if offset is None:
+        data -= data.mean(axis=-1, keepdims=True)
+    else:
+        data -= offset
+    return data
+
+
+@functools.lru_cache(maxsize=32)
+def apodization(name, points, broadening=0.0, timeStep=anmr_common.TIME_STEP):
+    # window of points values. broadening is the line broadening in Hz for
+    # 'exponential' (Lorentzian) and 'gaussian' (Gaussian FWHM), the others
+    # don't use it
+    if name == 'none':
+        w = numpy.ones(points)
+    elif name == 'exponential':
+        w = numpy.exp(-numpy.pi * broadening * numpy.arange(points) * timeStep)
+    elif name == 'gaussian':
+        t = numpy.arange(points) * timeStep
+        w = numpy.exp(-(numpy.pi * broadening * t) ** 2 / (4 * numpy.log(2)))
+    elif name == 'hann':
+        w = numpy.hanning(points)
+    elif name == 'hamming':
+        w = numpy.hamming(points)
+    elif name == 'blackman':
+        w = numpy.blackman(points)
+    else:
+        raise ValueError("unknown window " + str(name) + ", expected one of " + ", ".join(WINDOWS))
+    w.flags.writeable = False
+    return w
+
+
+def fftLength(points, zeroFill=1, real=True):
+    # points after zero-filling: at least zeroFill times the data, rounded up
+    # to a length with only small prime factors
+    return scipy.fft.next_fast_len(max(int(numpy.ceil(points * zeroFill)), 1), real=real)
+
+
+@functools.lru_cache(maxsize=32)
+def frequencies(length, timeStep=anmr_common.TIME_STEP, real=True):
+    # Hz of the bins of a transform of length points: the rfft bins, or for
+    # complex data all bins from the most negative up (after fftshift)
+    if real:
+        f = numpy.fft.rfftfreq(length, timeStep)
+    else:
+        f = numpy.fft.fftshift(numpy.fft.fftfreq(length, timeStep))
+    f.flags.writeable = False
+    return f
+
+
+def spectrum(samples, window='none', broadening=0.0, zeroFill=1, offset=None,
+             timeStep=anmr_common.TIME_STEP, workers=None, centre=0.0):
+    # (frequencies, complex spectra) of samples, one spectrum per row for 2D
+    # input. workers is passed on to scipy.fft for large batches. Complex
+    # samples are baseband mixed down by centre Hz: their DC is the signal,
+    # so offset defaults to 0 for them, and the frequencies include centre
+    real = not numpy.iscomplexobj(samples)
+    if not real and offset is None:
+        offset = 0
+    data = removeDC(samples, offset)
+    points = data.shape[-1]
+    if window != 'none':
+        data *= apodization(window, points, float(broadening), timeStep)
+    length = fftLength(points, zeroFill, real)
+    if real:
+        return frequencies(length, timeStep), scipy.fft.rfft(data, n=length, axis=-1, workers=workers)
+    values = scipy.fft.fftshift(scipy.fft.fft(data, n=length, axis=-1, workers=workers), axes=-1)
+    return centre + frequencies(length, timeStep, False), values
+
+
+def magnitude(samples, **options):
+    # (frequencies, |spectra|), options as for spectrum
+    freqs, spectra = spectrum(samples, **options)
+    return freqs, numpy.abs(spectra)
+
+
+def phase(spectra, phi0, phi1):
+    # spectra turned by phi0 + phi1 * k / n degrees at bin k of n. phi0 and
+    # phi1 are scalars or one value per row
+    n = spectra.shape[-1]
+    phi0 = numpy.asarray(phi0, dtype=float)[..., None]
+    phi1 = numpy.asarray(phi1, dtype=float)[..., None]
+    return spectra * numpy.exp(1j * numpy.radians(phi0 + phi1 * numpy.arange(n) / n))
+
+
+def _peakWeights(spectra):
+    # weight of each bin: its power, so the strong lines decide and the
+    # noise hardly counts
+    power = numpy.abs(spectra) ** 2
+    total = power.sum(axis=-1, keepdims=True)
+    return power / numpy.where(total > 0, total, 1)
+
+
+def _coarsePhase1(weighted, phi1Range, phi1Step):
+    # phi1 on a grid within +-phi1Range with the largest |sum(w s e^(i phi1 k/n))|
+    # per row. The rotation for the next grid point is the current one times a
+    # fixed step, so there is only one exp for the whole grid
+    ramp = numpy.radians(numpy.arange(weighted.shape[-1]) / weighted.shape[-1])
+    grid = numpy.arange(-phi1Range, phi1Range + phi1Step / 2, phi1Step)
+    rotation = numpy.exp(1j * grid[0] * ramp)
+    stepRotation = numpy.exp(1j * phi1Step * ramp)
+    sizes = numpy.empty(weighted.shape[:-1] + grid.shape)
+    for i in range(len(grid)):
+        sizes[..., i] = numpy.abs(weighted @ rotation)
+        rotation *= stepRotation
+    return grid[sizes.argmax(axis=-1)]
+
+
+def _refinePhase1(weighted, phi1, width, limit, tolerance):
+    # golden section search for the largest |sum(w s e^(i phi1 k/n))| within
+    # phi1 +- width, but not beyond +-limit, all rows at once
+    ramp = numpy.radians(numpy.arange(weighted.shape[-1]) / weighted.shape[-1])
+    size = lambda p: numpy.abs((weighted * numpy.exp(1j * p[..., None] * ramp)).sum(axis=-1))
+    g = (numpy.sqrt(5) - 1) / 2
+    lo = numpy.maximum(phi1 - width, -limit)
+    hi = numpy.minimum(phi1 + width, limit)
+    a = hi - g * (hi - lo)
+    b = lo + g * (hi - lo)
+    fa = size(a)
+    fb = size(b)
+    while (hi - lo).max() > tolerance:
+        # left: the maximum is in [lo, b], b moves to a; else it is in [a, hi]
+        left = fa >= fb
+        hi = numpy.where(left, b, hi)
+        lo = numpy.where(left, lo, a)
+        kept = numpy.where(left, a, b)
+        fKept = numpy.where(left, fa, fb)
+        new = numpy.where(left, hi - g * (hi - lo), lo + g * (hi - lo))
+        fNew = size(new)
+        a, fa = numpy.where(left, new, kept), numpy.where(left, fNew, fKept)
+        b, fb = numpy.where(left, kept, new), numpy.where(left, fKept, fNew)
+    return (lo + hi) / 2
+
+
+def autoPhase(spectra, phi1Range=360.0, phi1Step=10.0, phi1Start=None, tolerance=0.05):
+    # (phased spectra, phi0, phi1) with phi0, phi1 in degrees, one per row.
+    # The phase makes the power weighted sum of the real part as large as
+    # possible, so the strong lines come out as positive absorption. For any
+    # phi1 the best phi0 is -arg(sum(w s e^(i phi1 k/n))), only phi1 is
+    # searched: on a coarse grid within +-phi1Range, then refined to
+    # tolerance degrees. phi1Start, e.g. from the last call while averaging,
+    # skips the grid and only refines within +-phi1Step of it, so phi1 can
+    # follow the data but never leaves +-phi1Range.
+    spectra = numpy.asarray(spectra, dtype=complex)
+    weighted = _peakWeights(spectra) * spectra
+    if phi1Start is None:
+        phi1 = _coarsePhase1(weighted, phi1Range, phi1Step)
+    else:
+        phi1 = numpy.broadcast_to(numpy.asarray(phi1Start, dtype=float), spectra.shape[:-1])
+    phi1 = _refinePhase1(weighted, phi1, phi1Step, phi1Range, tolerance)
+    ramp = numpy.arange(spectra.shape[-1]) / spectra.shape[-1]
+    phi0 = -numpy.degrees(numpy.angle((weighted * numpy.exp(1j * numpy.radians(phi1[..., None]) * ramp)).sum(axis=-1)))
+    return phase(spectra, phi0, phi1), phi0, phi1
+
+
+def baseline(real, order=3, clip=3.0, maxIter=20):
+    # polynomial of the given order through the signal free part of each row
+    # of real. Points more than clip standard deviations off the fit are left
+    # out and the fit repeated until the set of points stays the same.
+    real = numpy.asarray(real, dtype=float)
+    n = real.shape[-1]
+    vander = numpy.polynomial.legendre.legvander(numpy.linspace(-1, 1, n), order)
+    weights = numpy.ones(real.shape)
+    for _ in range(maxIter):
+        normal = numpy.einsum('...n,ni,nj->...ij', weights, vander, vander)
+        rhs = numpy.einsum('...n,ni->...i', weights * real, vander)
+        fit = numpy.linalg.solve(normal, rhs[..., None])[..., 0] @ vander.T
+        residual = real - fit
+        sigma = numpy.sqrt((weights * residual ** 2).sum(axis=-1, keepdims=True) / weights.sum(axis=-1, keepdims=True))
+        kept = (numpy.abs(residual) <= clip * sigma).astype(float)
+        if (kept.sum(axis=-1) <= order).any() or numpy.array_equal(kept, weights):
+            break
+        weights = kept
+    return fit
@@ -0,0 +1,244 @@
+####################
+#
+# Parameter sweeps by patching compiled programs.
+#
+# The program is compiled once. The compiler's relocation table says where
+# each %variable ended up in the bytecode, so every further point of the sweep
+# only rewrites those bytes and corrects the two checksums for them, instead of
+# editing the text, recompiling and checksumming the whole program again.
+# Values that would change the program's layout (a DELAY_IN_MS or LOOP of 0,
+# or a variable whose current value left its instruction out) fall back to a
+# normal compile.
+#
+#   sweep = Sweep([('echo_delay', range(10, 110, 10)), ('frequency', [2100, 2150, 2200])])
+#   runner = SweepRunner(text, sweep, ardSer, scans=4)
+#   runner.run()
+#   runner.save('echo_sweep.npz')   # data[i, j, :] is echo_delay[i], frequency[j]
+#
+# The scans go through anmr_async where the serial port allows it, so cancel()
+# takes effect within milliseconds, else through anmr_common.runProgram.
+#
+##################
+
+import asyncio
+import itertools
+
+import numpy
+
+import anmr_analyzer
+import anmr_async
+import anmr_common
+import anmr_compiler
+
+
+class Sweep:
+    # axes: list of (variable, values), or a dict in the order wanted. The
+    # points are all combinations of the values, the first axis varying slowest.
+    def __init__(self, axes):
+        if isinstance(axes, dict):
+            axes = list(axes.items())
+        self.axes = []
+        for variable, values in axes:
+            variable = variable.strip()
+            if not variable.startswith('%'):
+                variable = '%' + variable
+            values = [int(value) for value in values]
+            if not values:
+                raise ValueError("no values for " + variable)
+            self.axes.append((variable, values))
+        if len(set(variable for variable, values in self.axes)) != len(self.axes):
+            raise ValueError("a variable appears on more than one axis")
+
+    @property
+    def shape(self):
+        return tuple(len(values) for variable, values in self.axes)
+
+    def __len__(self):
+        return int(numpy.prod(self.shape))
+
+    def points(self):
+        # yields (index, {variable: value}) for every point of the grid
+        ranges = [range(len(values)) for variable, values in self.axes]
+        for index in itertools.product(*ranges):
+            yield index, dict((variable, values[i]) for i, (variable, values) in zip(index, self.axes))
+
+
+def parseSweep(text):
+    # a sweep written one axis per line, in the style of the pulse programs:
+    #   %echo_delay = 10:100:10        start:stop:step, stop included
+    #   %frequency = 2100, 2150, 2200
+    # lines starting with # are ignored.
+    axes = []
+    for line in text.splitlines():
+        myline = line.split('#')[0].strip()
+        if not myline:
+            continue
+        fields = myline.split('=')
+        if len(fields) != 2:
+            raise ValueError("Error parsing sweep line: " + myline)
+        spec = fields[1].strip()
+        try:
+            if ':' in spec:
+                start, stop, step = [int(field) for field in spec.split(':')]
+                if step == 0:
+                    raise ValueError("step of 0")
+                values = list(range(start, stop + (1 if step > 0 else -1), step))
+            else:
+                values = [int(field) for field in spec.split(',')]
+        except ValueError:
+            raise ValueError("Error parsing sweep values: " + myline)
+        axes.append((fields[0], values))
+    return Sweep(axes)
+
+
+class ProgramPatcher:
+    # Keeps a working copy of a compiled program and moves it to new variable
+    # values by rewriting only the bytes the relocation table points at.
+    def __init__(self, program):
+        if program.relocations is None:
+            raise ValueError("program has no relocation table (compiled with optimize?)")
+        self.program = program
+        self.prog = bytearray(program.prog)
+        self.checksum1 = program.checksum1
+        self.checksum2 = program.checksum2
+        self.values = dict(program.variables)
+        self.totalReadings = program.total_readings
+        self.byVariable = {}
+        for offset, size, variable, kind in program.relocations:
+            self.byVariable.setdefault(variable, []).append((offset, size, kind))
+
+    def patch(self, values):
+        # returns the CompiledProgram for values ({variable: value}, other
+        # variables keep their current values). Raises ValueError, leaving the
+        # copy as it was, if a value needs a different program layout.
+        values = anmr_compiler.normalizeOverrides(values)
+        changes = []
+        layout = False  # a number of points or a loop count changes
+        for variable, value in values.items():
+            if variable not in self.values:
+                raise ValueError("program has no variable " + variable)
+            entries = self.byVariable.get(variable, ())
+            # nothing to patch, or the current value dropped an instruction:
+            # only a compile knows what the new value makes of the program
+            if not entries or any(size == 0 for offset, size, kind in entries):
+                if value == self.values[variable]:
+                    continue
+                raise ValueError("can't patch " + variable + " from " + str(self.values[variable]))
+            for offset, size, kind in entries:
+                changes.append((offset, anmr_compiler.encodeRelocation(kind, value)))
+                layout = layout or kind in ('points', 'loop')
+        prog = self.prog
+        for offset, data in changes:
+            for i, new in enumerate(data, offset):
+                old = prog[i]
+                if new != old:
+                    self.checksum1 += (i + 1) * (new - old)
+                    self.checksum2 += (i + 2) * (new - old)
+                    prog[i] = new
+        self.values.update(values)
+        if layout:
+            self.totalReadings = anmr_analyzer.analyze(prog).totalReadings
+        return anmr_compiler.CompiledProgram(bytes(prog), self.totalReadings, self.checksum1, self.checksum2,
+                                             dict(self.values), None, 0, self.program.relocations)
+
+
+class SweepRunner:
+    # Runs a program at every point of a sweep, scans times each, and keeps
+    # the results in one array: data has the sweep's shape plus one axis for
+    # the points of a scan (padded with 0 where a point has fewer, see lengths).
+    def __init__(self, text, sweep, ardSer, scans=1, overrides=None, chunkSize=anmr_common.DOWNLOAD_CHUNK):
+        self.text = text
+        self.sweep = sweep
+        self.ardSer = ardSer
+        self.scans = scans
+        self.overrides = anmr_compiler.normalizeOverrides(overrides)
+        self.chunkSize = chunkSize
+        self.data = None
+        self.lengths = None
+        self.recompiled = 0  # points that couldn't be patched
+        self.errors = {}  # {index: CompileError message} for points that didn't compile
+        self.cancelled = False
+
+    def programs(self):
+        # yields (index, values, CompiledProgram) for every point, the program
+        # None for a point that doesn't compile (its error is in self.errors)
+        base = anmr_compiler.compile_source(self.text, self.overrides)
+        patcher = ProgramPatcher(base)
+        self.errors = {}
+        for index, values in self.sweep.points():
+            try:
+                program = patcher.patch(values)
+            except ValueError:
+                overrides = dict(self.overrides)
+                overrides.update(values)
+                self.recompiled += 1
+                try:
+                    program = anmr_compiler.compile_source(self.text, overrides)
+                except anmr_compiler.CompileError as e:
+                    self.errors[index] = str(e)
+                    program = None
+            yield index, values, program
+
+    def cancel(self):
+        self.cancelled = True
+        anmr_common.abort = True
+
+    def run(self, onPoint=None):
+        # onPoint(index, values, data) is called after each point.
+        # Returns True, or an error string from the download or runProgram.
+        # Points that don't compile are skipped (lengths 0) and reported at the end.
+        self.cancelled = False
+        points = list(self.programs())
+        readings = max([program.total_readings for index, values, program in points if program is not None] or [0])
+        self.data = numpy.zeros(self.sweep.shape + (readings,), dtype=numpy.int64)
+        self.lengths = numpy.zeros(self.sweep.shape, dtype=numpy.int64)
+        anmr_common.ardSer = self.ardSer
+        for index, values, program in points:
+            if self.cancelled:
+                return "aborted"
+            if program is None:
+                continue
+            if not anmr_common.programResident(program, self.ardSer):
+                result = anmr_common.sendProgram(program, self.ardSer, self.chunkSize)
+                if result is not True:
+                    return "download failed at " + str(values) + ": " + str(result)
+            analysis = anmr_analyzer.analyze(program.prog)
+            result, data = self._measure(analysis)
+            if result is not True:
+                return str(result) + " at " + str(values)
+            self.data[index][:data.size] = data
+            self.lengths[index] = data.size
+            if onPoint is not None:
+                onPoint(index, values, data)
+        if self.errors:
+            index, error = next(iter(self.errors.items()))
+            return str(len(self.errors)) + " points didn't compile, eg. " + str(index) + ": " + error
+        return True
+
+    def _measure(self, analysis):
+        # (True, summed scans) or (error string, None), as from runProgram
+        if not anmr_async.available(self.ardSer):
+            data = None
+            for scan in range(self.scans):
+                result, data = anmr_common.runProgram(None, data, scan, analysis)
+                if result is not True:
+                    return result, None
+            return True, data
+        try:
+            data = anmr_async.runProgram(self.ardSer, self.scans, analysis, cancelled=lambda: self.cancelled)
+        except asyncio.TimeoutError:
+            return "Serial read timeout", None
+        except (RuntimeError, ValueError, OSError, EOFError) as e:
+            return str(e), None
+        if data is None:
+            return "aborted", None
+        return True, data
+
+    def save(self, fileName):
+        # one .npz with the data cube, the lengths, and for every axis its
+        # variable name and values
+        arrays = {'data': self.data, 'lengths': self.lengths, 'scans': self.scans,
+                  'variables': numpy.array([variable for variable, values in self.sweep.axes])}
+        for i, (variable, values) in enumerate(self.sweep.axes):
+            arrays['axis%d' % i] = numpy.array(values)
+        numpy.savez(fileName, **arrays)
@@ -127,6 +127,17 @@ void loop(){
   case QUERY:
     Serial.println("ANMR v0.9, Ready");
     break;
+  case QUERY_PROGRAM: // report which program we hold, so the host can skip downloading it again
+    if (head != NULL){
+      Serial.println(checksum1,DEC);
+      Serial.println(checksum2,DEC);
+    }
+    else{
+      Serial.println(0,DEC);
+      Serial.println(0,DEC);
+    }
+    Serial.println(scanNum,DEC);
+    break;
   case START_OF_PROGRAM://if (input == %0001)    //start of program instruction
     {
       scanNum = 0;
@@ -134,6 +145,7 @@ void loop(){
       checksum2 = 0;
       if (head != NULL)            //there is a pulse program stored
         free (head);               
+      head = NULL;
       bytes=0;
       totalNumReadings=0;
       if (fRead(2,(byte *) &bytes) == 0){
@@ -156,6 +168,7 @@ void loop(){
       if (fRead(bytes,head) == 0){
         Serial.println("Timed out reading program" );
         free(head);
+        head = NULL;
         break;
       }
       else{
@@ -1,6 +1,9 @@
-from PyQt5.QtCore import QTimer
+import time
+import numpy as np
+
+from PyQt5.QtCore import QTimer, QThread, pyqtSignal
 from PyQt5.QtWidgets import QFileDialog, QMessageBox, QTextEdit
-from models import PulseModel
+from models import PulseModel, StepError
 
 
 
@@ -244,10 +247,64 @@ class PulseControlController:
                 print(f"DEBUG: Setze Read Data Eingabefeld {i} = {val}")
                 read_data_inputs[i].setValue(val)
 
+class StepWorker(QThread):
+    """Führt einen Schritt des ExperimentModel außerhalb des GUI-Threads aus."""
+    progress = pyqtSignal(int, int)  # empfangene Messwerte, erwartete Messwerte
+    data_chunk = pyqtSignal(object)  # neu empfangene Messwerte (NumPy-Array)
+    average = pyqtSignal(object, int, float)  # laufender Mittelwert, Anzahl Scans, Rauschen je Scan
+    snr = pyqtSignal(float, int, float)  # geschätztes SNR, noch nötige Scans, noch nötige Zeit in s
+    step_done = pyqtSignal(int, object)  # Schrittindex, Ergebnis des Schritts
+    step_failed = pyqtSignal(int, str)  # Schrittindex, Fehlermeldung
+
+    def __init__(self, model, step_index, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.step_index = step_index
+
+    def run(self):
+        step_function = self.model.steps[self.step_index]
+        # Signale sind threadsicher, die Slots laufen im GUI-Thread
+        self.model.on_progress = self.progress.emit
+        self.model.on_data_chunk = self.data_chunk.emit
+        self.model.on_average = self.average.emit
+        self.model.on_snr = self.snr.emit
+        try:
+            result = step_function()
+        except Exception as e:
+            self.step_failed.emit(self.step_index, str(e))
+        else:
+            self.step_done.emit(self.step_index, result)
+        finally:
+            self.model.on_progress = None
+            self.model.on_data_chunk = None
+            self.model.on_average = None
+            self.model.on_snr = None
+
+
 class ExperimentController:
+    # Zeitlimit je Schritt in ms, danach wird der automatische Ablauf abgebrochen
+    STEP_TIMEOUTS_MS = {
+        "step_check_arduino_readiness": 6000,
+        "step_transfer_compiled_program": 10000,
+        "step_data_acquisition_and_processing": 600000,
+    }
+    DEFAULT_STEP_TIMEOUT_MS = 10000
+    # so lange wartet stop_worker auf einen abgebrochenen Schritt, ein laufender Scan
+    # bemerkt den Abbruch spätestens nach dem Lese-Timeout der seriellen Schnittstelle
+    STOP_WAIT_MS = 3000
+
     def __init__(self, model, view):
         self.model = model
         self.view = view
+        self.worker = None  # StepWorker des gerade laufenden Schritts
+        self.stopping_workers = []  # abgebrochene StepWorker, die noch nicht beendet sind
+        self.target_step = None  # bis zu diesem Schritt wird automatisch weitergeschaltet
+        self.step_durations = {}  # gemessene Dauer je Schritt in s
+        self.step_started_at = None
+        self.run_started_at = None
+        self.step_timer = QTimer()
+        self.step_timer.setSingleShot(True)
+        self.step_timer.timeout.connect(self._on_step_timeout)
 
     def run_until_start_experiment(self):
         """Führt automatisch alle Schritte bis einschließlich step_start_experiment aus."""
@@ -260,62 +317,186 @@ class ExperimentController:
             return
         print(f"DEBUG: Ziel-Schritt-Index: {target_step_index}")
 
-        def execute_next_step_with_timer():
-            if self.model.current_step <= target_step_index:
-                print(f"DEBUG: Aktueller Schritt-Index: {self.model.current_step}")
-                self.execute_next_step()
-                QTimer.singleShot(2000, execute_next_step_with_timer)# Nächster Schritt nach kurzer Verzögerung
-            else:
-                print("DEBUG: Alle vorbereitenden Schritte abgeschlossen.")
-                self.view.update_output(
-                    "Beobachte die PULSE-Abfolge auf dem Oszilloskop" + "\n" + "Warte vor ADC-Wiedergabe")
+        # Jeder Schritt startet, sobald der vorherige fertig ist (siehe _advance)
+        self.target_step = target_step_index
+        self.step_durations = {}
+        self.run_started_at = time.perf_counter()
+        self.execute_next_step()  # Starte direkt den ersten Schritt
 
-        execute_next_step_with_timer()  # Starte direkt den ersten Schritt
+    def _advance(self):
+        """Startet nach einem abgeschlossenen Schritt den nächsten, bis der Zielschritt erreicht ist."""
+        if self.target_step is None:
+            return
+        if self.model.current_step <= self.target_step:
+            print(f"DEBUG: Aktueller Schritt-Index: {self.model.current_step}")
+            self.execute_next_step()
+            return
+        self.target_step = None
+        total = time.perf_counter() - self.run_started_at
+        durations = ", ".join(f"{name}: {seconds * 1000:.0f} ms" for name, seconds in self.step_durations.items())
+        print(f"DEBUG: Alle vorbereitenden Schritte abgeschlossen. Dauer: {durations}")
+        self.view.update_output(f"Vorbereitung abgeschlossen nach {total:.2f} s.")
+        self.view.update_output(
+            "Beobachte die PULSE-Abfolge auf dem Oszilloskop" + "\n" + "Warte vor ADC-Wiedergabe")
+
+    def _on_step_timeout(self):
+        """Der laufende Schritt hat sein Zeitlimit überschritten."""
+        step_function = self.model.steps[self.model.current_step]
+        self.target_step = None  # automatischen Ablauf anhalten
+        self.model.cancel_event.set()
+        self.view.update_output(f"Zeitüberschreitung bei {step_function.__name__}, Ablauf angehalten.")
+
+    def is_step_running(self):
+        return self.worker is not None and self.worker.isRunning()
 
     def execute_next_step(self):
-        """Führt den aktuellen Schritt aus und bewegt sich zum nächsten."""
+        """Startet den aktuellen Schritt im Hintergrund; weiter geht es in _on_step_done."""
+        if self.is_step_running() or self.stopping_workers:
+            # ein neuer Schritt würde cancel_event zurücksetzen, solange ein abgebrochener noch läuft
+            self.view.update_output("Der vorherige Schritt läuft noch.")
+            return
         if self.model.current_step < len(self.model.steps):
-            try:
-                step_function = self.model.steps[self.model.current_step]
-                self.view.update_output(
-                    f"Schritt {self.model.current_step + 1}: {step_function.__name__} wird ausgeführt."
-                )
-                result = step_function()
-
-                # Zeige Diagramme und relevante Statistiken nur bei Schritt 7
-                if self.model.current_step == self.model.get_step_index("step_visualize_results"):
-                    if result and "plots" in result:
-                        self.view.main_window.update_diagrams(result["plots"])
-                    if result and "stats" in result:
-                        self.view.update_output(result["stats"])
-
-                # Zeige die Ausgabe nur, wenn sie nicht None ist und nicht Rohdaten enthält
-                if result and not isinstance(result, dict):
-                    self.view.update_output(f"{step_function.__name__} abgeschlossen: {result}")
-
-                 # DEBUG nur ausgeben, wenn es nicht Schritt 7 ist
-                if self.model.current_step != self.model.get_step_index("step_visualize_results"):
-                    print(f"DEBUG: Schritt {self.model.current_step + 1} abgeschlossen mit Ergebnis: {result}")
-
-                self.model.current_step += 1
-            except Exception as e:
-                error_message = f"Fehler bei Schritt {self.model.current_step + 1}: {e}"
-                self.view.update_output(error_message)
-                print(f"DEBUG: {error_message}")
+            step_function = self.model.steps[self.model.current_step]
+            self.view.update_output(
+                f"Schritt {self.model.current_step + 1}: {step_function.__name__} wird ausgeführt."
+            )
+            self.model.cancel_event.clear()
+            self.step_started_at = time.perf_counter()
+            timeout_ms = self.STEP_TIMEOUTS_MS.get(step_function.__name__, self.DEFAULT_STEP_TIMEOUT_MS)
+            analysis = getattr(self.model, "analysis", None)
+            if step_function.__name__ == "step_data_acquisition_and_processing" and analysis is not None \
+                    and analysis.endDeadline() is not None:
+                # Laufzeit aus der Programmanalyse statt pauschal 10 Minuten: ein Scan dauert endDeadline,
+                # gemittelt werden bis zu num_scans (mit target_snr die Obergrenze), je Scan 1 s Reserve
+                # für GO und Übertragung, plus Reserve für das Speichern
+                scans = max(self.model.num_scans, 1)
+                timeout_ms = int(analysis.endDeadline() * 1000 * scans) + 1000 * (scans - 1) + 5000
+            if step_function.__name__ == "step_data_acquisition_and_processing":
+                # Messwerte schon während der Aufnahme anzeigen
+                self.view.main_window.begin_live_plot(analysis.totalReadings if analysis is not None else 0)
+            self.step_timer.start(timeout_ms)
+            self.worker = StepWorker(self.model, self.model.current_step)
+            self.worker.step_done.connect(self._on_step_done)
+            self.worker.step_failed.connect(self._on_step_failed)
+            self.worker.progress.connect(self.view.update_progress)
+            self.worker.data_chunk.connect(self._on_data_chunk)
+            self.worker.average.connect(self._on_average)
+            self.worker.snr.connect(self._on_snr)
+            self.worker.start()
         else:
             self.view.update_output("Keine weiteren Schritte auszuführen.")
 
+    def cancel_step(self):
+        """Bricht eine laufende Datenaufnahme ab."""
+        if self.is_step_running():
+            self.model.cancel_event.set()
+            self.view.update_output("Abbruch angefordert...")
+
+    def stop_worker(self):
+        """Bricht den laufenden Schritt ab und wartet höchstens STOP_WAIT_MS, bis der Thread beendet ist."""
+        self.step_timer.stop()
+        self.target_step = None
+        if self.worker is not None:
+            # Ergebnisse des abgebrochenen Schritts sollen nach dem Zurücksetzen nicht mehr ankommen
+            self.worker.step_done.disconnect()
+            self.worker.step_failed.disconnect()
+            self.worker.progress.disconnect()
+            self.worker.data_chunk.disconnect()
+            self.worker.average.disconnect()
+            self.worker.snr.disconnect()
+            self.model.cancel_event.set()
+            if not self.worker.wait(self.STOP_WAIT_MS):
+                # GUI nicht blockieren; der Thread wird behalten, bis er von selbst endet
+                worker = self.worker
+                self.stopping_workers.append(worker)
+                worker.finished.connect(lambda: self.stopping_workers.remove(worker))
+                self.view.update_output("Der abgebrochene Schritt läuft noch im Hintergrund.")
+            self.worker = None
+
+    def _on_step_failed(self, step_index, message):
+        self.step_timer.stop()
+        self.target_step = None  # bei Fehlern nicht automatisch weitermachen
+        error_message = f"Fehler bei Schritt {step_index + 1}: {message}"
+        self.view.update_output(error_message)
+        print(f"DEBUG: {error_message}")
+
+    def _on_step_done(self, step_index, result):
+        """Wertet das Ergebnis eines Schritts im GUI-Thread aus und bewegt sich zum nächsten."""
+        step_function = self.model.steps[step_index]
+        self.step_timer.stop()
+        if isinstance(result, StepError):
+            # die Schritte fangen ihre Fehler selbst ab und melden sie so
+            self._on_step_failed(step_index, result)
+            return
+        self.step_durations[step_function.__name__] = time.perf_counter() - self.step_started_at
+        try:
+            # Zeige Diagramme und relevante Statistiken nur bei Schritt 7
+            if self.model.current_step == self.model.get_step_index("step_visualize_results"):
+                if result and "plots" in result:
+                    self.view.main_window.update_diagrams(result["plots"])
+                if result and "stats" in result:
+                    self.view.update_output(result["stats"])
+
+            # Zeige die Ausgabe nur, wenn sie nicht None ist und nicht Rohdaten enthält
+            if result and not isinstance(result, dict):
+                self.view.update_output(f"{step_function.__name__} abgeschlossen: {result}")
+
+             # DEBUG nur ausgeben, wenn es nicht Schritt 7 ist
+            if self.model.current_step != self.model.get_step_index("step_visualize_results"):
+                print(f"DEBUG: Schritt {self.model.current_step + 1} abgeschlossen mit Ergebnis: {result}")
+
+            self.model.current_step += 1
+        except Exception as e:
+            self._on_step_failed(step_index, str(e))
+            return
+        self._advance()
+
+    def _on_data_chunk(self, chunk):
+        """Hängt neu empfangene Messwerte an die Live-Anzeige an."""
+        live_plot = getattr(self.view.main_window, "live_plot", None)
+        if live_plot is not None:
+            live_plot.append(chunk)
+
+    def _on_average(self, mean, scans, noise):
+        """Zeigt während der Mittelung den aktuellen Mittelwert an (alle display_every Scans)."""
+        self.view.update_output(f"{scans} Scans gemittelt, Rauschen je Scan: {noise:.2f}")
+        # Spektrum nur von der letzten Phase aus verfeinert, damit die Anzeige schnell bleibt
+        freqs, spectrum = self.model.process_spectrum(mean, live=True)
+        self.view.main_window.update_diagrams([{
+            "x": np.arange(len(mean)),
+            "y": mean,
+            "title": f"Mittelwert aus {scans} Scans",
+            "xlabel": "Measurement No.",
+            "ylabel": "ADC Value"
+        }, {
+            "x": freqs,
+            "y": spectrum,
+            "title": "Frequency Spectrum",
+            "xlabel": "Frequency (Hz)",
+            "ylabel": "Amplitude"
+        }])
+
+    def _on_snr(self, snr, remaining_scans, remaining_time):
+        """Zeigt bei der Mittelung mit SNR-Ziel nach jedem Scan die Prognose an."""
+        if remaining_scans < 0:
+            self.view.update_output(f"SNR {snr:.1f}, noch kein Signal erkennbar")
+        elif remaining_scans == 0:
+            self.view.update_output(f"SNR {snr:.1f}, Ziel erreicht")
+        else:
+            self.view.update_output(f"SNR {snr:.1f}, noch ca. {remaining_scans} Scans ({remaining_time:.0f} s)")
+
     def restart_experiment(self):
         """
         Setzt das Experiment zurück und startet neu.
         """
         self.view.update_output("Experiment wird zurückgesetzt...")
+        self.stop_worker()
 
-        # Serielle Verbindung schließen, falls offen
+        # Serielle Verbindung freigeben; die Sitzung bleibt offen und wird beim Neustart
+        # wiederverwendet (anmr_session prüft vorher, ob der Arduino noch antwortet)
         if self.model.ardSer:
-            self.model.ardSer.close()
             self.model.ardSer = None
-            self.view.update_output("Serielle Verbindung geschlossen.")
+            self.view.update_output("Serielle Verbindung freigegeben.")
 
         # Experiment zurücksetzen
         self.model.reset()  # Ruft die Reset-Methode des Models auf
@@ -339,6 +520,7 @@ class ExperimentController:
 
     def reset_model(self):
         """Setzt das Experiment-Modell und den Zustand zurück."""
+        self.stop_worker()
         self.model.current_step = 0  # Zurücksetzen des Schritts
         print(f"DEBUG: current_step wurde zurückgesetzt: {self.model.current_step}")
         self.model.reset()
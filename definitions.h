@@ -15,3 +15,4 @@
 #define QUERY 14
 #define TOGGLE_PIN 15
 #define TABLE 16
+#define QUERY_PROGRAM 17
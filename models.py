@@ -1,11 +1,29 @@
 import anmr_compiler as anmr
 import anmr_common
+import anmr_cache
+import anmr_analyzer
+import anmr_averaging
+import anmr_ddc
+import anmr_echoes
+import anmr_fitting
+import anmr_runfile
+import anmr_spectrum
+import anmr_session
 import serial
 import time
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.fft import fft, fftfreq
 import os
+import threading
+
+
+class StepError(str):
+    """
+    Ergebnis eines fehlgeschlagenen Schritts: die Fehlermeldung, als str weiter lesbar.
+    Der Controller hält den automatischen Ablauf an, statt mit dem nächsten Schritt weiterzumachen.
+    """
+
 
 class PulseModel:
     def __init__(self):
@@ -140,6 +158,37 @@ class ExperimentModel:
         ]
         self.current_step = 0
         self.target_step = self.get_step_index("self.step_data_acquisition_and_processing")
+        self.program_cache = anmr_cache.ProgramCache()  # bleibt über Resets hinweg erhalten
+        self.program = None  # zuletzt kompiliertes Programm (anmr_compiler.CompiledProgram)
+        self.optimize_program = True  # Bytecode mit anmr_compiler.peephole verkleinern (gleiches Timing)
+        self.analysis = None  # Laufzeit, DAT-Blöcke und Speicherbedarf des Programms (anmr_analyzer.ProgramAnalysis)
+        self.run_started_at = None  # Zeitpunkt des GO-Befehls
+        # Rückmeldungen während der Datenaufnahme, werden vom StepWorker gesetzt
+        self.on_progress = None  # on_progress(empfangene Werte, erwartete Werte)
+        self.on_data_chunk = None  # on_data_chunk(NumPy-Array mit neuen Werten)
+        self.on_average = None  # on_average(Mittelwert, Anzahl Scans, Rauschen je Scan)
+        self.on_snr = None  # on_snr(SNR, noch nötige Scans, noch nötige Zeit in s), -1 = noch unbekannt
+        self.num_scans = 1  # Anzahl Scans, die gemittelt werden
+        self.display_every = 10  # Anzeige des Mittelwerts alle k Scans aktualisieren
+        self.checkpoint_every = 100  # Zwischenstand alle m Scans binär sichern
+        self.target_snr = None  # Mittelung beenden, sobald dieses SNR bei %frequency erreicht ist (num_scans = Obergrenze)
+        self.snr_confidence = None  # z.B. 0.95: die untere Konfidenzgrenze des SNR muss target_snr erreichen
+        self.averager = None  # anmr_averaging.Averager des letzten Laufs
+        self.block_points = []  # Werte je empfangenem DAT-Block des letzten Laufs
+        self.echo_matrix = None  # anmr_echoes.EchoMatrix des letzten Laufs (eine Zeile je DAT-Block)
+        self.spectrum_window = 'none'  # Fensterfunktion vor der FFT, siehe anmr_spectrum.WINDOWS
+        self.line_broadening = 0.0  # Hz, für die Fenster 'exponential' und 'gaussian'
+        self.phase_correction = True  # Spektren automatisch phasen und Basislinie abziehen (sonst Betragsspektrum)
+        self.baseline_order = 3  # Grad des Basislinien-Polynoms
+        self.spectrum_phase = None  # (phi0, phi1) in Grad der letzten Phasenkorrektur eines einzelnen Spektrums
+        self.downconvert = 0  # Dezimationsfaktor (4-16): beim Empfang bei %frequency ins komplexe Basisband mischen, 0 = aus
+        self.baseband = None  # anmr_ddc.Baseband des letzten Laufs
+        self.run_file = None  # anmr_runfile.RunWriter für adc_run.anmr, nur während der Datenaufnahme offen
+        self.first_scan_num = None  # Scan-Nummer des Arduino beim nächsten GO: 0 nach einer Übertragung, None = unbekannt
+        self.cancel_event = threading.Event()  # gesetzt = laufende Datenaufnahme abbrechen
+        self.serial_port = 'COM3'
+        self.session = None  # anmr_session.SerialSession, bleibt über mehrere Experimente geöffnet
+        self.ardSer = None
 
     def get_step_index(self, step_name):
         """Gibt den Index eines Schrittes zurück oder -1, wenn nicht gefunden."""
@@ -164,6 +213,7 @@ class ExperimentModel:
         ]
         # Setzt alle Schritte zurück
         self.ardSer = None  # Schließt ggf. serielle Verbindungen
+        self.first_scan_num = None
         print(f"DEBUG: Schritte nach Reset: {[step.__name__ for step in self.steps]}")
 
     def step_compile_command_list(self):
@@ -173,163 +223,438 @@ class ExperimentModel:
             # Setze den Dateinamen fest
             pulse_file_name = "pulse_program.txt"
 
-            # Debug: Prüfen, ob die Datei existiert
+            # Ohne Datei gibt es nichts zu übertragen (output.bin wäre von einem früheren Lauf)
             if not os.path.exists(pulse_file_name):
                 print(f"ERROR: Datei {pulse_file_name} existiert nicht!")
-            else:
-                print(f"DEBUG: Datei {pulse_file_name} existiert, starte Compile-Prozess...")
-
-            # Rufe compile nur auf, wenn die Datei wirklich existiert
-            if os.path.exists(pulse_file_name):
-                self.anmr.compile(pulse_file_name, "output.bin")
+                return StepError(f"Fehler in step_compile_command_list: Datei {pulse_file_name} existiert nicht.")
+            print(f"DEBUG: Datei {pulse_file_name} existiert, starte Compile-Prozess...")
+
+            # Unveränderte Programme kommen aus dem Cache und werden nicht erneut kompiliert.
+            with open(pulse_file_name, 'r', encoding='utf-8') as file:
+                source = file.read()
+            self.program = self.program_cache.get(source, optimize=self.optimize_program)
+            if self.program.bytes_saved:
+                print(f"DEBUG: Optimierer hat {self.program.bytes_saved} Bytes eingespart")
+            self.analysis = anmr_analyzer.analyze(self.program.prog)
+            print(f"DEBUG: {self.analysis.report()}")
+            if not self.analysis.fitsHeap():
+                return StepError(f"Fehler in step_compile_command_list: Programm ({self.analysis.programBytes} Bytes) "
+                                 f"passt nicht in den Speicher des Arduino ({self.analysis.heapBytes} Bytes).")
+            self.anmr.writeProgram(self.program, "output.bin")
+            stats = self.program_cache.stats()
+            print(f"DEBUG: Programm-Cache: {stats['hits']} Treffer, {stats['misses']} Kompilierungen")
 
             return "step_compile_command_list erfolgreich."
 
         except Exception as e:
-            return f"Fehler in step_compile_command_list: {e}"
+            return StepError(f"Fehler in step_compile_command_list: {e}")
 
     def step_setup_serial_connection(self):
         try:
-            self.ardSer = self.serial.Serial('COM3', 1000000)
-            self.ardSer.setRTS(True)
-            self.ardSer.setDTR(True)
-            self.ardSer.bytesize = self.serial.EIGHTBITS
-            self.ardSer.parity = self.serial.PARITY_NONE
-            self.ardSer.stopbits = self.serial.STOPBITS_ONE
+            # Die Verbindung wird nur beim ersten Mal (oder nach Fehlern) geöffnet,
+            # sonst entfällt der Neustart des Arduino samt Wartezeit
+            self.session = anmr_session.sessions.session(self.serial_port)
+            self.ardSer, reused = self.session.acquire()
+            if reused:
+                return "Bestehende serielle Verbindung wiederverwendet."
             return "Serielle Verbindung erfolgreich hergestellt."
         except Exception as e:
-            return f"Fehler bei der seriellen Verbindung: {e}"
+            return StepError(f"Fehler bei der seriellen Verbindung: {e}")
 
     def step_check_arduino_readiness(self):
         try:
-            self.ardSer.reset_input_buffer()
-            self.ardSer.write(bytearray([14]))  # 14 is QUERY
-            self.time.sleep(1)
-            response = self.ardSer.readline()
-            if response.strip():
-                return f"Antwort vom Arduino: {response.decode().strip()}"
-            else:
-                return "Keine Antwort vom Arduino."
+            # Nach dem Öffnen startet der Arduino neu; QUERY wiederholen, bis er antwortet
+            self.ardSer.timeout = 0.25
+            deadline = self.time.time() + 5
+            while self.time.time() < deadline and not self.cancel_event.is_set():
+                self.ardSer.reset_input_buffer()
+                self.ardSer.write(bytearray([14]))  # 14 is QUERY
+                response = self.ardSer.readline()
+                if response.strip():
+                    return f"Antwort vom Arduino: {response.decode().strip()}"
+            return StepError("Keine Antwort vom Arduino.")
         except Exception as e:
-            return f"Fehler beim Prüfen der Arduino-Bereitschaft: {e}"
+            return StepError(f"Fehler beim Prüfen der Arduino-Bereitschaft: {e}")
 
     def step_transfer_compiled_program(self):
         try:
-            self.anmr_common.downloadProgram('output.bin', self.ardSer)
+            # Hält der Arduino genau dieses Programm schon (gleiche Prüfsummen), entfällt die Übertragung
+            self.first_scan_num = None
+            if self.anmr_common.programResident(self.program, self.ardSer):
+                return "Programm bereits auf dem Arduino, Übertragung übersprungen."
+            result = self.anmr_common.downloadProgram('output.bin', self.ardSer)
+            if result is not True:
+                return StepError(f"Fehler beim Übertragen des Programms: {result}")
+            self.first_scan_num = 0  # der Arduino zählt seine Scans nach der Übertragung von 0 an
             return "Programm erfolgreich übertragen."
         except Exception as e:
-            return f"Fehler beim Übertragen des Programms: {e}"
+            return StepError(f"Fehler beim Übertragen des Programms: {e}")
 
     def step_start_experiment(self):
         try:
             self.ardSer.write(bytearray([9]))  # 9 is GO
             response = self.ardSer.readline()
+            self.run_started_at = self.time.time()  # Bezugspunkt für den Zeitplan der DAT-Blöcke
+            if not response.startswith(b'Executing'):
+                return StepError(f"Fehler beim Starten des Experiments: Antwort {response!r} statt Executing")
             return f"Experiment gestartet: {response.decode().strip()}"
         except Exception as e:
-            return f"Fehler beim Starten des Experiments: {e}"
+            return StepError(f"Fehler beim Starten des Experiments: {e}")
 
     def step_data_acquisition_and_processing(self):
         # Exakter Codeblock zur Datenaufnahme und Verarbeitung
         try:
-            def read_int_from_serial(bytesize, signed=False):
+            def read_block_into(samples, raw, filled, num_points, expected, deadline, timeout_duration,
+                                downconverter=None, baseband=None):
                 """
-                Liest eine Ganzzahl von der seriellen Schnittstelle mit der gegebenen Bytegröße.
+                Füllt samples[filled:filled + num_points] direkt von der seriellen Schnittstelle.
+                Gibt die Anzahl der gelesenen Bytes zurück (weniger bei Timeout oder Abbruch).
+                deadline: Zeitpunkt, bis zu dem der Block vollständig sein muss (None = nur timeout_duration).
+                downconverter: jeder neue Teil wird gleich ins Basisband gemischt und an baseband angehängt.
                 """
-                bytes_read = self.ardSer.read(bytesize)
-                return int.from_bytes(bytes_read, byteorder='little', signed=signed)
+                block = raw[2 * filled:2 * (filled + num_points)]
+                got = 0
+                last_data_time = self.time.time()
+                while got < len(block) and not self.cancel_event.is_set():
+                    n = self.ardSer.readinto(block[got:])
+                    if n:
+                        start = filled + got // 2
+                        got += n
+                        last_data_time = self.time.time()
+                        if filled + got // 2 > start:
+                            chunk = samples[start:filled + got // 2]
+                            if downconverter is not None:
+                                baseband.append(downconverter.process(chunk))
+                            if self.on_data_chunk is not None:
+                                self.on_data_chunk(chunk)
+                        if self.on_progress is not None:
+                            self.on_progress(filled + got // 2, expected)
+                    elif deadline is not None and self.time.time() > deadline:
+                        break
+                    elif (self.time.time() - last_data_time) > timeout_duration:
+                        break
+                return got
 
             def read_and_process_adc_data():
                 """
-                Liest und verarbeitet ADC-Daten, die vom Arduino gesendet wurden.
+                Liest die DAT-Blöcke des Arduino blockweise in einen vorab angelegten int16-Puffer.
+                Mit einer Programmanalyse gilt für jeden Block und für EOP eine eigene Frist,
+                sonst ein pauschaler Timeout von 5 s ohne Daten.
                 """
                 timeout_duration = 5  # Timeout in Sekunden
                 last_data_time = self.time.time()  # Aktuelle Zeit speichern
-                program_running = True  # Zustandsvariable für den Betriebsstatus des Programms
-                adc_values = []  # Eine Liste für ADC-Werte
-
-                while program_running:
-                    if self.ardSer.in_waiting > 0:
-                        header = self.ardSer.readline().decode().strip()
-                        last_data_time = self.time.time()
-
-                        if header == 'DAT':
-                            # Aufruf von read_int_from_serial für die Anzahl der Datenpunkte
-                            num_points = read_int_from_serial(4, signed=True)
-                            for _ in range(num_points):
-                                # Aufruf von read_int_from_serial für ADC-Werte
-                                adc_value = read_int_from_serial(2, signed=True)
-                                adc_values.append(adc_value)
-                                print("ADC-Wert:", adc_value)
-
-                        else:
-                            print(f"Erhaltene Nachricht: {header}")
-
-                    elif (self.time.time() - last_data_time) > timeout_duration:
-                        print("Timeout: Keine Daten empfangen.")
-                        if adc_values:  # Überprüfung, ob Daten vorhanden sind
-                            adc_array = self.np.array(adc_values)  # Konvertiere die Liste in ein NumPy-Array
-                            self.np.save("adc_data.npy", adc_array)
-                            print(f"Daten gespeichert. {len(adc_values)} Werte.")
+                analysis = self.analysis
+                started = self.run_started_at if self.run_started_at is not None else last_data_time
+                header_deadlines = analysis.headerDeadlines() if analysis is not None else None
+                if header_deadlines is not None:
+                    header_deadlines.append(analysis.endDeadline())  # nach dem letzten Block kommt EOP
+                    timeout_duration = float('inf')
+                block = 0  # Nummer des nächsten erwarteten DAT-Blocks
+                self.block_points = []  # Blockgrenzen bleiben für die Echo-Matrix erhalten
+                self.spectrum_phase = None  # neue Messung: Phase wieder von Grund auf suchen
+                downconverter = self.make_downconverter()
+                baseband = []  # Basisband-Teile in Empfangsreihenfolge
+                # Puffergröße aus der Programmanalyse; wächst nur, falls mehr Daten kommen
+                if analysis is not None:
+                    expected = analysis.totalReadings
+                else:
+                    expected = self.program.total_readings if self.program is not None else 0
+                samples = self.np.empty(expected, dtype='<i2')
+                raw = memoryview(samples.view(self.np.uint8))
+                filled = 0  # Anzahl bereits empfangener Werte
+                self.ardSer.timeout = 0.1  # kurz, damit ein Abbruch schnell greift
+                complete = False  # True, sobald EOP empfangen wurde
+
+                while not self.cancel_event.is_set():
+                    if header_deadlines is not None:
+                        line_deadline = started + header_deadlines[min(block, len(header_deadlines) - 1)]
+                    else:
+                        line_deadline = last_data_time + timeout_duration
+                    # vom Timeout zerschnittene Zeilen setzt readLine wieder zusammen (wie in runProgram)
+                    line = anmr_common.readLine(self.ardSer, line_deadline, self.cancel_event.is_set)
+                    if line is None:
+                        if self.cancel_event.is_set():
+                            break
+                        if header_deadlines is not None:
+                            print(f"Timeout: DAT-Block {block + 1} bzw. EOP nicht rechtzeitig empfangen.")
                         else:
-                            print("Keine ADC-Daten zum Speichern.")
-                        program_running = False
-
+                            print("Timeout: Keine Daten empfangen.")
+                        break
+                    last_data_time = self.time.time()
+                    header = line.strip()
+
+                    if header == b'DAT':
+                        count = self.ardSer.read(4)
+                        if len(count) != 4:
+                            print(f"Timeout: Anzahl der Werte nach DAT-Block {block + 1} unvollständig ({len(count)} von 4 Bytes).")
+                            break
+                        num_points = int.from_bytes(count, byteorder='little', signed=True)
+                        if filled + num_points > len(samples):
+                            grown = self.np.empty(max(2 * len(samples), filled + num_points), dtype='<i2')
+                            grown[:filled] = samples[:filled]
+                            samples = grown
+                            raw = memoryview(samples.view(self.np.uint8))
+                        deadline = None
+                        if header_deadlines is not None:
+                            deadline = self.time.time() + analysis.blockDuration(num_points)
+                        got = read_block_into(samples, raw, filled, num_points, expected, deadline, timeout_duration,
+                                              downconverter, baseband)
+                        if downconverter is not None:
+                            # Rest des Blocks; zwischen den Blöcken ist das Signal nicht zusammenhängend
+                            baseband.append(downconverter.flush())
+                        filled += got // 2
+                        block += 1
+                        self.block_points.append(got // 2)
+                        last_data_time = self.time.time()
+                        if got < 2 * num_points:
+                            print(f"Abbruch/Timeout: nur {got // 2} von {num_points} Werten empfangen.")
+                            break
+                    elif header == b'EOP':
+                        complete = True
+                        break
                     else:
-                        print("Warte auf Daten...")
-                        self.time.sleep(0.1)
+                        print(f"Erhaltene Nachricht: {header.decode(errors='replace')}")
+
+                if filled:
+                    adc_array = samples[:filled]
+                    # Rohdaten aller Scans in einer Laufdatei, weitere Scans hängt die Mittelung an
+                    self.run_file = anmr_runfile.create("adc_run.anmr", filled, self.program, self.block_points)
+                    self.run_file.append(adc_array)
+                    print(f"Daten gespeichert. {filled} Werte.")
+                    if downconverter is not None:
+                        self.baseband = anmr_ddc.Baseband(
+                            self.np.concatenate(baseband),
+                            [downconverter.outputPoints(points) for points in self.block_points],
+                            downconverter.frequency, downconverter.outputTimeStep, downconverter.decimation)
+                        self.baseband.save("adc_baseband.npz")
+                        print(f"Basisband gespeichert. {len(self.baseband.samples)} Werte.")
+                else:
+                    print("Keine ADC-Daten zum Speichern.")
+                return complete, samples[:filled]
+
+            def average_remaining_scans(first_scan):
+                """
+                Führt die übrigen Scans mit dem Programm auf dem Arduino aus und mittelt sie
+                (int64-Akkumulator). Der Mittelwert wird alle display_every Scans gemeldet,
+                der Zwischenstand alle checkpoint_every Scans binär gesichert.
+                Mit target_snr wird nach jedem Scan das SNR geschätzt und beendet, sobald es reicht.
+                Bei Programmen mit Phasenzyklus wird jeder Scan vor dem Addieren auf die Phase
+                des ersten Zyklusschritts zurückgedreht.
+                """
+                self.averager = anmr_averaging.makeAverager(self.program)
+                engine = anmr_averaging.AveragingEngine(
+                    self.ardSer, self.program, self.analysis, checkpointFile="adc_average.npz",
+                    displayEvery=self.display_every, checkpointEvery=self.checkpoint_every, runFile=self.run_file)
+                # Scan-Nummer des Arduino für den ersten Scan, bestimmt den Schritt im Phasenzyklus.
+                # Firmware ohne QUERY_PROGRAM nennt sie nicht, bekannt ist sie dann nur direkt nach einer Übertragung
+                resident = anmr_common.queryResidentProgram(self.ardSer)
+                first_scan_num = resident[2] - 1 if resident is not None else self.first_scan_num
+                self.first_scan_num = None
+                if first_scan_num is None and isinstance(self.averager, anmr_averaging.PhaseCycledAverager):
+                    print("Scan-Nummer unbekannt (Firmware ohne QUERY_PROGRAM), mittle ohne Phasenzyklus.")
+                    self.averager = anmr_averaging.Averager(len(first_scan))
+                if first_scan_num is not None:
+                    engine.scanNum = first_scan_num + 1
+                    self.run_file.update(firstScanNum=first_scan_num)
+                self.averager.add(first_scan, first_scan_num)
+
+                def update(averager):
+                    if self.on_progress is not None:
+                        self.on_progress(averager.scans, self.num_scans)
+                    if self.on_average is not None:
+                        self.on_average(averager.mean(), averager.scans, averager.noise())
+
+                def report(estimate):
+                    if self.on_snr is not None:
+                        remaining_scans = -1 if estimate.remainingScans is None else estimate.remainingScans
+                        remaining_time = -1.0 if estimate.remainingTime is None else estimate.remainingTime
+                        self.on_snr(estimate.snr, remaining_scans, remaining_time)
+
+                update(self.averager)
+                frequency = self.program.variables.get("%frequency")
+                if self.target_snr is not None and frequency is None:
+                    print("Kein %frequency im Programm, mittle ohne SNR-Ziel.")
+                if self.target_snr is not None and frequency is not None:
+                    result, estimate = engine.runToSNR(
+                        self.target_snr, frequency, self.num_scans, self.averager, self.snr_confidence,
+                        onEstimate=report, onUpdate=update, cancelEvent=self.cancel_event)
+                    if estimate is not None:
+                        reached = "erreicht" if estimate.remainingScans == 0 else "nicht erreicht"
+                        print(f"SNR {estimate.snr:.1f} nach {estimate.scans} Scans, Ziel {self.target_snr} {reached}")
+                else:
+                    result = engine.run(self.num_scans - 1, self.averager, update, self.cancel_event)
+                print(f"{self.averager.scans} Scans in adc_run.anmr gespeichert, "
+                      f"Rauschen je Scan: {self.averager.noise():.2f}")
+                if self.averager.missing():
+                    print(f"Phasenzyklus unvollständig: es fehlen {self.averager.missing()} Scans "
+                          f"(Zyklus aus {self.program.phase_cycle.length} Scans)")
+                if result is not True:
+                    print(f"Mittelung beendet: {result}")
+                # zwischen zwei Scans abgebrochen: der Arduino sendet nichts mehr
+                return result is True or result == "aborted"
+
+            def save_echo_matrix(data):
+                """
+                Teilt die Daten wieder in ihre DAT-Blöcke (eine Zeile je Echo), mit den
+                Echozeiten aus der Programmanalyse, und speichert sie in adc_echoes.npz.
+                """
+                self.echo_matrix = anmr_echoes.fromScan(data, self.block_points, self.analysis)
+                self.echo_matrix.save("adc_echoes.npz")
+                if len(self.echo_matrix) > 1:
+                    print(f"{len(self.echo_matrix)} Echos zu je {self.echo_matrix.points} Werten.")
 
             print("Daten werden aufgenommen und verarbeitet...")
 
             # Stelle sicher, dass die Funktion wirklich aufgerufen wird
-            read_and_process_adc_data()
+            complete = False
+            data = []
+            try:
+                complete, first_scan = read_and_process_adc_data()
+                data = first_scan
+                if complete and self.num_scans > 1 and self.program is not None:
+                    complete = average_remaining_scans(first_scan)
+                    data = self.averager.mean()
+                    downconverter = self.make_downconverter()
+                    if downconverter is not None and len(data):
+                        # der Mittelwert liegt erst jetzt vor: in einem Stück ins Basisband
+                        self.baseband = anmr_ddc.downconvert(data, self.block_points, downconverter)
+                        self.baseband.save("adc_baseband.npz")
+                if len(data):
+                    save_echo_matrix(data)
+            finally:
+                if self.run_file is not None:
+                    self.run_file.close()
+                    self.run_file = None
+                if not complete and self.session is not None:
+                    # Arduino sendet evtl. noch Daten: beim nächsten Lauf neu verbinden
+                    self.session.invalidate()
 
         except Exception as e:
-            return f"Fehler während der Datenaufnahme: {e}"
-
-        finally:
-            self.ardSer.close()
-            return "Datenaufnahme und Verarbeitung abgeschlossen" "\n" "Serielle Verbindung geschlossen nach ADC-Wertewiedergabe."
+            return StepError(f"Fehler während der Datenaufnahme: {e}")
+
+        if not len(data):
+            return StepError("Fehler während der Datenaufnahme: keine ADC-Daten empfangen.")
+        if not complete:
+            return "Datenaufnahme unvollständig (Abbruch oder Timeout), die empfangenen Daten sind gespeichert."
+        return "Datenaufnahme und Verarbeitung abgeschlossen" "\n" "Serielle Verbindung bleibt für den nächsten Lauf geöffnet."
+
+    def correct_spectra(self, spectra, live=False):
+        """
+        Verarbeitung nach der FFT für ein komplexes Spektrum oder mehrere als Zeilen: automatische
+        Phasenkorrektur (0. und 1. Ordnung) und Abzug einer Polynom-Basislinie, gibt den Realteil
+        zurück. Ohne phase_correction nur den Betrag. live: nur von der letzten Phase aus
+        verfeinern, schnell genug für die Anzeige während der Mittelung.
+        """
+        if not self.phase_correction:
+            return self.np.abs(spectra)
+        start = self.spectrum_phase[1] if live and self.spectrum_phase is not None else None
+        phased, phi0, phi1 = anmr_spectrum.autoPhase(spectra, phi1Start=start)
+        if self.np.ndim(phi0) == 0:
+            self.spectrum_phase = (float(phi0), float(phi1))
+        return phased.real - anmr_spectrum.baseline(phased.real, self.baseline_order)
+
+    def process_spectrum(self, samples, live=False, **options):
+        """
+        FFT (anmr_spectrum) mit anschließender Korrektur, gibt (Frequenzen, Spektren) zurück.
+        options gehen an anmr_spectrum.spectrum, z.B. timeStep und centre für Basisband-Daten.
+        """
+        freqs, spectra = anmr_spectrum.spectrum(samples, self.spectrum_window, self.line_broadening, **options)
+        return freqs, self.correct_spectra(spectra, live)
+
+    def make_downconverter(self):
+        """anmr_ddc.Downconverter bei %frequency mit downconvert als Dezimationsfaktor, None wenn aus."""
+        frequency = self.program.variables.get("%frequency") if self.program is not None else None
+        if not self.downconvert or frequency is None:
+            return None
+        return anmr_ddc.Downconverter(frequency, self.downconvert)
 
     def step_visualize_results(self):
         try:
-            data = self.np.load('adc_data.npy')
+            if os.path.exists("adc_run.anmr"):
+                run = anmr_runfile.load("adc_run.anmr")
+                # Kopie statt Ansicht in die memmap, sonst bliebe die Datei für den nächsten Lauf offen
+                data = self.np.array(run.scans[0]) if len(run) == 1 else run.mean()
+            else:
+                data = self.np.load('adc_data.npy')  # Läufe aus der Zeit vor adc_run.anmr
+            data.flags.writeable = False  # geht ohne Kopie bis in die Diagramme
 
-            # Daten für Diagramm 1
+            # Daten für Diagramm 1 (NumPy-Arrays, keine Listen)
             adc_plot = {
-                "x": list(range(len(data))),
-                "y": data.tolist(),
+                "x": self.np.arange(len(data)),
+                "y": data,
                 "title": "ADC Data",
                 "xlabel": "Measurement No.",
                 "ylabel": "ADC Value"
             }
 
-            # Daten für Diagramm 2 (FFT)
-            sampling_rate = 9615.0
-            N = len(data)
-            yf = self.fft(data)
-            xf = self.fftfreq(N, 1 / sampling_rate)
-            fft_plot = {
-                "x": xf[:N // 2].tolist(),
-                "y": self.np.abs(yf[:N // 2]).tolist(),
-                "title": "Frequency Spectrum",
-                "xlabel": "Frequency (Hz)",
-                "ylabel": "Amplitude"
-            }
+            # Mehrere DAT-Blöcke (Echos): Spektrum je Echo statt über die aneinandergehängten Blöcke
+            echoes = None
+            if os.path.exists("adc_echoes.npz"):
+                echoes = anmr_echoes.load("adc_echoes.npz")
+                if echoes.lengths.sum() != len(data):
+                    echoes = None  # gehört nicht zu diesen Daten
+
+            if echoes is not None and len(echoes) > 1:
+                # Daten für Diagramm 2 (Summe der Echo-Spektren)
+                fft_plot = {
+                    "x": echoes.frequencies(),
+                    "y": echoes.summedSpectrum(self.spectrum_window, self.line_broadening),  # Echos liegen mitten im Block: Betrag
+                    "title": f"Frequency Spectrum (Summe über {len(echoes)} Echos)",
+                    "xlabel": "Frequency (Hz)",
+                    "ylabel": "Amplitude"
+                }
+                # Daten für Diagramm 3 (Echo-Amplituden: Spektrallinie je Echo, rauschärmer als das Maximum der Einhüllenden)
+                frequency = self.program.variables.get("%frequency") if self.program is not None else None
+                amplitudes, line_frequencies = echoes.spectralPeaks(frequency)
+                echo_plot = {
+                    "x": echoes.times if echoes.times is not None else self.np.arange(len(echoes)),
+                    "y": amplitudes,
+                    "title": "Echo Amplitudes",
+                    "xlabel": "Echo Time (s)" if echoes.times is not None else "Echo No.",
+                    "ylabel": "Amplitude"
+                }
+                plots = [adc_plot, fft_plot, echo_plot]
+            else:
+                # Daten für Diagramm 2 (FFT: Offset weg, Fenster, Zero-Filling, rfft, Frequenzen aus TIME_STEP)
+                baseband = None
+                if self.downconvert and os.path.exists("adc_baseband.npz"):
+                    baseband = anmr_ddc.load("adc_baseband.npz")
+                    if sum(baseband.blockPoints) != -(-len(data) // baseband.decimation):
+                        baseband = None  # gehört nicht zu diesen Daten
+                if baseband is not None:
+                    # Basisband: um den Dezimationsfaktor weniger Werte für FFT und Diagramm
+                    xf, yf = self.process_spectrum(baseband.samples, timeStep=baseband.timeStep, centre=baseband.frequency)
+                else:
+                    xf, yf = self.process_spectrum(data)
+                fft_plot = {
+                    "x": xf,
+                    "y": yf,
+                    "title": "Frequency Spectrum",
+                    "xlabel": "Frequency (Hz)",
+                    "ylabel": "Amplitude"
+                }
+                plots = [adc_plot, fft_plot]
 
             stats = (
                 f"Min Value: {self.np.min(data)}\n"
                 f"Max Value: {self.np.max(data)}\n"
                 f"Mean Value: {self.np.mean(data)}"
             )
+            if echoes is not None and len(echoes) > 1:
+                stats += f"\nEchos: {len(echoes)}"
+                if echoes.times is not None and len(echoes) > 2:
+                    # T2 aus den Echo-Amplituden (monoexponentiell)
+                    t2_fit = anmr_fitting.fitDecay(echoes.times, amplitudes)
+                    if t2_fit.converged[0]:
+                        stats += f"\nT2: {t2_fit.value('T2')[0]:.4g} s ± {t2_fit.error('T2')[0]:.2g} s"
+            if self.phase_correction and self.spectrum_phase is not None:
+                stats += f"\nPhase: {self.spectrum_phase[0]:.1f}° + {self.spectrum_phase[1]:.1f}° (0. + 1. Ordnung)"
 
             print("Visualisierung abgeschlossen." "\n" + stats)
 
             return {
                 "Visualisierung abgeschlossen." "\n" "stats": stats,
-                "plots": [adc_plot, fft_plot]
+                "plots": plots
             }
         except Exception as e:
-            return {
-                "stats": f"Fehler bei der Visualisierung: {e}",
-                "plots": []
-            }
\ No newline at end of file
+            return StepError(f"Fehler bei der Visualisierung: {e}")
\ No newline at end of file
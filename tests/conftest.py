@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# the anmr_* modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def ardSer():
+    # a serial port to an anmr_emulator.ArduinoEmulator running without delays
+    serial = pytest.importorskip('serial')
+    import anmr_emulator
+    if not hasattr(os, 'openpty'):
+        pytest.skip("the emulator needs a pty")
+    emulator = anmr_emulator.ArduinoEmulator(timeScale=0.0, seed=1)
+    port = serial.Serial(emulator.start(), 1000000)
+    yield port
+    port.close()
+    emulator.stop()
@@ -0,0 +1,81 @@
+import struct
+
+import numpy
+import pytest
+
+import anmr_analyzer
+import anmr_async
+import anmr_common
+import anmr_compiler
+import anmr_sweep
+
+BLOCKS = [numpy.arange(-5, 5, dtype='<i2'), numpy.array([], dtype='<i2'), numpy.array([32767, -32768], dtype='<i2')]
+
+
+def stream():
+    data = b'Executing instructions\r\n'
+    for block in BLOCKS:
+        data += b'DAT\r\n' + struct.pack('<i', len(block)) + block.tobytes()
+    return data + b'DEB\r\n' + struct.pack('<H', 513) + b'EOP\r\n'
+
+
+def check(frames):
+    assert frames[0] == ('line', b'Executing instructions')
+    assert [kind for kind, value in frames] == ['line', 'dat', 'dat', 'dat', 'deb', 'eop']
+    for (kind, samples), block in zip(frames[1:4], BLOCKS):
+        numpy.testing.assert_array_equal(samples, block)
+    assert frames[4] == ('deb', 513)
+
+
+def feedAll(pieces):
+    parser = anmr_async.FrameParser()
+    frames = []
+    for piece in pieces:
+        frames += parser.feed(piece)
+    return frames
+
+
+def test_whole_stream():
+    check(feedAll([stream()]))
+
+
+@pytest.mark.parametrize('cut', range(1, len(stream())))
+def test_stream_cut_anywhere(cut):
+    # this includes lines cut before their '\n', counts and samples cut in two
+    data = stream()
+    check(feedAll([data[:cut], data[cut:]]))
+
+
+def test_byte_by_byte_and_random_pieces():
+    data = stream()
+    check(feedAll([data[i:i + 1] for i in range(len(data))]))
+    cuts = sorted(numpy.random.default_rng(3).choice(numpy.arange(1, len(data)), 12, replace=False))
+    check(feedAll([data[a:b] for a, b in zip([0] + cuts, cuts + [len(data)])]))
+
+
+FID = """PULSE_PROGRAM
+%frequency = 2153
+SET_FREQ %frequency
+PULSE 0 0 1 6
+READ_DATA 0 0 1 64
+DELAY_IN_MS 2
+READ_DATA 0 0 1 32
+"""
+
+
+def test_run_program_on_the_emulator(ardSer):
+    program = anmr_compiler.compile_source(FID)
+    assert anmr_common.sendProgram(program, ardSer) is True
+    data = anmr_async.runProgram(ardSer, 3, anmr_analyzer.analyze(program.prog))
+    assert data.dtype == numpy.int64 and data.size == 96
+    assert anmr_async.runProgram(ardSer, 1, cancelled=lambda: True) is None
+
+
+def test_sweep_measures_through_the_async_transport(ardSer, monkeypatch):
+    assert anmr_async.available(ardSer)
+    calls = []
+    runProgram = anmr_async.runProgram
+    monkeypatch.setattr(anmr_async, 'runProgram', lambda *args, **kw: calls.append(args) or runProgram(*args, **kw))
+    runner = anmr_sweep.SweepRunner(FID, anmr_sweep.Sweep([('frequency', [2100, 2200])]), ardSer, scans=2)
+    assert runner.run() is True
+    assert len(calls) == 2 and list(runner.lengths) == [96, 96]
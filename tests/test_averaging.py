@@ -0,0 +1,133 @@
+import os
+import threading
+
+import numpy
+import pytest
+
+import anmr_averaging
+import anmr_compiler
+import anmr_runfile
+
+FID = """PULSE_PROGRAM
+%frequency = 2153
+SET_FREQ %frequency
+PULSE 0 0 1 6
+DELAY_IN_MS 5
+READ_DATA 0 0 1 1024
+"""
+
+
+def test_variance_survives_many_scans():
+    # 10^7 scans of +-512: n * sumSq no longer fits in int64
+    averager = anmr_averaging.Averager(2)
+    averager.scans = 10 ** 7
+    averager.sum[:] = [512 * averager.scans // 2, 0]
+    averager.sumSq[:] = [512 * 512 * averager.scans // 2, 512 * 512 * averager.scans]
+    numpy.testing.assert_allclose(averager.variance(), [512 * 512 / 4, 512 * 512], rtol=1e-6)
+
+
+def test_variance_matches_numpy():
+    scans = numpy.random.default_rng(1).integers(-512, 512, (50, 16))
+    averager = anmr_averaging.Averager(16)
+    for scan in scans:
+        averager.add(scan)
+    numpy.testing.assert_allclose(averager.variance(), scans.var(axis=0, ddof=1))
+    numpy.testing.assert_array_equal(averager.mean(), scans.mean(axis=0))
+
+
+def test_run_to_snr_keeps_display_and_checkpoint_intervals(ardSer, tmp_path, monkeypatch):
+    program = anmr_compiler.compile_source(FID)
+    engine = anmr_averaging.AveragingEngine(ardSer, program, checkpointFile=str(tmp_path / 'average.npz'),
+                                            displayEvery=5, checkpointEvery=5)
+    updates = []
+    saves = []
+    estimates = []
+    monkeypatch.setattr(anmr_averaging.Averager, 'save', lambda averager, fileName: saves.append(averager.scans))
+    result, estimate = engine.runToSNR(1e9, 2153, 12, onEstimate=estimates.append,
+                                       onUpdate=lambda averager: updates.append(averager.scans))
+    assert result is True
+    assert engine.averager.scans == 12
+    assert updates == [5, 10, 12]
+    assert saves == [5, 10, 12]
+    assert len(estimates) == 11 and estimate is estimates[-1]
+
+
+def test_estimate_without_bins_is_nan():
+    snr, noiseBins = anmr_averaging.estimateSNR(numpy.ones(8), 2153)
+    assert numpy.isnan(snr) and noiseBins == 0
+    assert anmr_averaging.SNREstimate(snr, snr, noiseBins, 5, 10.0, 0.1).remainingScans is None
+
+
+def test_run_to_snr_without_bins_runs_all_scans(ardSer, capsys):
+    # 100 kHz is far above what the samples can show: no signal band
+    engine = anmr_averaging.AveragingEngine(ardSer, anmr_compiler.compile_source(FID))
+    result, estimate = engine.runToSNR(10.0, 100000, 6)
+    assert result is True
+    assert engine.averager.scans == 6
+    assert numpy.isnan(estimate.snr) and estimate.remainingScans is None
+    assert 'no spectrum points' in capsys.readouterr().out
+
+
+def test_engine_adds_every_scan_once(ardSer, tmp_path):
+    program = anmr_compiler.compile_source(FID)
+    checkpoint = str(tmp_path / 'average.npz')
+    with anmr_runfile.create(str(tmp_path / 'run.anmr'), program.total_readings, program) as runFile:
+        engine = anmr_averaging.AveragingEngine(ardSer, program, checkpointFile=checkpoint, displayEvery=3,
+                                                runFile=runFile)
+        updates = []
+        assert engine.run(4, onUpdate=lambda averager: updates.append(averager.scans)) is True
+        # the program is still on the arduino: the next run goes on from scan 4
+        assert engine.run(3, engine.averager) is True
+    assert updates == [3, 4]
+    run = anmr_runfile.load(str(tmp_path / 'run.anmr'))
+    assert len(run) == 7 and run.header['firstScanNum'] == 0 and not run.header.get('scanNumJumps')
+    assert engine.scanNum == 7
+    numpy.testing.assert_allclose(engine.averager.mean(), run.scans.mean(axis=0))
+    saved = anmr_averaging.Averager.load(checkpoint)
+    assert saved.scans == 7
+    numpy.testing.assert_array_equal(saved.sum, engine.averager.sum)
+
+
+def test_engine_stops_when_cancelled(ardSer):
+    engine = anmr_averaging.AveragingEngine(ardSer, anmr_compiler.compile_source(FID))
+    cancelEvent = threading.Event()
+    result = engine.run(50, onUpdate=lambda averager: cancelEvent.set(), cancelEvent=cancelEvent)
+    assert result == "aborted"
+    assert engine.averager.scans == engine.displayEvery
+
+
+def test_estimate_snr_of_a_tone():
+    # a tone of amplitude a in white noise of sigma: peak a n / 2 against noise rms sigma sqrt(n)
+    rng = numpy.random.default_rng(4)
+    t = numpy.arange(4096) * anmr_averaging.anmr_common.TIME_STEP
+    snrs = [anmr_averaging.estimateSNR(5.0 * numpy.cos(2 * numpy.pi * 2153 * t) + rng.normal(0, 20.0, len(t)),
+                                       2153)[0] for i in range(20)]
+    assert numpy.mean(snrs) == pytest.approx(5.0 * numpy.sqrt(4096) / 2 / 20.0, rel=0.15)
+
+
+def test_remaining_scans_grow_with_the_square_of_the_snr():
+    estimate = anmr_averaging.SNREstimate(5.0, 5.0, 100, 4, 10.0, 2.0)
+    assert estimate.remainingScans == 12 and estimate.remainingTime == 24.0
+    assert anmr_averaging.SNREstimate(12.0, 11.0, 100, 4, 10.0, 2.0).remainingScans == 0
+    assert anmr_averaging.SNREstimate(0.0, -1.0, 100, 4, 10.0, 2.0).remainingScans is None
+
+
+def test_run_to_snr_stops_once_reached():
+    # a weak signal, so the SNR grows with the scans (the fixture's is limited by the FID itself)
+    serial = pytest.importorskip('serial')
+    import anmr_emulator
+    if not hasattr(os, 'openpty'):
+        pytest.skip("the emulator needs a pty")
+    emulator = anmr_emulator.ArduinoEmulator(timeScale=0.0, seed=1, noise=40.0, amplitude=20.0)
+    ardSer = serial.Serial(emulator.start(), 1000000)
+    try:
+        engine = anmr_averaging.AveragingEngine(ardSer, anmr_compiler.compile_source(FID))
+        first, estimate = engine.runToSNR(1e9, 2153, 2)
+        target = 2 * estimate.snr  # about 4 times the scans
+        result, estimate = engine.runToSNR(target, 2153, 200, engine.averager)
+    finally:
+        ardSer.close()
+        emulator.stop()
+    assert result is True
+    assert estimate.snr >= target and estimate.remainingScans == 0
+    assert 2 < engine.averager.scans < 50
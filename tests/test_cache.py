@@ -0,0 +1,66 @@
+import os
+import threading
+
+import pytest
+
+import anmr_cache
+import anmr_common
+import anmr_compiler
+import anmr_sweep
+
+ECHO = """PULSE_PROGRAM
+%echo_delay = 20
+%frequency = 2153
+SET_FREQ %frequency
+PULSE 0 0 1 6
+DELAY_IN_MS %echo_delay
+PULSE 0 0 1 12
+READ_DATA 0 0 1 256
+"""
+
+
+def test_disk_hit_can_be_patched(tmp_path):
+    anmr_cache.ProgramCache(cacheDir=str(tmp_path)).get(ECHO)
+    cache = anmr_cache.ProgramCache(cacheDir=str(tmp_path))
+    program = cache.get(ECHO)
+    assert cache.stats()['hits'] == 1
+    assert program.relocations == anmr_compiler.compile_source(ECHO).relocations
+    patched = anmr_sweep.ProgramPatcher(program).patch({'%echo_delay': 40})
+    assert bytes(patched.prog) == bytes(anmr_compiler.compile_source(ECHO, {'%echo_delay': 40}).prog)
+
+
+def test_key_changes_with_the_compiler(monkeypatch):
+    key = anmr_cache.programKey(ECHO)
+    monkeypatch.setattr(anmr_compiler, 'COMPILER_VERSION', anmr_compiler.COMPILER_VERSION + 1)
+    assert anmr_cache.programKey(ECHO) != key
+
+
+@pytest.mark.parametrize('damage', [lambda text: text[:len(text) // 2], lambda text: '[1, 2]',
+                                    lambda text: text.replace('"prog": "', '"prog": 7, "x": "')])
+def test_damaged_entry_is_a_miss(tmp_path, damage):
+    anmr_cache.ProgramCache(cacheDir=str(tmp_path)).get(ECHO)
+    entry = os.path.join(str(tmp_path), anmr_cache.programKey(ECHO) + '.json')
+    with open(entry) as f:
+        text = f.read()
+    with open(entry, 'w') as f:
+        f.write(damage(text))
+    cache = anmr_cache.ProgramCache(cacheDir=str(tmp_path))
+    assert bytes(cache.get(ECHO).prog) == bytes(anmr_compiler.compile_source(ECHO).prog)
+    assert cache.stats()['misses'] == 1
+
+
+def test_writers_in_threads_use_their_own_temporary_file(tmp_path):
+    names = []
+    thread = threading.Thread(target=lambda: names.append(anmr_common.tempName('entry.json')))
+    thread.start()
+    thread.join()
+    assert names[0] != anmr_common.tempName('entry.json')
+    # and the entry of many threads storing the same key at once comes out whole
+    threads = [threading.Thread(target=anmr_cache.ProgramCache(cacheDir=str(tmp_path)).get, args=(ECHO,))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert anmr_cache.ProgramCache(cacheDir=str(tmp_path))._load(anmr_cache.programKey(ECHO)) is not None
+    assert [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')] == []
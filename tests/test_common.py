@@ -0,0 +1,45 @@
+import time
+
+import anmr_common
+
+
+class PiecesSerial:
+    # readline() returning what arrived before the timeout, a piece at a time
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+
+    def readline(self):
+        return self.pieces.pop(0) if self.pieces else b''
+
+
+def test_read_line_joins_pieces():
+    ardSer = PiecesSerial([b'DA', b'', b'T\n', b'EOP\n'])
+    assert anmr_common.readLine(ardSer, time.time() + 5) == b'DAT\n'
+    assert anmr_common.readLine(ardSer, time.time() + 5) == b'EOP\n'
+
+
+def test_read_line_timeout_and_cancel():
+    assert anmr_common.readLine(PiecesSerial([b'DA']), time.time() - 1) is None
+    assert anmr_common.readLine(PiecesSerial([b'DAT\n']), time.time() + 5, lambda: True) is None
+
+
+class SilentSerial(PiecesSerial):
+    # an arduino that started the program and then sends nothing, eg. in a WAIT_FOR_PIN
+    timeout = None
+
+    def __init__(self):
+        super().__init__([b'Executing\r\n'])
+
+    def flushInput(self):
+        pass
+
+    def write(self, data):
+        pass
+
+
+def test_run_program_cancelled_mid_scan(monkeypatch):
+    monkeypatch.setattr(anmr_common, 'ardSer', SilentSerial(), raising=False)
+    stopAt = time.time() + 0.2
+    result, data = anmr_common.runProgram(None, None, 0, cancelled=lambda: time.time() > stopAt)
+    assert result == "aborted" and data is None
+    assert time.time() - stopAt < 5
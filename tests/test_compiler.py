@@ -0,0 +1,62 @@
+import os
+import threading
+
+import pytest
+
+import anmr_compiler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the shipped programs, with what compile() of the baseline wrote for them
+SHIPPED = ['CommandFullEchoKorrekt.txt', 'CommandFullEchoKorrekt2.0']
+
+
+def source(name):
+    with open(os.path.join(ROOT, name)) as inFile:
+        return inFile.read()
+
+
+def baseline(name):
+    with open(os.path.join(ROOT, 'tests', 'data', name + '.out')) as inFile:
+        return inFile.read()
+
+
+@pytest.mark.parametrize('name', SHIPPED)
+def test_text_output_unchanged(name):
+    assert anmr_compiler.compile_source(source(name)).toText() == baseline(name)
+
+
+@pytest.mark.parametrize('name', SHIPPED)
+def test_compile_writes_the_old_text_file(name, tmp_path):
+    outName = str(tmp_path / 'prog.txt')
+    assert anmr_compiler.compile(os.path.join(ROOT, name), outName, textFormat=True) is True
+    with open(outName) as outFile:
+        assert outFile.read() == baseline(name)
+
+
+def test_overrides_apply_to_one_call_only():
+    text = source(SHIPPED[0])
+    changed = anmr_compiler.compile_source(text, {'frequency': 2000})
+    assert changed.variables['%frequency'] == 2000
+    assert changed.toText() != baseline(SHIPPED[0])
+    assert anmr_compiler.compile_source(text).toText() == baseline(SHIPPED[0])
+
+
+def test_compiles_in_parallel_threads():
+    results = {}
+
+    def work(name):
+        results[name] = [anmr_compiler.compile_source(source(name)).toText() for i in range(20)]
+
+    threads = [threading.Thread(target=work, args=(name,)) for name in SHIPPED]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for name in SHIPPED:
+        assert results[name] == [baseline(name)] * 20
+
+
+@pytest.mark.parametrize('frequency', [0, -2153])
+def test_set_freq_must_be_positive(frequency):
+    with pytest.raises(anmr_compiler.CompileError):
+        anmr_compiler.compile_source("PULSE_PROGRAM\nSET_FREQ " + str(frequency) + "\n")
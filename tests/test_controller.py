@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('serial')
+pytest.importorskip('PyQt5')
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtCore import QTimer  # noqa: E402
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+
+import controller  # noqa: E402
+import models  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+class View:
+    def __init__(self):
+        self.output = []
+
+    def update_output(self, text):
+        self.output.append(text)
+
+    def update_progress(self, received, expected):
+        pass
+
+
+class StepModel:
+    # the parts of models.ExperimentModel the controller uses, with steps
+    # that only record the thread they ran in
+    def __init__(self, slow=0.0, fail=None, deaf=False):
+        self.slow = slow
+        self.fail = fail
+        self.deaf = deaf  # True: the steps don't notice cancel_event
+        self.threads = []
+        self.cancel_event = threading.Event()
+        self.current_step = 0
+        self.num_scans = 1
+        self.analysis = None
+        self.steps = [self.step_compile_command_list, self.step_check_arduino_readiness,
+                      self.step_start_experiment]
+
+    def get_step_index(self, step_name):
+        names = [step.__name__ for step in self.steps]
+        return names.index(step_name) if step_name in names else -1
+
+    def _step(self, name):
+        self.threads.append(threading.get_ident())
+        deadline = time.time() + self.slow
+        while time.time() < deadline and (self.deaf or not self.cancel_event.is_set()):
+            time.sleep(0.01)
+        if name == self.fail:
+            return models.StepError("kaputt")
+        return name + " erfolgreich."
+
+    def step_compile_command_list(self):
+        return self._step('step_compile_command_list')
+
+    def step_check_arduino_readiness(self):
+        return self._step('step_check_arduino_readiness')
+
+    def step_start_experiment(self):
+        return self._step('step_start_experiment')
+
+
+def wait_for(app, condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+    return condition()
+
+
+def test_steps_run_in_the_background_one_after_the_other(app):
+    model = StepModel(slow=0.2)
+    ctl = controller.ExperimentController(model, View())
+    ticks = []
+    timer = QTimer()
+    timer.timeout.connect(lambda: ticks.append(time.time()))
+    timer.start(10)
+    ctl.run_until_start_experiment()
+    assert wait_for(app, lambda: model.current_step == 3 and not ctl.is_step_running())
+    timer.stop()
+    assert len(model.threads) == 3 and threading.get_ident() not in model.threads
+    # the event loop kept running while the steps did
+    assert len(ticks) > 20
+    assert any('Vorbereitung abgeschlossen' in line for line in ctl.view.output)
+
+
+def test_a_failed_step_stops_the_sequence(app):
+    model = StepModel(fail='step_check_arduino_readiness')
+    ctl = controller.ExperimentController(model, View())
+    ctl.run_until_start_experiment()
+    assert wait_for(app, lambda: ctl.target_step is None and not ctl.is_step_running())
+    app.processEvents()
+    assert model.current_step == 1 and len(model.threads) == 2
+    assert any('Fehler bei Schritt 2: kaputt' in line for line in ctl.view.output)
+
+
+def test_a_step_that_outlives_stop_worker_blocks_the_next(app):
+    model = StepModel(slow=0.5, deaf=True)
+    ctl = controller.ExperimentController(model, View())
+    ctl.STOP_WAIT_MS = 50
+    ctl.execute_next_step()
+    assert wait_for(app, lambda: model.threads)
+    started = time.time()
+    ctl.stop_worker()
+    assert time.time() - started < 0.4
+    assert ctl.worker is None and len(ctl.stopping_workers) == 1
+    ctl.execute_next_step()
+    assert len(model.threads) == 1 and 'Der vorherige Schritt läuft noch.' in ctl.view.output
+    # once it has ended the next step may start, and its result never arrived
+    assert wait_for(app, lambda: not ctl.stopping_workers)
+    assert model.current_step == 0
@@ -0,0 +1,70 @@
+import numpy
+import pytest
+
+import anmr_common
+import anmr_ddc
+
+FREQUENCY = 2153.0
+
+
+def tone(offset, points=1024, amplitude=100.0, phase=0.3):
+    t = numpy.arange(points) * anmr_common.TIME_STEP
+    return amplitude * numpy.cos(2 * numpy.pi * (FREQUENCY + offset) * t + phase)
+
+
+def whole(ddc, samples):
+    return numpy.concatenate((ddc.process(samples), ddc.flush()))
+
+
+def test_tone_comes_out_at_its_offset():
+    ddc = anmr_ddc.Downconverter(FREQUENCY, decimation=8)
+    baseband = whole(ddc, tone(120.0))
+    assert len(baseband) == ddc.outputPoints(1024) == 128
+    # away from the ends of the block: A e^(i (2 pi offset t + phase)) at the input sample's time
+    middle = numpy.arange(8, 120)
+    t = middle * ddc.outputTimeStep
+    numpy.testing.assert_allclose(baseband[middle], 100.0 * numpy.exp(1j * (2 * numpy.pi * 120.0 * t + 0.3)),
+                                  atol=1.0)
+
+
+def test_carrier_harmonics_are_filtered_out():
+    ddc = anmr_ddc.Downconverter(FREQUENCY, decimation=8)
+    # 2 kHz off the carrier is far beyond the 480 Hz passband
+    assert numpy.abs(whole(ddc, tone(2000.0))[8:120]).max() < 1.0
+    assert numpy.abs(whole(ddc, numpy.full(1024, 50.0))[8:120]).max() < 1.0
+
+
+@pytest.mark.parametrize('sizes', [[1024], [1, 7, 200, 816], [3] * 341 + [1], [100, 0, 924]])
+def test_chunks_give_the_same_as_the_whole_block(sizes):
+    samples = tone(-60.0) + numpy.random.default_rng(3).normal(0, 5, 1024)
+    expected = whole(anmr_ddc.Downconverter(FREQUENCY, decimation=8), samples)
+    ddc = anmr_ddc.Downconverter(FREQUENCY, decimation=8)
+    chunks = numpy.split(samples, numpy.cumsum(sizes)[:-1])
+    out = numpy.concatenate([ddc.process(chunk) for chunk in chunks] + [ddc.flush()])
+    numpy.testing.assert_allclose(out, expected, atol=1e-9)
+    # flush starts the next block afresh
+    numpy.testing.assert_allclose(whole(ddc, samples), expected, atol=1e-9)
+
+
+@pytest.mark.parametrize('decimation', [1, 4, 5, 16])
+def test_output_points(decimation):
+    ddc = anmr_ddc.Downconverter(FREQUENCY, decimation=decimation)
+    for points in (1, 99, 100, 512):
+        assert len(whole(ddc, numpy.zeros(points))) == ddc.outputPoints(points)
+    assert ddc.outputTimeStep == pytest.approx(decimation * anmr_common.TIME_STEP)
+
+
+def test_downconvert_treats_each_block_on_its_own(tmp_path):
+    blocks = [tone(100.0, 512), tone(100.0, 256)]
+    ddc = anmr_ddc.Downconverter(FREQUENCY, decimation=4)
+    baseband = anmr_ddc.downconvert(numpy.concatenate(blocks), [512, 256], ddc)
+    assert baseband.blockPoints == [128, 64]
+    numpy.testing.assert_allclose(baseband.samples[128:], whole(ddc, blocks[1]), atol=1e-9)
+    assert baseband.frequency == FREQUENCY and baseband.timeStep == ddc.outputTimeStep
+    with pytest.raises(ValueError):
+        anmr_ddc.downconvert(numpy.zeros(10), [4, 4], ddc)
+    fileName = str(tmp_path / 'baseband.npz')
+    baseband.save(fileName)
+    loaded = anmr_ddc.load(fileName)
+    assert loaded.blockPoints == [128, 64] and loaded.decimation == 4
+    numpy.testing.assert_allclose(loaded.samples, baseband.samples, rtol=1e-6)
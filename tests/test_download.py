@@ -0,0 +1,29 @@
+import os
+import time
+
+import anmr_common
+import anmr_compiler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def download(ardSer, fileName, chunkSize, times=5):
+    start = time.perf_counter()
+    for i in range(times):
+        assert anmr_common.downloadProgram(fileName, ardSer, chunkSize) is True
+    return (time.perf_counter() - start) / times
+
+
+def test_chunked_download_against_byte_by_byte(ardSer, tmp_path):
+    # the benchmark of the chunked download: both ways pass the checksum check,
+    # the chunks without the 150 us sleep after every byte
+    with open(os.path.join(ROOT, 'CommandFullEchoKorrekt.txt')) as inFile:
+        program = anmr_compiler.compile_source(inFile.read())
+    fileName = str(tmp_path / 'prog.bin')
+    anmr_compiler.writeProgram(program, fileName)
+    byteTime = download(ardSer, fileName, 1)
+    chunkTime = download(ardSer, fileName, anmr_common.DOWNLOAD_CHUNK)
+    print('download of', len(program), 'bytes: byte by byte', round(byteTime * 1000, 1), 'ms, in chunks',
+          round(chunkTime * 1000, 1), 'ms')
+    assert chunkTime < byteTime
+    assert anmr_common.residentPrograms[anmr_common._deviceKey(ardSer)] == (program.checksum1, program.checksum2)
@@ -0,0 +1,84 @@
+import numpy
+import pytest
+
+import anmr_analyzer
+import anmr_common
+import anmr_compiler
+import anmr_echoes
+
+CPMG = """PULSE_PROGRAM
+SET_FREQ 2153
+PULSE 0 0 1 6
+DELAY_IN_MS 2
+PULSE 0 0 1 12
+READ_DATA 0 0 1 64
+DELAY_IN_MS 2
+PULSE 0 0 1 12
+READ_DATA 0 0 1 64
+DELAY_IN_MS 2
+PULSE 0 0 1 12
+READ_DATA 0 0 1 64
+"""
+
+
+def echo(points, amplitude, centre, frequency=2000.0):
+    # a gaussian echo on a 2000 Hz carrier, centred on point centre
+    t = (numpy.arange(points) - centre) * anmr_common.TIME_STEP
+    return amplitude * numpy.exp(-(t / (6 * anmr_common.TIME_STEP)) ** 2) * numpy.cos(2 * numpy.pi * frequency * t)
+
+
+def test_equal_blocks_are_a_view_of_the_scan():
+    samples = numpy.arange(12)
+    echoes = anmr_echoes.fromScan(samples, [4, 4, 4])
+    assert len(echoes) == 3 and echoes.points == 4
+    numpy.testing.assert_array_equal(echoes.echoes[1], [4, 5, 6, 7])
+    assert echoes.times is None
+
+
+def test_shorter_blocks_are_padded():
+    echoes = anmr_echoes.fromScan(numpy.arange(1, 8), [4, 2, 1])
+    numpy.testing.assert_array_equal(echoes.echoes, [[1, 2, 3, 4], [5, 6, 0, 0], [7, 0, 0, 0]])
+    numpy.testing.assert_array_equal(echoes.lengths, [4, 2, 1])
+    # the padding doesn't shift the offset taken off each row
+    numpy.testing.assert_allclose(echoes._centred()[1], [-0.5, 0.5, 0, 0])
+
+
+def test_sample_count_must_match_the_blocks():
+    with pytest.raises(ValueError):
+        anmr_echoes.fromScan(numpy.arange(10), [4, 4])
+
+
+def test_times_come_from_a_matching_analysis():
+    analysis = anmr_analyzer.analyze(anmr_compiler.compile_source(CPMG).prog)
+    echoes = anmr_echoes.fromScan(numpy.zeros(192), [64, 64, 64], analysis)
+    numpy.testing.assert_allclose(echoes.times, analysis.echoTimes())
+    assert numpy.all(numpy.diff(echoes.times) > 0)
+    assert anmr_echoes.fromScan(numpy.zeros(192), [96, 96], analysis).times is None
+
+
+def test_peaks_follow_the_echo_amplitudes():
+    amplitudes = [800.0, 400.0, 200.0]
+    centres = [30, 32, 34]
+    samples = numpy.concatenate([echo(64, a, c) for a, c in zip(amplitudes, centres)]) + 2048
+    echoes = anmr_echoes.fromScan(samples, [64] * 3)
+    heights, positions = echoes.peaks()
+    numpy.testing.assert_allclose(heights, amplitudes, rtol=0.05)
+    numpy.testing.assert_allclose(positions, numpy.array(centres) * anmr_common.TIME_STEP, atol=1.5 * anmr_common.TIME_STEP)
+    magnitudes, frequencies = echoes.spectralPeaks(2000.0)
+    assert numpy.all(numpy.abs(frequencies - 2000.0) < 1 / (64 * anmr_common.TIME_STEP))
+    assert magnitudes[0] > magnitudes[1] > magnitudes[2]
+    numpy.testing.assert_array_equal(echoes.summed(), samples.reshape(3, 64).sum(axis=0))
+
+
+def test_save_and_load(tmp_path):
+    echoes = anmr_echoes.EchoMatrix(numpy.arange(12.0).reshape(3, 4), [1e-3, 2e-3, 3e-3], [4, 3, 4], 2e-5)
+    fileName = str(tmp_path / 'echoes.npz')
+    echoes.save(fileName)
+    loaded = anmr_echoes.load(fileName)
+    numpy.testing.assert_array_equal(loaded.echoes, echoes.echoes)
+    numpy.testing.assert_array_equal(loaded.times, echoes.times)
+    numpy.testing.assert_array_equal(loaded.lengths, echoes.lengths)
+    assert loaded.timeStep == 2e-5
+    echoes.times = None
+    echoes.save(fileName)
+    assert anmr_echoes.load(fileName).times is None
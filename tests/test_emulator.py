@@ -0,0 +1,38 @@
+import pytest
+
+import anmr_analyzer
+import anmr_common
+import anmr_compiler
+import anmr_emulator
+
+
+def test_checksum_of_a_long_program():
+    # byte 200 is 255: 200 * 255 = 51000 is -14536 in the arduino's 16 bit int,
+    # sign extended into the unsigned long sum (201 * 255 likewise)
+    prog = bytes(199) + b'\xff'
+    assert anmr_emulator.firmwareChecksums(prog) == (4294952760, 4294953015)
+    assert anmr_compiler.checksums(prog) == (4294952760, 4294953015)
+
+
+def test_long_program_downloads(ardSer):
+    text = "PULSE_PROGRAM\n" + "DELAY_IN_CLOCKS 4294967295\n" * 60 + "READ_DATA 0 0 1 8\n"
+    program = anmr_compiler.compile_source(text)
+    # the plain sums the host used to form, which no arduino prints for this program
+    assert program.checksum1 != sum((i + 1) * b for i, b in enumerate(program.prog)) & 0xffffffff
+    assert anmr_common.sendProgram(program, ardSer) is True
+
+
+@pytest.mark.parametrize('count, passes', [(0, 1), (1, 1), (5, 5), (32767, 32767), (32768, 32768),
+                                           (32769, 1), (40000, 1), (65535, 1)])
+def test_loop_passes(count, passes):
+    assert anmr_compiler.loopPasses(count) == passes
+
+
+def test_loop_counter_is_signed():
+    # the firmware's int loopCounter is negative for 40000: the body runs once
+    program = anmr_compiler.compile_source("PULSE_PROGRAM\nLOOP 40000\nREAD_DATA 0 0 1 4\nEND_LOOP\n")
+    sent = []
+    anmr_emulator.BytecodeVM(program.prog).run(sent.append)
+    assert sum(chunk.startswith(b'DAT\r\n') for chunk in sent) == 1
+    assert program.total_readings == 4
+    assert anmr_analyzer.analyze(program.prog).totalReadings == 4
@@ -0,0 +1,47 @@
+import numpy
+
+import anmr_fitting
+
+TIMES = numpy.linspace(2e-3, 0.4, 60)
+
+
+def test_recovers_t2_from_noisy_decays():
+    rng = numpy.random.default_rng(5)
+    t2 = numpy.linspace(0.02, 0.2, 40)
+    y = 1000.0 * numpy.exp(-TIMES / t2[:, None]) + rng.normal(0, 5.0, (len(t2), len(TIMES)))
+    result = anmr_fitting.fitDecay(TIMES, y)
+    assert len(result) == len(t2) and result.converged.all()
+    numpy.testing.assert_allclose(result.value('T2'), t2, rtol=0.03)
+    numpy.testing.assert_allclose(result.value('A'), 1000.0, rtol=0.03)
+    # the quoted errors are about right: nearly all fits within 3 of them
+    assert numpy.mean(numpy.abs(result.value('T2') - t2) < 3 * result.error('T2')) > 0.9
+
+
+def test_one_curve_with_an_offset():
+    y = 500.0 * numpy.exp(-TIMES / 0.05) + 40.0
+    result = anmr_fitting.fitDecay(TIMES, y, offset=True)
+    assert result.names == ['A', 'T2', 'C']
+    numpy.testing.assert_allclose(result.params[0], [500.0, 0.05, 40.0], rtol=1e-6)
+
+
+def test_bi_exponential_puts_the_shorter_time_first():
+    y = 300.0 * numpy.exp(-TIMES / 0.15) + 700.0 * numpy.exp(-TIMES / 0.01)
+    result = anmr_fitting.fitDecay(TIMES, y, components=2)
+    assert result.converged.all()
+    numpy.testing.assert_allclose(result.params[0], [700.0, 0.01, 300.0, 0.15], rtol=1e-4)
+
+
+def test_missing_points_are_left_out():
+    y = 1000.0 * numpy.exp(-TIMES / 0.08)
+    y[::3] = numpy.nan
+    result = anmr_fitting.fitDecay(TIMES, y)
+    numpy.testing.assert_allclose(result.value('T2'), [0.08], rtol=1e-6)
+
+
+def test_recovery():
+    t = numpy.linspace(0.01, 2.0, 25)
+    y = 800.0 * (1 - numpy.exp(-t / 0.3))
+    result = anmr_fitting.fitRecovery(t, [y, y / 2])
+    assert result.converged.all()
+    numpy.testing.assert_allclose(result.value('T1'), [0.3, 0.3], rtol=1e-6)
+    numpy.testing.assert_allclose(result.value('A'), [800.0, 400.0], rtol=1e-6)
@@ -0,0 +1,89 @@
+import os
+
+import numpy
+import pytest
+
+pytest.importorskip('serial')
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+
+import anmr_cache  # noqa: E402
+import anmr_echoes  # noqa: E402
+import anmr_runfile  # noqa: E402
+import anmr_session  # noqa: E402
+import models  # noqa: E402
+
+ECHOES = """PULSE_PROGRAM
+%frequency = 2153
+SET_FREQ %frequency
+PULSE 0 0 1 6
+DELAY_IN_MS 2
+PULSE 0 0 1 12
+READ_DATA 0 0 1 300
+DELAY_IN_MS 2
+PULSE 0 0 1 12
+READ_DATA 0 0 1 300
+DELAY_IN_MS 2
+PULSE 0 0 1 12
+READ_DATA 0 0 1 200
+"""
+
+STEPS = ['step_compile_command_list', 'step_setup_serial_connection', 'step_check_arduino_readiness',
+         'step_transfer_compiled_program', 'step_start_experiment', 'step_data_acquisition_and_processing']
+
+
+@pytest.fixture
+def model(tmp_path, monkeypatch):
+    # an ExperimentModel on an emulated arduino, working in tmp_path
+    import anmr_emulator
+    if not hasattr(os, 'openpty'):
+        pytest.skip("the emulator needs a pty")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'pulse_program.txt').write_text(ECHOES)
+    emulator = anmr_emulator.ArduinoEmulator(timeScale=0.0, seed=1)
+    port = emulator.start()
+    anmr_session.sessions.session(port, hardware=False)
+    experiment = models.ExperimentModel()
+    experiment.serial_port = port
+    experiment.program_cache = anmr_cache.ProgramCache(cacheDir=None)
+    yield experiment
+    anmr_session.sessions.sessions.pop(port).close()
+    emulator.stop()
+
+
+def run(experiment):
+    for name in STEPS:
+        result = getattr(experiment, name)()
+        assert not isinstance(result, models.StepError), result
+    return result
+
+
+def test_blocks_are_read_straight_into_one_buffer(model):
+    chunks = []
+    model.on_data_chunk = lambda chunk: chunks.append(chunk.copy())
+    assert 'abgeschlossen' in run(model)
+    assert model.block_points == [300, 300, 200]
+    data = anmr_runfile.load('adc_run.anmr').scans[0]
+    assert len(data) == 800
+    # every value reached on_data_chunk exactly once, in order
+    numpy.testing.assert_array_equal(numpy.concatenate(chunks), data)
+    echoes = anmr_echoes.load('adc_echoes.npz')
+    numpy.testing.assert_array_equal(echoes.lengths, [300, 300, 200])
+    numpy.testing.assert_array_equal(echoes.echoes[2, :200], data[600:])
+    assert len(echoes.times) == 3
+
+
+def test_downconverted_on_ingest(model):
+    model.downconvert = 4
+    run(model)
+    assert model.baseband.blockPoints == [75, 75, 50]
+    assert model.baseband.samples.dtype.kind == 'c'
+
+
+def test_cancelled_acquisition_stops_at_once(model):
+    for name in STEPS[:-1]:
+        result = getattr(model, name)()
+        assert not isinstance(result, models.StepError), result
+    model.cancel_event.set()
+    result = model.step_data_acquisition_and_processing()
+    assert isinstance(result, models.StepError) and 'keine ADC-Daten' in result
@@ -0,0 +1,43 @@
+import pytest
+
+import anmr_analyzer
+import anmr_compiler
+import anmr_emulator
+
+LONG_DELAYS = """PULSE_PROGRAM
+%frequency = 2153
+SET_FREQ %frequency
+PULSE 0 0 1 6
+DELAY_IN_MS 10000
+DELAY_IN_MS 10000
+DELAY_IN_MS 10000
+DELAY_IN_MS 10000
+READ_DATA 0 0 1 64
+"""
+
+
+def runVM(program):
+    vm = anmr_emulator.BytecodeVM(program.prog, noise=0.0)
+    cycles = vm.run(lambda data: None)
+    return cycles, [(clock, kind) for clock, kind, value in vm.events]
+
+
+def test_merged_delays_fit_the_firmwares_signed_int():
+    program = anmr_compiler.compile_source(LONG_DELAYS, optimize=True)
+    delays = [args[0] for offset, opcode, args in anmr_compiler.decode(program.prog)
+              if opcode == anmr_compiler.DELAY_IN_MS]
+    assert max(delays) <= anmr_compiler.MAX_DELAY_MS
+    assert sum(delays) == 40000
+
+
+def test_optimized_program_runs_like_the_original():
+    plain = anmr_compiler.compile_source(LONG_DELAYS)
+    optimized = anmr_compiler.compile_source(LONG_DELAYS, optimize=True)
+    assert optimized.bytes_saved > 0
+    assert runVM(optimized) == runVM(plain)
+
+
+@pytest.mark.parametrize('ms, cycles', [(1, 16000), (0x7fff, 0x7fff * 16000),
+                                        (0x8000, (-0x8000 * 16000) & 0xffffffff)])
+def test_delay_is_signed_as_on_the_arduino(ms, cycles):
+    assert anmr_analyzer.delayMsCycles(ms) == cycles
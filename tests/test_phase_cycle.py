@@ -0,0 +1,56 @@
+import numpy
+
+import anmr_averaging
+import anmr_compiler
+import anmr_runfile
+
+# 90 degree steps on the excitation, the second READ_DATA negated every other scan
+CYCLED = """PULSE_PROGRAM
+SET_FREQ 2000
+PULSE 0 90 1 4
+PULSE 0 0 1 8
+READ_DATA 0 180 2 64
+READ_DATA 0 0 1 64
+"""
+
+
+def test_phase_cycle_schedule():
+    cycle = anmr_compiler.compile_source(CYCLED).phase_cycle
+    assert cycle.length == 4
+    assert cycle.blockPoints == [64, 64]
+    assert cycle.blockPhases(1) == [270, 270]
+    assert cycle.relativePhases() == [[0, 0], [270, 270], [0, 180], [270, 90]]
+
+
+def test_uncycled_program():
+    program = anmr_compiler.compile_source(CYCLED.replace("PULSE 0 90 1 4", "PULSE 0 0 1 4")
+                                           .replace("READ_DATA 0 180 2 64", "READ_DATA 0 0 1 64"))
+    assert program.phase_cycle.length == 1
+    assert type(anmr_averaging.makeAverager(program)) is anmr_averaging.Averager
+
+
+def test_co_add_turns_every_step_back():
+    program = anmr_compiler.compile_source(CYCLED)
+    averager = anmr_averaging.makeAverager(program)
+    assert isinstance(averager, anmr_averaging.PhaseCycledAverager)
+    t = numpy.arange(64)
+    cycle = program.phase_cycle
+    # 8 cycles per block, so the Hilbert transform of the blocks is exact
+    for scanNum in range(3, 11):
+        scan = numpy.concatenate([100 * numpy.cos(2 * numpy.pi * 8 * t / 64 + numpy.radians(phase))
+                                  for phase in cycle.blockPhases(scanNum)])
+        averager.add(numpy.round(scan).astype(int), scanNum)
+    assert averager.counts == [2, 2, 2, 2] and averager.missing() == 0
+    expected = numpy.concatenate([100 * numpy.cos(2 * numpy.pi * 8 * t / 64 + numpy.radians(phase))
+                                  for phase in cycle.blockPhases(0)])
+    numpy.testing.assert_allclose(averager.mean(), expected, atol=1.0)
+
+
+def test_long_cycle_falls_back_to_plain_averaging(capsys):
+    program = anmr_compiler.compile_source("PULSE_PROGRAM\nSET_FREQ 2000\nPULSE 0 2 255 4\nPULSE 0 2 254 4\n"
+                                           "READ_DATA 0 0 1 100\n")
+    assert program.phase_cycle.length == 11658600
+    averager = anmr_averaging.makeAverager(program)
+    assert type(averager) is anmr_averaging.Averager and len(averager) == 100
+    assert 'phase cycle of 11658600 scans' in capsys.readouterr().out
+    assert anmr_runfile.programHeader(program)['phaseCycle'] is None
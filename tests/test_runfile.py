@@ -0,0 +1,103 @@
+import numpy
+import pytest
+
+import anmr_averaging
+import anmr_common
+import anmr_runfile
+
+
+@pytest.fixture
+def scans():
+    return numpy.random.default_rng(2).integers(-512, 512, (5, 64)).astype(numpy.int16)
+
+
+def write(fileName, scans, **options):
+    with anmr_runfile.create(fileName, scans.shape[1], **options) as writer:
+        for scan in scans:
+            writer.append(scan)
+
+
+def test_round_trip(tmp_path, scans):
+    fileName = str(tmp_path / 'run.anmr')
+    write(fileName, scans, variables={'%frequency': 2153})
+    run = anmr_runfile.load(fileName)
+    assert len(run) == 5
+    assert isinstance(run.scans, numpy.memmap) and not run.scans.flags.writeable
+    numpy.testing.assert_array_equal(run.scans, scans)
+    numpy.testing.assert_array_equal(run.sum(), scans.sum(axis=0))
+    assert run.variables == {'%frequency': 2153}
+
+
+def test_append_leaves_the_header_alone(tmp_path, scans):
+    fileName = str(tmp_path / 'run.anmr')
+    writer = anmr_runfile.create(fileName, scans.shape[1])
+    with open(fileName, 'rb') as inFile:
+        header = inFile.read(writer.dataOffset)
+    for scan in scans:
+        writer.append(scan)
+    writer.close()
+    with open(fileName, 'rb') as inFile:
+        assert inFile.read(writer.dataOffset) == header
+
+
+def test_partial_scan_after_a_crash(tmp_path, scans):
+    fileName = str(tmp_path / 'run.anmr')
+    write(fileName, scans)
+    with open(fileName, 'ab') as outFile:
+        outFile.write(scans[0].tobytes()[:50])  # cut off while writing the next scan
+    assert len(anmr_runfile.load(fileName)) == 5
+    with anmr_runfile.append(fileName) as writer:
+        assert writer.scans == 5
+        writer.append(scans[0])
+    run = anmr_runfile.load(fileName)
+    numpy.testing.assert_array_equal(run.scans[:5], scans)
+    numpy.testing.assert_array_equal(run.scans[5], scans[0])
+
+
+def test_phase_cycled_mean(tmp_path, scans):
+    fileName = str(tmp_path / 'run.anmr')
+    phases = [[0], [180], [90], [270]]
+    write(fileName, scans, firstScanNum=3, phaseCycle={'length': 4, 'phases': phases})
+    averager = anmr_averaging.PhaseCycledAverager([scans.shape[1]], phases)
+    for i, scan in enumerate(scans):
+        averager.add(scan, 3 + i)
+    numpy.testing.assert_allclose(anmr_runfile.load(fileName).mean(), averager.mean())
+
+
+def test_readAFile_reads_run_and_text_files(tmp_path, scans):
+    fileName = str(tmp_path / 'run.anmr')
+    write(fileName, scans)
+    total, count = anmr_common.readAFile(fileName)
+    assert count == 5
+    numpy.testing.assert_array_equal(total, scans.sum(axis=0))
+    textName = tmp_path / 'data.txt'
+    textName.write_text('#3\n1\n2\n-3\n')
+    total, count = anmr_common.readAFile(str(textName))
+    assert count == 3 and list(total) == [1, 2, -3]
+
+
+def test_phase_cycled_mean_across_a_renumbering(tmp_path, scans):
+    # the arduino starts counting from 0 again after a download between scans 2 and 3
+    fileName = str(tmp_path / 'run.anmr')
+    phases = [[0], [180], [90], [270]]
+    numbers = [5, 6, 7, 0, 1]
+    with anmr_runfile.create(fileName, scans.shape[1], phaseCycle={'length': 4, 'phases': phases}) as writer:
+        for scan, scanNum in zip(scans, numbers):
+            writer.append(scan, scanNum)
+    header = anmr_runfile.load(fileName).header
+    assert header['firstScanNum'] == 5 and header['scanNumJumps'] == [[3, 0]]
+    averager = anmr_averaging.PhaseCycledAverager([scans.shape[1]], phases)
+    for scan, scanNum in zip(scans, numbers):
+        averager.add(scan, scanNum)
+    run = anmr_runfile.load(fileName)
+    assert run.averager().counts == averager.counts
+    numpy.testing.assert_allclose(run.mean(), averager.mean())
+
+
+def test_phase_cycled_run_with_unknown_scan_numbers(tmp_path, scans, capsys):
+    fileName = str(tmp_path / 'run.anmr')
+    write(fileName, scans, phaseCycle={'length': 4, 'phases': [[0], [180], [90], [270]]})
+    averager = anmr_runfile.load(fileName).averager()
+    assert type(averager) is anmr_averaging.Averager
+    numpy.testing.assert_allclose(averager.mean(), scans.mean(axis=0))
+    assert 'unknown' in capsys.readouterr().out
@@ -0,0 +1,102 @@
+import numpy
+import pytest
+
+import anmr_common
+import anmr_spectrum
+
+
+def tone(frequency, points=512, amplitude=100.0, timeStep=anmr_common.TIME_STEP):
+    return amplitude * numpy.cos(2 * numpy.pi * frequency * numpy.arange(points) * timeStep)
+
+
+def test_remove_dc():
+    samples = numpy.array([[1, 2, 3], [10, 10, 13]], dtype=numpy.int16)
+    numpy.testing.assert_allclose(anmr_spectrum.removeDC(samples), [[-1, 0, 1], [-1, -1, 2]])
+    numpy.testing.assert_allclose(anmr_spectrum.removeDC(samples, 2), [[-1, 0, 1], [8, 8, 11]])
+    assert samples[0, 0] == 1  # a copy
+    baseband = anmr_spectrum.removeDC(numpy.array([1 + 1j, 3 - 1j]))
+    numpy.testing.assert_allclose(baseband, [-1 + 1j, 1 - 1j])
+
+
+def test_fft_length():
+    assert anmr_spectrum.fftLength(512) == 512
+    assert anmr_spectrum.fftLength(500, zeroFill=2) == 1000
+    length = anmr_spectrum.fftLength(1021)
+    assert length >= 1021 and max(p for p in (2, 3, 5) if length % p == 0) <= 5
+
+
+def test_tone_lands_on_its_bin():
+    # 512 points of 104 us: bins 18.78 Hz apart, 2066 Hz is bin 110
+    freqs, spectra = anmr_spectrum.spectrum(tone(2066.0) + 512)
+    assert len(freqs) == len(spectra) == 257
+    assert freqs[1] == pytest.approx(1 / (512 * anmr_common.TIME_STEP))
+    assert freqs[-1] == pytest.approx(0.5 / anmr_common.TIME_STEP)
+    assert abs(freqs[numpy.abs(spectra).argmax()] - 2066.0) < freqs[1] / 2
+    assert abs(spectra[0]) < 1e-6  # the DC is removed
+
+
+def test_rows_are_transformed_together():
+    samples = numpy.stack([tone(1000.0), tone(3000.0, amplitude=20.0)])
+    freqs, spectra = anmr_spectrum.spectrum(samples, 'hann', zeroFill=2)
+    assert spectra.shape == (2, 513)
+    numpy.testing.assert_allclose(spectra[1], anmr_spectrum.spectrum(samples[1], 'hann', zeroFill=2)[1])
+    peaks = freqs[numpy.abs(spectra).argmax(axis=1)]
+    numpy.testing.assert_allclose(peaks, [1000.0, 3000.0], atol=freqs[1])
+
+
+def test_complex_samples_are_centred():
+    t = numpy.arange(256) * 8 * anmr_common.TIME_STEP
+    baseband = numpy.exp(2j * numpy.pi * -150.0 * t)
+    freqs, spectra = anmr_spectrum.spectrum(baseband, timeStep=8 * anmr_common.TIME_STEP, centre=2153.0)
+    assert len(freqs) == 256 and numpy.all(numpy.diff(freqs) > 0)
+    assert freqs[128] == 2153.0
+    assert abs(freqs[numpy.abs(spectra).argmax()] - 2003.0) < freqs[1] - freqs[0]
+
+
+def test_cached_axes_and_windows_are_read_only():
+    freqs = anmr_spectrum.frequencies(512)
+    assert freqs is anmr_spectrum.frequencies(512)
+    window = anmr_spectrum.apodization('exponential', 512, 5.0)
+    for array in (freqs, window):
+        with pytest.raises(ValueError):
+            array[0] = 1
+    assert window[0] == 1 and window[-1] < 1
+    with pytest.raises(ValueError):
+        anmr_spectrum.apodization('square', 512)
+
+
+
+def lorentzians(n=512, lines=((150, 1.0), (330, 0.6)), width=0.5):
+    # complex spectrum of absorption lines, width in bins. With 18.8 Hz bins
+    # the lines of a long FID are well under a bin wide; broad lines pull the
+    # power weighted phi1 a few degrees per bin of width
+    k = numpy.arange(n)
+    return sum(height * width / (width - 1j * (k - position)) for position, height in lines)
+
+
+def test_auto_phase_undoes_a_known_phase():
+    pure = lorentzians()
+    spectra = anmr_spectrum.phase(numpy.stack([pure, pure]), [-70.0, 40.0], [120.0, -200.0])
+    phased, phi0, phi1 = anmr_spectrum.autoPhase(spectra)
+    numpy.testing.assert_allclose(phi1, [-120.0, 200.0], atol=6.0)
+    numpy.testing.assert_allclose((phi0 - [70.0, -40.0] + 180) % 360 - 180, 0, atol=3.0)
+    numpy.testing.assert_allclose(phased.real, [pure.real, pure.real], atol=0.01)
+    # starting from the last phi1 only refines it
+    again = anmr_spectrum.autoPhase(spectra, phi1Start=phi1)
+    numpy.testing.assert_allclose(again[2], phi1, atol=0.1)
+
+
+def test_auto_phase_single_line():
+    pure = lorentzians(lines=((200, 1.0),), width=3.0)
+    phased, phi0, phi1 = anmr_spectrum.autoPhase(anmr_spectrum.phase(pure, 135.0, 0.0))
+    assert abs(phased.real.max() - 1.0) < 0.01 and phased.real.argmax() == 200
+    assert phased.real.min() > -0.05
+
+
+def test_baseline_removes_a_polynomial_under_the_lines():
+    x = numpy.linspace(-1, 1, 512)
+    drift = 0.3 + 0.2 * x - 0.4 * x ** 3
+    real = lorentzians(width=3.0).real + drift
+    fit = anmr_spectrum.baseline(numpy.stack([real, drift]))
+    numpy.testing.assert_allclose(fit[1], drift, atol=1e-9)
+    numpy.testing.assert_allclose(fit[0], drift, atol=0.02)
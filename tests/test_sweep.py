@@ -0,0 +1,68 @@
+import pytest
+
+import anmr_compiler
+import anmr_sweep
+
+ECHO = """PULSE_PROGRAM
+%echo_delay = 0
+%frequency = 2153
+%pin = 12
+SET_FREQ %frequency
+CHANGE_PIN %pin 1
+PULSE 0 0 1 6
+DELAY_IN_MS %echo_delay
+PULSE 0 0 1 12
+READ_DATA 0 0 1 256
+"""
+
+
+def assertSameProgram(program, reference):
+    assert bytes(program.prog) == bytes(reference.prog)
+    assert (program.checksum1, program.checksum2) == (reference.checksum1, reference.checksum2)
+    assert program.total_readings == reference.total_readings
+
+
+@pytest.mark.parametrize('values', [{'%frequency': 2000}, {'%echo_delay': 0, '%pin': 13}])
+def test_patch_matches_compile(values):
+    patcher = anmr_sweep.ProgramPatcher(anmr_compiler.compile_source(ECHO))
+    assertSameProgram(patcher.patch(values), anmr_compiler.compile_source(ECHO, values))
+
+
+def test_patch_refuses_variable_whose_value_dropped_its_instruction():
+    patcher = anmr_sweep.ProgramPatcher(anmr_compiler.compile_source(ECHO))
+    with pytest.raises(ValueError):
+        patcher.patch({'%echo_delay': 40})
+    # the working copy is left as it was
+    assertSameProgram(patcher.patch({}), anmr_compiler.compile_source(ECHO))
+
+
+def test_patch_refuses_null_loop_count():
+    text = ECHO.replace("PULSE 0 0 1 12\n", "%echoes = 0\nLOOP %echoes\nPULSE 0 0 1 12\nEND_LOOP\n")
+    patcher = anmr_sweep.ProgramPatcher(anmr_compiler.compile_source(text))
+    with pytest.raises(ValueError):
+        patcher.patch({'%echoes': 3})
+
+
+def test_programs_recompile_dropped_instruction():
+    sweep = anmr_sweep.Sweep([('echo_delay', [0, 40])])
+    runner = anmr_sweep.SweepRunner(ECHO, sweep, None)
+    for index, values, program in runner.programs():
+        assertSameProgram(program, anmr_compiler.compile_source(ECHO, values))
+    assert runner.recompiled == 1
+
+
+def test_programs_report_points_that_dont_compile():
+    sweep = anmr_sweep.Sweep([('pin', [12, 300])])  # 300 doesn't fit in CHANGE_PIN's byte
+    runner = anmr_sweep.SweepRunner(ECHO, sweep, None)
+    programs = list(runner.programs())
+    assert programs[0][2] is not None
+    assert programs[1][2] is None
+    assert list(runner.errors) == [(1,)]
+
+
+def test_run_measures_the_points_that_compile(ardSer):
+    sweep = anmr_sweep.Sweep([('pin', [12, 300])])
+    runner = anmr_sweep.SweepRunner(ECHO, sweep, ardSer)
+    result = runner.run()
+    assert result is not True and "didn't compile" in result
+    assert list(runner.lengths) == [256, 0]
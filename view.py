@@ -1,14 +1,119 @@
 from PyQt5.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QLabel, QGroupBox, QTextEdit,
     QPushButton, QTabWidget, QScrollArea, QSpinBox, QHBoxLayout, QSplitter, QSizePolicy,
-    QAction, QStatusBar, QPlainTextEdit, QApplication, QMessageBox
+    QAction, QStatusBar, QPlainTextEdit, QApplication, QMessageBox, QProgressBar
 )
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QPixmap
 from models import PulseModel, PulseFileModel, ExperimentModel
 from controller import PulseControlController, ExperimentController
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+import numpy as np
+
+
+def minmax_decimate(y, width):
+    """
+    Reduziert y auf eine senkrechte Strecke vom Minimum zum Maximum je Pixelspalte,
+    damit auch schmale Spitzen sichtbar bleiben. Die Strecken sind durch NaN getrennt:
+    eine durchgehende Zickzack-Linie braucht in Agg ein Vielfaches der Zeit.
+    Gibt (x, y) zurück, unverändert wenn y höchstens 2 * width Werte hat.
+    """
+    n = len(y)
+    width = max(int(width), 1)
+    if n <= 2 * width:
+        return np.arange(n), y
+    bucket = -(-n // width)  # Werte je Pixelspalte, aufgerundet
+    full = n - n % bucket
+    columns = y[:full].reshape(-1, bucket)
+    mins = columns.min(axis=1)
+    maxs = columns.max(axis=1)
+    if full < n:
+        mins = np.append(mins, y[full:].min())
+        maxs = np.append(maxs, y[full:].max())
+    x = np.repeat(np.arange(len(mins)) * bucket + bucket // 2, 3)
+    return x, np.column_stack((mins, maxs, np.full(len(mins), np.nan))).ravel()
+
+
+class LiveFidPlot:
+    """
+    Live-Anzeige der Messwerte während der Datenaufnahme. Neue DAT-Daten werden nur
+    angehängt; ein Timer zeichnet höchstens FRAME_INTERVAL_MS oft neu, und zwar nur die
+    Linie (Blitting) aus einer Min/Max-Dezimierung auf die Pixelbreite der Achse.
+    """
+    FRAME_INTERVAL_MS = 33  # ca. 30 Bilder pro Sekunde
+
+    def __init__(self, figure, canvas, expected):
+        self.figure = figure
+        self.canvas = canvas
+        self.data = np.empty(max(expected, 1), dtype=np.int16)
+        self.count = 0
+        self.dirty = False
+        self.background = None
+        self.axes = figure.add_subplot(1, 1, 1)
+        self.axes.set_title("ADC Data (live)", fontsize=10)
+        self.axes.set_xlabel("Measurement No.", fontsize=8)
+        self.axes.set_ylabel("ADC Value", fontsize=8)
+        self.axes.grid(True)
+        self.axes.set_xlim(0, len(self.data))
+        self.y_limit = 64  # wird bei Bedarf verdoppelt
+        self.axes.set_ylim(-self.y_limit, self.y_limit)
+        (self.line,) = self.axes.plot([], [], animated=True)
+        self.draw_cid = canvas.mpl_connect("draw_event", self._on_draw)
+        self.timer = QTimer()
+        self.timer.setInterval(self.FRAME_INTERVAL_MS)
+        self.timer.timeout.connect(self.redraw)
+        self.timer.start()
+        canvas.draw()
+
+    def append(self, chunk):
+        """Hängt neu empfangene Messwerte an; gezeichnet wird beim nächsten Timer-Tick."""
+        if len(chunk) == 0:
+            return
+        end = self.count + len(chunk)
+        if end > len(self.data):
+            grown = np.empty(max(2 * len(self.data), end), dtype=self.data.dtype)
+            grown[:self.count] = self.data[:self.count]
+            self.data = grown
+        self.data[self.count:end] = chunk
+        self.count = end
+        self.dirty = True
+
+    def _on_draw(self, event):
+        """Nach jedem vollständigen Zeichnen den Hintergrund für das Blitting merken."""
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.axes.draw_artist(self.line)
+
+    def _set_line_data(self):
+        width = self.axes.get_window_extent().width
+        x, y = minmax_decimate(self.data[:self.count], width)
+        self.line.set_data(x, y)
+
+    def redraw(self):
+        """Zeichnet die Linie neu, falls seit dem letzten Mal Daten dazugekommen sind."""
+        if not self.dirty:
+            return
+        self.dirty = False
+        self._set_line_data()
+        peak = int(np.abs(self.data[:self.count].astype(np.int32)).max())
+        relayout = False
+        while peak > self.y_limit:
+            self.y_limit *= 2
+            relayout = True
+        if self.count > self.axes.get_xlim()[1]:
+            self.axes.set_xlim(0, len(self.data))
+            relayout = True
+        if relayout or self.background is None:
+            self.axes.set_ylim(-self.y_limit, self.y_limit)
+            self.canvas.draw()  # _on_draw merkt den neuen Hintergrund und zeichnet die Linie
+        else:
+            self.canvas.restore_region(self.background)
+            self.axes.draw_artist(self.line)
+        self.canvas.blit(self.figure.bbox)
+
+    def close(self):
+        self.timer.stop()
+        self.canvas.mpl_disconnect(self.draw_cid)
 
 
 class TitleScreen(QWidget):
@@ -308,6 +413,7 @@ class MainWindow(QMainWindow):
         if hasattr(self, "experiment_execution_view"):
             self.experiment_execution_view.output_area.clear()
         if hasattr(self, "figure") and self.figure:
+            self.end_live_plot()
             self.figure.clear()
             self.canvas.draw()
 
@@ -321,6 +427,7 @@ class MainWindow(QMainWindow):
         # Fügt das Matplotlib-Canvas hinzu
         self.figure = Figure(figsize=(6, 4))  # Kleinere Diagrammgröße
         self.canvas = FigureCanvas(self.figure)
+        self.diagram_axes = []  # (Achse, Linie) je Diagramm, werden wiederverwendet
         self.diagrams_layout.addWidget(self.canvas)
         # Fügt den Messdiagramme-Tab hinzu
         self.tab_widget.addTab(self.diagrams_tab, "Messdiagramme")
@@ -337,22 +444,65 @@ class MainWindow(QMainWindow):
         # **Direkter Aufruf der Methode**
         self.experiment_controller.run_until_start_experiment()
 
+    def begin_live_plot(self, expected):
+        """Ersetzt die Diagramme durch die Live-Anzeige der Datenaufnahme (expected: erwartete Werte)."""
+        if not hasattr(self, "figure") or not self.figure:
+            return None
+        self.end_live_plot()
+        self.figure.clear()
+        self.diagram_axes = []
+        self.live_plot = LiveFidPlot(self.figure, self.canvas, expected)
+        return self.live_plot
+
+    def end_live_plot(self):
+        """Beendet die Live-Anzeige, die Daten bleiben bis zum nächsten Zeichnen stehen."""
+        if getattr(self, "live_plot", None) is not None:
+            self.live_plot.redraw()
+            self.live_plot.close()
+            self.live_plot = None
+
+    def _diagram_axes(self, count):
+        """
+        Gibt (Achse, Linie) für count Diagramme untereinander zurück. Solange sich die Anzahl
+        nicht ändert, bleiben Achsen und Linien erhalten; nur sonst wird die Figure neu aufgeteilt.
+        Gibt zusätzlich zurück, ob neu aufgeteilt wurde.
+        """
+        if count and len(self.diagram_axes) == count:
+            return self.diagram_axes, False
+        self.figure.clear()  # Löscht alte Diagramme
+        self.diagram_axes = []
+        for i in range(1, count + 1):
+            subplot = self.figure.add_subplot(count, 1, i)
+            subplot.grid(True)
+            (line,) = subplot.plot([], [])
+            self.diagram_axes.append((subplot, line))
+        return self.diagram_axes, True
+
     def update_diagrams(self, plots):
-        """Zeichnet die Diagramme in den Messdiagramme-Tab."""
+        """
+        Zeichnet die Diagramme in den Messdiagramme-Tab. "x" und "y" sind NumPy-Arrays; sie
+        werden ohne Kopie an die vorhandenen Linien übergeben, geändert werden nur Daten,
+        Beschriftung und Achsengrenzen.
+        """
         if not hasattr(self, "figure") or not self.figure:
             return  # Falls kein Diagramm vorhanden ist, abbrechen
+        self.end_live_plot()
 
-        self.figure.clear()  # Löscht alte Diagramme
-        for i, plot in enumerate(plots, start=1):
-            subplot = self.figure.add_subplot(len(plots), 1, i)
-            subplot.plot(plot["x"], plot["y"])
+        axes_lines, relayout = self._diagram_axes(len(plots))
+        for (subplot, line), plot in zip(axes_lines, plots):
+            line.set_data(plot["x"], plot["y"])
             subplot.set_title(plot["title"], fontsize=10)
-            subplot.set_xlabel(plot["xlabel"], fontsize=8)
-            subplot.set_ylabel(plot["ylabel"], fontsize=8)
-            subplot.grid(True)
-
-        self.figure.tight_layout(pad=2.0)  # Verhindert Überlappungen
-        self.canvas.draw()
+            if (subplot.get_xlabel(), subplot.get_ylabel()) != (plot["xlabel"], plot["ylabel"]):
+                # nur neue Achsenbeschriftungen ändern den Platzbedarf
+                subplot.set_xlabel(plot["xlabel"], fontsize=8)
+                subplot.set_ylabel(plot["ylabel"], fontsize=8)
+                relayout = True
+            subplot.relim()
+            subplot.autoscale_view()
+
+        if relayout:
+            self.figure.tight_layout(pad=2.0)  # Verhindert Überlappungen
+        self.canvas.draw_idle()
 
     def leave_experiment(self):
         """Wechselt zurück zum Parameter-Tab und setzt das Experiment zurück."""
@@ -361,6 +511,7 @@ class MainWindow(QMainWindow):
             if self.tab_widget.indexOf(self.experiment_execution_view) != -1:
                 self.tab_widget.removeTab(self.tab_widget.indexOf(self.experiment_execution_view))
 
+            self.end_live_plot()
             if hasattr(self, "diagrams_tab") and self.tab_widget.indexOf(self.diagrams_tab) != -1:
                 self.tab_widget.removeTab(self.tab_widget.indexOf(self.diagrams_tab))
 
@@ -606,10 +757,19 @@ class ExperimentExecutionView(QWidget):
         self.restart_button = QPushButton("Experiment neustarten")
         self.restart_button.clicked.connect(self.controller.restart_experiment)
 
+        self.cancel_button = QPushButton("Datenaufnahme abbrechen")
+        self.cancel_button.clicked.connect(self.controller.cancel_step)
+
+        # Fortschritt der Datenaufnahme (empfangene Messwerte)
+        self.progress_bar = QProgressBar(self)
+        self.progress_bar.setValue(0)
+
         # Widgets hinzufügen
         self.layout.addWidget(self.output_area)
+        self.layout.addWidget(self.progress_bar)
         self.layout.addWidget(self.start_button)
         self.layout.addWidget(self.restart_button)
+        self.layout.addWidget(self.cancel_button)
 
     def update_output(self, message):
         """Aktualisiert den Ausgabe-Bereich der GUI."""
@@ -618,3 +778,8 @@ class ExperimentExecutionView(QWidget):
             return
         self.output_area.append(message)
         self.output_area.verticalScrollBar().setValue(self.output_area.verticalScrollBar().maximum())
+
+    def update_progress(self, received, expected):
+        """Zeigt an, wie viele Messwerte bereits empfangen wurden."""
+        self.progress_bar.setMaximum(max(expected, received, 1))
+        self.progress_bar.setValue(received)